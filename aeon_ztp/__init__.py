@@ -26,8 +26,15 @@ def create_app(conf=None):
     app.register_blueprint(api)
     app.register_blueprint(web)
 
-    @app.before_first_request
-    def initialize_database():
-        db.create_all()
+    app.before_first_request(initialize_database)
 
     return app
+
+
+def initialize_database():
+    """Upgrades the tables of an existing database and creates the missing ones, in the current app context
+    """
+    from aeon_ztp.api.migrate import add_missing_columns, upgrade_devices_table
+    upgrade_devices_table(db.engine)
+    add_missing_columns(db.engine)
+    db.create_all()
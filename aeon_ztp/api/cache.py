@@ -0,0 +1,192 @@
+# Copyright 2014-present, Apstra, Inc. All rights reserved.
+#
+# This source code is licensed under End User License Agreement found in the
+# LICENSE file at http://www.apstra.com/community/eula
+#
+# Write-through cache of device records keyed by (os_name, ip_addr).
+#
+# Writes never trust the cache blindly: a cached record is updated with
+# "UPDATE ... WHERE id = :id AND updated_at = :cached_updated_at", so a record
+# changed by another server process simply fails the update and the caller
+# falls back to the database.
+#
+# Reads need more than that, since nothing checks a cached value that is
+# returned to the client.  Every write bumps a per-key change counter, kept in
+# a small memory mapped file shared by all of the server processes, and a
+# cached record is only returned if its counter has not changed since the
+# record was read from the database.
+
+import fcntl
+import mmap
+import os
+import struct
+import threading
+import zlib
+from collections import OrderedDict
+
+from aeon_ztp.api.models import Device
+from aeon_ztp.ztp_metrics import metrics
+
+_AEON_CACHE_FILE = os.getenv('AEON_CACHE_FILE')
+
+_SLOTS = 4096
+_COUNTER = struct.Struct('=Q')
+
+
+class VersionTable(object):
+    """ Change counters shared by the server processes.  Keys are hashed onto
+    a fixed number of slots; keys sharing a slot only cause extra cache misses.
+    Slot 0 is the epoch, bumped when devices are deleted in bulk.
+
+    Attributes:
+        fpath (str): File backing the counters, or None for an anonymous
+                     mapping shared only with forked processes
+    """
+    def __init__(self, fpath=None, slots=_SLOTS):
+        self.fpath = fpath
+        self.slots = slots
+        size = (slots + 1) * _COUNTER.size
+        self._lock = threading.Lock()
+        self._fd = None
+
+        if fpath:
+            self._fd = os.open(fpath, os.O_RDWR | os.O_CREAT, 0o664)
+            if os.fstat(self._fd).st_size < size:
+                os.ftruncate(self._fd, size)
+            self._map = mmap.mmap(self._fd, size)
+        else:
+            self._map = mmap.mmap(-1, size)
+
+    def _offset(self, key):
+        slot = 1 + (zlib.crc32((u'%s|%s' % key).encode('utf-8')) & 0xffffffff) % self.slots
+        return slot * _COUNTER.size
+
+    def get(self, key):
+        """ Returns:
+            tuple: (epoch, key counter)
+        """
+        return (_COUNTER.unpack_from(self._map, 0)[0],
+                _COUNTER.unpack_from(self._map, self._offset(key))[0])
+
+    def bump(self, key=None):
+        """ Bumps the counter of the key, or the epoch when no key is given.
+        """
+        offset = self._offset(key) if key else 0
+        with self._lock:
+            if self._fd is not None:
+                fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                value = _COUNTER.unpack_from(self._map, offset)[0]
+                _COUNTER.pack_into(self._map, offset, value + 1)
+            finally:
+                if self._fd is not None:
+                    fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+
+class CachedDevice(object):
+    """ Detached copy of a devices row; has the same attributes as Device so it
+    can be passed to update_device_status() and the device schema.
+    """
+    def __init__(self, values):
+        self.__dict__.update(values)
+
+    def values(self):
+        return dict(self.__dict__)
+
+
+def device_values(rec):
+    """ Returns:
+        dict: column name -> value of a loaded Device
+    """
+    return dict((col.name, getattr(rec, col.name)) for col in Device.__table__.columns)
+
+
+class DeviceCache(object):
+    """ In-process cache of device records keyed by (os_name, ip_addr).
+
+    Attributes:
+        versions (VersionTable): Shared change counters
+        max_size (int): Number of records kept, least recently used are dropped
+        hits (int): Lookups answered from the cache
+        misses (int): Lookups that had to go to the database
+    """
+    def __init__(self, versions=None, max_size=10000):
+        self.versions = versions or VersionTable()
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def version(self, os_name, ip_addr):
+        """ Returns the current change counter of a device; read it before
+        reading the device from the database and pass it to put().
+        """
+        return self.versions.get((os_name, ip_addr))
+
+    def get(self, os_name, ip_addr, for_update=False):
+        """ Looks up a device.
+
+        Args:
+            os_name (str): Device os_name
+            ip_addr (str): Device ip_addr
+            for_update (bool): The record is only used for a guarded update, so
+                               it does not have to be known to be current
+
+        Returns:
+            CachedDevice: copy of the cached record, or None on a miss
+        """
+        key = (os_name, ip_addr)
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self._entries[key] = entry
+            usable = entry is not None and (for_update or entry[0] == self.versions.get(key))
+            if usable:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+        metrics.inc('aeon_ztp_device_cache_lookups_total', dict(result='hit' if usable else 'miss'))
+        return CachedDevice(entry[1]) if usable else None
+
+    def put(self, values, version=None):
+        """ Caches a device record.
+
+        Args:
+            values (dict): Column values, see device_values()
+            version (tuple): Change counter read before the record was read
+                             from the database, or None if the record may only
+                             be used for updates
+        """
+        key = (values['os_name'], values['ip_addr'])
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (version, dict(values))
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def written(self, values):
+        """ Records a committed write of a device: other processes, and reads
+        in this one, stop trusting their copy, and the written values are
+        kept for the next update.
+        """
+        self.versions.bump((values['os_name'], values['ip_addr']))
+        self.put(values)
+
+    def invalidate(self, os_name, ip_addr):
+        """ Drops a device, eg: after a failed guarded update or a delete.
+        """
+        self.versions.bump((os_name, ip_addr))
+        with self._lock:
+            self._entries.pop((os_name, ip_addr), None)
+
+    def clear(self):
+        """ Drops all of the devices, in every process.
+        """
+        self.versions.bump()
+        with self._lock:
+            self._entries.clear()
+
+
+device_cache = DeviceCache(VersionTable(_AEON_CACHE_FILE))
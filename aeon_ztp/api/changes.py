@@ -0,0 +1,46 @@
+# Copyright 2014-present, Apstra, Inc. All rights reserved.
+#
+# This source code is licensed under End User License Agreement found in the
+# LICENSE file at http://www.apstra.com/community/eula
+
+import threading
+
+
+class ChangeNotifier(object):
+    """ Wakes up the GET /api/devices/changes long-poll requests waiting in this
+    process whenever a device row is written.
+
+    Requests served by other processes are not notified; the long-poll loop
+    re-checks the database every few seconds to pick those changes up.
+
+    Attributes:
+        version (int): Incremented on every notify()
+    """
+    def __init__(self):
+        self._cond = threading.Condition()
+        self.version = 0
+
+    def notify(self):
+        """ Signals that device rows have changed.
+        """
+        with self._cond:
+            self.version += 1
+            self._cond.notify_all()
+
+    def wait(self, version, timeout):
+        """ Waits for a notify() after the given version was read.
+
+        Args:
+            version (int): Value of the version attribute read before checking for changes
+            timeout (float): Maximum number of seconds to wait
+
+        Returns:
+            int: Current version
+        """
+        with self._cond:
+            if self.version == version:
+                self._cond.wait(timeout)
+            return self.version
+
+
+notifier = ChangeNotifier()
@@ -0,0 +1,271 @@
+# Copyright 2014-present, Apstra, Inc. All rights reserved.
+#
+# This source code is licensed under End User License Agreement found in the
+# LICENSE file at http://www.apstra.com/community/eula
+#
+# Client side helpers used by the bootstrappers to report device progress to
+# the Aeon-ZTP server REST API.
+
+import json
+import os
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+
+# (connect, read) seconds, for the requests that do not give their own
+_TIMEOUT = (5, 60)
+_RETRIES = 3
+_RETRY_BACKOFF = 0.5
+_POOL_SIZE = 32
+
+_session = None
+_session_pid = None
+_session_lock = threading.Lock()
+
+
+class ApiAdapter(HTTPAdapter):
+    """ Keeps up to _POOL_SIZE connections to the server alive, retries the
+    requests that fail to connect, and the idempotent ones the server is too
+    busy to answer, with an exponential backoff, and gives the requests a
+    default timeout.
+    """
+    def __init__(self, timeout=_TIMEOUT, retries=_RETRIES, pool_size=_POOL_SIZE):
+        self.timeout = timeout
+        super(ApiAdapter, self).__init__(
+            pool_connections=1, pool_maxsize=pool_size,
+            max_retries=Retry(total=retries, backoff_factor=_RETRY_BACKOFF,
+                              status_forcelist=(502, 503, 504), raise_on_status=False))
+
+    def send(self, request, **kwargs):
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = self.timeout
+        return super(ApiAdapter, self).send(request, **kwargs)
+
+
+def api_session():
+    """ Returns:
+        requests.Session: shared by the threads of this process to talk to the
+        Aeon-ZTP server; a forked process, eg: a celery worker, gets its own
+    """
+    global _session, _session_pid
+    with _session_lock:
+        if _session is None or _session_pid != os.getpid():
+            _session = requests.Session()
+            _session.mount('http://', ApiAdapter())
+            _session_pid = os.getpid()
+        return _session
+
+
+class DeviceUpdateBatch(object):
+    """ Collects device status and facts updates and sends them to the Aeon-ZTP server
+    with a single PUT /api/devices/batch request.
+
+    Pending updates are sent when the device state changes, when max_items
+    updates are pending, when the oldest pending update is max_age seconds
+    old, or when flush() is called.  Repeated progress messages for the same
+    state, eg: the reload countdown in wait_for_device(), are therefore
+    grouped into one request.  The max_age flush is run by a timer, so an
+    update queued before a long wait, eg: for a reboot or an image transfer,
+    is not held back until the wait ends.
+
+    Updates the server does not accept stay pending, and are sent again by
+    the next flush.  Checkpoints are always sent immediately, and a checkpoint
+    the server does not save raises: the bootstrap must not go on before its
+    checkpoint is saved.
+
+    Attributes:
+        server (str): Aeon-ZTP server host:port
+        max_items (int): Number of pending updates that triggers a flush
+        max_age (int): Age in seconds of the oldest pending update that triggers a flush
+        facts (list): Pending facts updates
+        checkpoints (list): Pending checkpoint updates
+        status (list): Pending status updates
+    """
+    def __init__(self, server, max_items=20, max_age=30):
+        self.server = server
+        self.max_items = max_items
+        self.max_age = max_age
+        self.facts = []
+        self.checkpoints = []
+        self.status = []
+        self._last_state = None
+        self._oldest = None
+        self._timer = None
+        # the timer thread flushes too, the updates are sent in order
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self.facts) + len(self.checkpoints) + len(self.status)
+
+    def add_facts(self, dev_data):
+        """ Queues a facts update, see PUT /api/devices/facts for the dev_data content.
+        """
+        self._queue(self.facts, dev_data)
+
+    def add_checkpoint(self, os_name, ip_addr, checkpoint, data=None):
+        """ Saves a bootstrap checkpoint, along with anything else that is
+        pending.  A checkpoint of None clears the saved checkpoints.
+
+        Raises:
+            requests.RequestException: the checkpoint was not saved
+        """
+        with self._lock:
+            self._queue(self.checkpoints, dict(os_name=os_name, ip_addr=ip_addr, checkpoint=checkpoint, data=data),
+                        flush=False)
+            self.flush().raise_for_status()
+
+    def add_status(self, os_name, ip_addr, state=None, message=None, phases=None):
+        """ Queues a status update.  A change of state is sent immediately, along
+        with anything else that is pending.  phases are the bootstrap phase
+        timings, see aeon_ztp.ztp_timing, sent with the final status.
+        """
+        item = dict(os_name=os_name, ip_addr=ip_addr, state=state, message=message)
+        if phases is not None:
+            item['phases'] = phases
+        with self._lock:
+            state_changed = bool(state) and state != self._last_state
+            if state:
+                self._last_state = state
+            self._queue(self.status, item, state_changed=state_changed)
+
+    def flush(self):
+        """ Sends all pending updates to the server.  The updates stay pending
+        unless the server accepts them, they are sent again by the next flush.
+
+        Returns:
+            requests.Response: Server response, or None if nothing was pending
+
+        Raises:
+            requests.RequestException: the server could not be reached
+        """
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            if not len(self):
+                return None
+
+            body = dict(facts=self.facts, status=self.status)
+            if self.checkpoints:
+                body['checkpoints'] = self.checkpoints
+            resp = None
+            try:
+                resp = api_session().put(url='http://%s/api/devices/batch' % self.server, json=body)
+            finally:
+                if resp is not None and resp.ok:
+                    self.facts, self.checkpoints, self.status, self._oldest = [], [], [], None
+                else:
+                    # tried again max_age seconds from now
+                    self._oldest = time.time()
+                    self._start_timer()
+            return resp
+
+    def _queue(self, pending, item, state_changed=False, flush=True):
+        with self._lock:
+            if self._oldest is None:
+                self._oldest = time.time()
+            pending.append(item)
+            if self._timer is None:
+                self._start_timer()
+
+            due = state_changed or len(self) >= self.max_items or time.time() - self._oldest >= self.max_age
+            if flush and due:
+                self.flush()
+
+    def _start_timer(self):
+        if self.max_age and self._timer is None:
+            self._timer = threading.Timer(self.max_age, self._flush_due)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def _flush_due(self):
+        with self._lock:
+            # a flush, or a new timer, since this one fired
+            if self._timer is None or self._timer is not threading.current_thread():
+                return
+            self._timer = None
+        try:
+            self.flush()
+        except Exception:
+            # the requests were retried already, the updates stay pending and
+            # the next flush sends them again
+            pass
+
+
+def get_device_checkpoints(server, os_name, ip_addr):
+    """ Returns:
+        dict: checkpoint name: data of the checkpoints saved for a device,
+        empty if there are none
+    """
+    got = api_session().get(url='http://%s/api/devices' % server,
+                            params=dict(os_name=os_name, ip_addr=ip_addr, fields='checkpoints'))
+    items = got.json().get('items') if got.ok else None
+    if not items or not items[0].get('checkpoints'):
+        return {}
+    return json.loads(items[0]['checkpoints'])
+
+
+class Checkpoints(object):
+    """ Checkpoints of a bootstrap that goes through an ordered list of phases.
+
+    Each completed phase is saved on the server, with the data needed to go on
+    without repeating it, eg: the selected image.  A bootstrap restarted after
+    an interruption loads the saved checkpoints and skips the completed phases.
+
+    Attributes:
+        updates (DeviceUpdateBatch): Sends the checkpoints
+        os_name (str): Device os_name
+        target (str): Device ip_addr
+        phases (tuple): Phase names, in the order the bootstrap completes them
+        saved (dict): name: data of the completed phases
+    """
+    def __init__(self, updates, os_name, target, phases):
+        self.updates = updates
+        self.os_name = os_name
+        self.target = target
+        self.phases = phases
+        self.saved = {}
+
+    @property
+    def last(self):
+        """ Returns:
+            str: the last completed phase, or None
+        """
+        done = [name for name in self.phases if name in self.saved]
+        return done[-1] if done else None
+
+    def done(self, name):
+        """ Returns:
+            bool: True if the phase, or a phase after it, was completed
+        """
+        last = self.last
+        return last is not None and self.phases.index(last) >= self.phases.index(name)
+
+    def get(self, name, key, default=None):
+        """ Returns the data saved with a completed phase.
+        """
+        return (self.saved.get(name) or {}).get(key, default)
+
+    def load(self, server):
+        """ Loads the checkpoints saved by an interrupted bootstrap.
+        """
+        self.saved = get_device_checkpoints(server, self.os_name, self.target)
+        return self.saved
+
+    def save(self, name, **data):
+        """ Records the completion of a phase.
+
+        Raises:
+            requests.RequestException: the server did not save it
+        """
+        self.updates.add_checkpoint(self.os_name, self.target, name, data)
+        self.saved[name] = data
+
+    def reset(self):
+        """ Clears the checkpoints, the bootstrap starts from the beginning.
+        """
+        self.updates.add_checkpoint(self.os_name, self.target, None)
+        self.saved = {}
@@ -0,0 +1,113 @@
+# Copyright 2014-present, Apstra, Inc. All rights reserved.
+#
+# This source code is licensed under End User License Agreement found in the
+# LICENSE file at http://www.apstra.com/community/eula
+#
+# Time-series helpers for the device_events state transition history.
+
+import json
+import math
+from collections import defaultdict
+from itertools import groupby
+
+# states that end a bootstrap run; the time spent in them is not a phase
+TERMINAL_STATES = ('DONE', 'ERROR', 'FAILED')
+
+PERCENTILES = (50, 90, 99)
+
+
+def percentile(values, pct):
+    """ Nearest-rank percentile.
+
+    Args:
+        values (list): Sorted list of numbers
+        pct (int): Percentile, 0 - 100
+
+    Returns:
+        The value at the given percentile, or None if there are no values
+    """
+    if not values:
+        return None
+    rank = int(math.ceil(pct / 100.0 * len(values)))
+    return values[max(rank, 1) - 1]
+
+
+def device_runs(events):
+    """ Splits the events into the bootstrap runs of each device.  A run
+    starts at each REGISTERED event, and at each change of device: the id of
+    a deleted device may be given to the next device registered, so the
+    events of a device_id may belong to several devices, one after the other.
+
+    Args:
+        events (iterable): DeviceEvent rows ordered by device_id, created_at
+
+    Yields:
+        list: DeviceEvent rows of a run
+    """
+    for _, dev_events in groupby(events, key=lambda evt: (evt.device_id, evt.os_name, evt.ip_addr)):
+        run = []
+        for evt in dev_events:
+            if run and evt.state == 'REGISTERED':
+                yield run
+                run = []
+            run.append(evt)
+        yield run
+
+
+def phase_durations(events):
+    """ Computes how long each device stayed in each state, and collects the
+    bootstrap phase timings reported with the final status.
+
+    The time spent in a state is the time between its event and the next
+    event of the same run, see device_runs().  The last state of a run, and
+    terminal states, have no duration.  Each run is reported under the last
+    known hw_model of its events, since the hardware model is only learned
+    after the bootstrap has started.
+
+    Args:
+        events (iterable): DeviceEvent rows ordered by device_id, created_at
+
+    Returns:
+        tuple: (state durations, phase timings); dicts of
+        (os_name, hw_model, state or phase) -> list of durations in seconds
+    """
+    durations = defaultdict(list)
+    timings = defaultdict(list)
+
+    for dev_events in device_runs(events):
+        hw_model = None
+        for evt in dev_events:
+            hw_model = evt.hw_model or hw_model
+
+        for evt, next_evt in zip(dev_events, dev_events[1:]):
+            if evt.state in TERMINAL_STATES:
+                continue
+            elapsed = next_evt.created_at - evt.created_at
+            durations[(evt.os_name, hw_model, evt.state)].append(elapsed.total_seconds())
+
+        for evt in dev_events:
+            for phase in json.loads(evt.phases) if evt.phases else []:
+                timings[(evt.os_name, hw_model, phase['phase'])].append(phase['duration'])
+
+    return durations, timings
+
+
+def duration_stats(durations, key=('os_name', 'hw_model', 'state'), pcts=PERCENTILES):
+    """ Summarizes durations into percentiles.
+
+    Args:
+        durations (dict): As returned by phase_durations()
+        key (tuple): Names of the durations key items
+        pcts (tuple): Percentiles to report
+
+    Returns:
+        list: One dict per durations key with the key items, count, max and pNN values
+    """
+    stats = []
+    for values_key, values in sorted(durations.items()):
+        values = sorted(values)
+        item = dict(zip(key, values_key), count=len(values), max=values[-1])
+        for pct in pcts:
+            item['p%d' % pct] = percentile(values, pct)
+        stats.append(item)
+    return stats
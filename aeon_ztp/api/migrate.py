@@ -0,0 +1,123 @@
+# Copyright 2014-present, Apstra, Inc. All rights reserved.
+#
+# This source code is licensed under End User License Agreement found in the
+# LICENSE file at http://www.apstra.com/community/eula
+#
+# In-place schema upgrades for existing Aeon-ZTP databases.  db.create_all()
+# only creates missing tables, so tables created by an older release need to
+# be converted before the application starts using them.  Columns added by a
+# later release are nullable and are simply added to the existing table.
+
+import time
+from datetime import datetime
+
+import sqlalchemy
+
+from aeon_ztp.api.models import BootstrapLock, Device, DeviceEvent
+
+_LEGACY_TIME_FORMATS = ('%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S')
+
+
+def parse_legacy_time(value):
+    """ Converts a legacy ISO-8601 local-time string into a naive UTC datetime.
+
+    Args:
+        value (str): Timestamp as written by older releases, eg: '2017-05-01T10:11:12.123456'
+
+    Returns:
+        datetime: UTC datetime, or the current UTC time if the value cannot be parsed.
+    """
+    for fmt in _LEGACY_TIME_FORMATS:
+        try:
+            local = datetime.strptime(value, fmt)
+        except (TypeError, ValueError):
+            continue
+        utc = datetime.utcfromtimestamp(time.mktime(local.timetuple()))
+        return utc.replace(microsecond=local.microsecond)
+
+    return datetime.utcnow()
+
+
+def needs_upgrade(engine):
+    """ Checks if the 'devices' table was created with the legacy schema
+    (ip_addr primary key, string timestamps, no indexes).
+
+    Args:
+        engine: SQLAlchemy engine bound to the Aeon-ZTP database
+
+    Returns:
+        bool: True if the devices table exists and must be upgraded
+    """
+    insp = sqlalchemy.inspect(engine)
+    if Device.__tablename__ not in insp.get_table_names():
+        return False
+
+    columns = [col['name'] for col in insp.get_columns(Device.__tablename__)]
+    return 'id' not in columns
+
+
+def upgrade_devices_table(engine):
+    """ Upgrades a legacy 'devices' table to the current schema.
+
+    The existing rows are read, the table is re-created with the surrogate
+    key, indexes and DateTime columns, and the rows are written back with
+    their timestamps converted to UTC.  All of this happens in a single
+    transaction, so a failure leaves the legacy table untouched on databases
+    with transactional DDL (eg: PostgreSQL).
+
+    Args:
+        engine: SQLAlchemy engine bound to the Aeon-ZTP database
+
+    Returns:
+        int: Number of rows migrated, or None if no upgrade was required
+    """
+    if not needs_upgrade(engine):
+        return None
+
+    table = Device.__table__
+    legacy = sqlalchemy.Table(table.name, sqlalchemy.MetaData(), autoload=True, autoload_with=engine)
+    keep = set(col.name for col in table.columns) & set(col.name for col in legacy.columns)
+
+    with engine.begin() as conn:
+        rows = []
+        for row in conn.execute(legacy.select()):
+            row = dict((key, value) for key, value in row.items() if key in keep)
+            row['created_at'] = parse_legacy_time(row.get('created_at'))
+            row['updated_at'] = parse_legacy_time(row.get('updated_at'))
+            rows.append(row)
+
+        legacy.drop(conn)
+        table.create(conn)
+        if rows:
+            conn.execute(table.insert(), rows)
+
+    return len(rows)
+
+
+def add_missing_columns(engine, tables=(Device.__table__, DeviceEvent.__table__, BootstrapLock.__table__)):
+    """ Adds the columns of the current schema that an existing table lacks.
+
+    Args:
+        engine: SQLAlchemy engine bound to the Aeon-ZTP database
+        tables (tuple): Tables to check
+
+    Returns:
+        list: 'table.column' names of the added columns
+    """
+    insp = sqlalchemy.inspect(engine)
+    existing_tables = insp.get_table_names()
+    added = []
+
+    with engine.begin() as conn:
+        for table in tables:
+            if table.name not in existing_tables:
+                continue
+            columns = set(col['name'] for col in insp.get_columns(table.name))
+            for col in table.columns:
+                if col.name in columns:
+                    continue
+                conn.execute('ALTER TABLE {} ADD COLUMN {} {}'.format(
+                    table.name, col.name, col.type.compile(dialect=engine.dialect)))
+                added.append('{}.{}'.format(table.name, col.name))
+
+    return added
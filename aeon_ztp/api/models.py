@@ -3,6 +3,8 @@
 # This source code is licensed under End User License Agreement found in the
 # LICENSE file at http://www.apstra.com/community/eula
 
+from datetime import datetime
+
 from aeon_ztp import db, ma
 
 
@@ -10,18 +12,68 @@ class Device(db.Model):
     Schema = None
     __tablename__ = 'devices'
 
-    ip_addr = db.Column(db.String(16), primary_key=True)
+    # a device is identified by the (os_name, ip_addr) pair; the unique
+    # constraint doubles as the composite index used by find_device()
+    __table_args__ = (
+        db.UniqueConstraint('os_name', 'ip_addr', name='uq_devices_os_name_ip_addr'),
+        db.Index('ix_devices_updated_at_id', 'updated_at', 'id'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    ip_addr = db.Column(db.String(16), nullable=False, index=True)
     os_name = db.Column(db.String(16), nullable=False)
-    serial_number = db.Column(db.String(64))
-    hw_model = db.Column(db.String(64))
+    serial_number = db.Column(db.String(64), index=True)
+    hw_model = db.Column(db.String(64), index=True)
     os_version = db.Column(db.String(64))
-    state = db.Column(db.String(64))
+    state = db.Column(db.String(64), index=True)
     message = db.Column(db.String(10000))
-    created_at = db.Column(db.String(64), nullable=False)
-    updated_at = db.Column(db.String(64), nullable=False)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
     facts = db.Column(db.String(2000))
     finally_script = db.Column(db.String(256))
     image_name = db.Column(db.String(256))
+    # JSON name: data of the bootstrap phases completed, see api.client.Checkpoints
+    checkpoints = db.Column(db.Text)
+
+
+class DeviceEvent(db.Model):
+    """ Append-only history of device state transitions, one row per state
+    change.  Rows are kept when the device is deleted so that past runs remain
+    available for the phase duration statistics.  'phases' holds the JSON list
+    of bootstrap phase timings reported with the final status.
+    """
+    __tablename__ = 'device_events'
+
+    __table_args__ = (
+        db.Index('ix_device_events_device_id_created_at', 'device_id', 'created_at'),
+        db.Index('ix_device_events_os_name_created_at', 'os_name', 'created_at'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    device_id = db.Column(db.Integer, nullable=False)
+    ip_addr = db.Column(db.String(16), nullable=False)
+    os_name = db.Column(db.String(16), nullable=False)
+    hw_model = db.Column(db.String(64))
+    state = db.Column(db.String(64), nullable=False)
+    message = db.Column(db.String(10000))
+    phases = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, index=True)
+
+
+class BootstrapLock(db.Model):
+    """ One row per device with a bootstrap in flight, so that the repeated
+    register calls of a device enqueue a single bootstrap.  The lock is
+    released when the bootstrap ends, and lapses at expires_at if the worker
+    running it dies.  token identifies the bootstrap holding the lock, and node
+    the celery worker node running it, once its task has started.
+    """
+    __tablename__ = 'bootstrap_locks'
+
+    ip_addr = db.Column(db.String(16), primary_key=True)
+    os_name = db.Column(db.String(16), nullable=False)
+    token = db.Column(db.String(32), nullable=False)
+    expires_at = db.Column(db.DateTime, nullable=False)
+    node = db.Column(db.String(255))
 
 
 class DeviceSchema(ma.ModelSchema):
@@ -29,4 +81,10 @@ class DeviceSchema(ma.ModelSchema):
         model = Device
 
 
+class DeviceEventSchema(ma.ModelSchema):
+    class Meta:
+        model = DeviceEvent
+
+
 device_schema = DeviceSchema()
+device_event_schema = DeviceEventSchema()
@@ -0,0 +1,375 @@
+# Copyright 2014-present, Apstra, Inc. All rights reserved.
+#
+# This source code is licensed under End User License Agreement found in the
+# LICENSE file at http://www.apstra.com/community/eula
+#
+# Device repository: reads and writes of the device rows, and of the device
+# cache that goes with them.  Shared by the API views and by the celery tasks,
+# which use it to reach the database directly instead of going through the
+# HTTP API of their own server.  Every function takes the SQLAlchemy session
+# to work in; the ones that write commit it.
+
+import json
+import uuid
+from datetime import datetime, timedelta
+
+from sqlalchemy import and_, or_, select, text
+from sqlalchemy.orm.exc import NoResultFound
+
+from aeon_ztp.api.cache import CachedDevice, device_cache, device_values
+from aeon_ztp.api.models import device_schema, BootstrapLock, Device, DeviceEvent
+
+# columns written by the status and facts updates
+STATUS_COLUMNS = ('state', 'message', 'updated_at')
+FACTS_COLUMNS = ('serial_number', 'hw_model', 'os_version', 'facts', 'updated_at',
+                 'image_name', 'finally_script')
+
+# message left on a device that registers again
+_EXISTS_MESSAGE = 'device with os_name, ip_addr already exists'
+
+
+def find_device(db, dev_data):
+    return db.query(Device).filter(Device.os_name == dev_data['os_name'],
+                                   Device.ip_addr == dev_data['ip_addr'])
+
+
+def filter_devices(query, matching):
+    """
+    :param query: Device query
+    :param matching: dictionary of column name:value parings
+    :return: query filtered on all of the matching values
+    """
+    for _filter, value in matching.items():
+        query = query.filter(getattr(Device, _filter) == value)
+    return query
+
+
+def find_devices(db, matching):
+    """
+    :param db: database
+    :param matching: dictionary of column name:value parings
+    :return: filtered query items
+    """
+
+    return filter_devices(db.query(Device), matching).all()
+
+
+def update_device_status(rec, rqst_data):
+    """
+    :param rec: Device to update
+    :param rqst_data: status values: state, message, phases
+    :return: DeviceEvent to add to the session if the state changed or phase timings were given, else None
+    """
+    event = None
+    if rqst_data.get('state'):
+        if rqst_data['state'] != rec.state or rqst_data.get('phases'):
+            event = device_event(rec, rqst_data['state'], rqst_data.get('message'))
+            if rqst_data.get('phases'):
+                event.phases = json.dumps(rqst_data['phases'])
+        rec.state = rqst_data['state']
+
+    rec.message = rqst_data.get('message')
+    rec.updated_at = time_now()
+    return event
+
+
+def device_event(rec, state, message):
+    """
+    :param rec: Device entering the state, must have been flushed so its id is set
+    :param state: new state
+    :param message: status message
+    :return: DeviceEvent recording the state transition
+    """
+    return DeviceEvent(device_id=rec.id, ip_addr=rec.ip_addr, os_name=rec.os_name,
+                       hw_model=rec.hw_model, state=state, message=message,
+                       created_at=time_now())
+
+
+def update_device_facts(rec, rqst_data):
+    """
+    :param rec: Device to update
+    :param rqst_data: facts values: serial_number, hw_model, os_version, facts, image_name, finally_script
+    """
+    rec.serial_number = rqst_data.get('serial_number')
+    rec.hw_model = rqst_data.get('hw_model')
+    rec.os_version = rqst_data.get('os_version')
+    rec.facts = rqst_data.get('facts')
+    rec.updated_at = time_now()
+    rec.image_name = rqst_data.get('image_name')
+    rec.finally_script = rqst_data.get('finally_script')
+
+
+def update_device_checkpoint(rec, rqst_data):
+    """
+    :param rec: Device to update
+    :param rqst_data: checkpoint values: checkpoint, the name of the completed
+        bootstrap phase, or None to clear the checkpoints, and its data
+    """
+    checkpoints = {}
+    if rqst_data.get('checkpoint'):
+        if rec.checkpoints:
+            checkpoints = json.loads(rec.checkpoints)
+        checkpoints[rqst_data['checkpoint']] = rqst_data.get('data')
+    rec.checkpoints = json.dumps(checkpoints) if checkpoints else None
+    rec.updated_at = time_now()
+
+
+def upsert_device(db, rec):
+    """
+    Registers a device with a single atomic statement: the device is inserted,
+    or if a device with the same os_name and ip_addr already exists its message
+    and updated_at are touched.  Two concurrent registrations of the same
+    device can therefore never both see it as new.  The caller commits.
+
+    :param db: database
+    :param rec: transient Device holding the registration values
+    :return: (id, state, created) of the device row; created is True if the row was inserted
+    """
+    table = Device.__table__
+    values = dict((col.name, getattr(rec, col.name)) for col in table.columns
+                  if col.name != 'id' and getattr(rec, col.name) is not None)
+    columns = sorted(values)
+    insert = 'INTO devices ({}) VALUES ({})'.format(
+        ', '.join(columns), ', '.join(':' + col for col in columns))
+
+    if db.bind.dialect.name == 'postgresql':
+        upsert = ('INSERT {} ON CONFLICT (os_name, ip_addr) DO UPDATE'
+                  ' SET message = :exists_message, updated_at = EXCLUDED.updated_at'
+                  ' RETURNING id, state, (xmax = 0) AS created').format(insert)
+        row = db.execute(text(upsert), dict(values, exists_message=_EXISTS_MESSAGE)).first()
+        return row.id, row.state, row.created
+
+    # SQLite: the INSERT takes the database write lock, so the UPDATE and
+    # SELECT that follow it in the same transaction see the row it conflicted with
+    result = db.execute(text('INSERT OR IGNORE ' + insert), values)
+    if result.rowcount == 1:
+        return result.lastrowid, values.get('state'), True
+
+    match = and_(table.c.os_name == rec.os_name, table.c.ip_addr == rec.ip_addr)
+    db.execute(table.update().where(match).values(message=_EXISTS_MESSAGE, updated_at=rec.updated_at))
+    row = db.execute(select([table.c.id, table.c.state]).where(match)).first()
+    return row.id, row.state, False
+
+
+def save_cached_device(db, cached, version, columns):
+    """
+    :param db: database
+    :param cached: CachedDevice holding the new values
+    :param version: updated_at value of the record when it was cached
+    :param columns: names of the columns to write
+    :return: True if the row was updated, False if it changed since it was cached
+    """
+    table = Device.__table__
+    result = db.execute(
+        table.update()
+        .where(and_(table.c.id == cached.id, table.c.updated_at == version))
+        .values(dict((col, getattr(cached, col)) for col in columns)))
+    return result.rowcount == 1
+
+
+def write_device(db, rqst_data, update, columns):
+    """
+    Applies update(rec, rqst_data) to the device named by the os_name and
+    ip_addr of rqst_data, along with the DeviceEvent it returns, and commits.
+
+    A cached record is written by id without reading the row first; if the
+    row changed since it was cached the update is retried from the database.
+
+    :param db: database
+    :param rqst_data: request values
+    :param update: update_device_status or update_device_facts
+    :param columns: names of the columns the update changes
+    :return: True, or False if the device does not exist
+    """
+    os_name, ip_addr = rqst_data.get('os_name'), rqst_data.get('ip_addr')
+
+    cached = device_cache.get(os_name, ip_addr, for_update=True)
+    if cached is not None:
+        version = cached.updated_at
+        event = update(cached, rqst_data)
+        if save_cached_device(db, cached, version, columns):
+            if event:
+                db.add(event)
+            db.commit()
+            device_cache.written(cached.values())
+            return True
+
+        db.rollback()
+        device_cache.invalidate(os_name, ip_addr)
+
+    try:
+        rec = find_device(db, rqst_data).one()
+    except NoResultFound:
+        return False
+
+    event = update(rec, rqst_data)
+    if event:
+        db.add(event)
+    values = device_values(rec)
+    db.commit()
+    device_cache.written(values)
+    return True
+
+
+def time_now():
+    return datetime.utcnow()
+
+
+def device_states(db):
+    """
+    :param db: database
+    :return: list of (os_name, ip_addr, state) of all of the devices
+    """
+    return [tuple(row) for row in db.query(Device.os_name, Device.ip_addr, Device.state)]
+
+
+def locked_device_states(db, updated_since=None):
+    """
+    :param db: database
+    :param updated_since: datetime, only the devices updated since then
+    :return: list of (os_name, ip_addr, state) of the devices with a bootstrap
+        lock, see BootstrapLock
+    """
+    query = db.query(Device.os_name, Device.ip_addr, Device.state).join(
+        BootstrapLock, and_(BootstrapLock.ip_addr == Device.ip_addr, BootstrapLock.os_name == Device.os_name))
+    if updated_since is not None:
+        query = query.filter(Device.updated_at >= updated_since)
+    return [tuple(row) for row in query.order_by(Device.id)]
+
+
+def get_device_item(db, os_name, ip_addr):
+    """
+    :param db: database
+    :param os_name: device os_name
+    :param ip_addr: device ip_addr
+    :return: the device as an item of GET /api/devices, read from the device
+        cache when it has a current copy, or None if the device does not exist
+    """
+    cached = device_cache.get(os_name, ip_addr)
+    if cached is None:
+        version = device_cache.version(os_name, ip_addr)
+        rec = find_device(db, dict(os_name=os_name, ip_addr=ip_addr)).first()
+        if rec is None:
+            return None
+        cached = CachedDevice(device_values(rec))
+        device_cache.put(cached.values(), version)
+    return device_schema.dump(cached).data
+
+
+def register_device(db, device_data):
+    """
+    Adds a device, or touches it if it already exists, see upsert_device(),
+    and commits.
+
+    :param db: database
+    :param device_data: Device column values, must include os_name and ip_addr
+    :return: (state, created) of the device; created is True if it was added
+    """
+    rec = Device(created_at=time_now(),
+                 updated_at=time_now(),
+                 **device_data)
+    try:
+        rec.id, state, created = upsert_device(db, rec)
+        if created and rec.state:
+            db.add(device_event(rec, rec.state, rec.message))
+        values = device_values(rec)
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+
+    if created:
+        device_cache.written(values)
+    else:
+        device_cache.invalidate(rec.os_name, rec.ip_addr)
+    return state, created
+
+
+def set_device_status(db, os_name, ip_addr, state=None, message=None):
+    """
+    :return: True, or False if the device does not exist
+    """
+    return write_device(db, dict(os_name=os_name, ip_addr=ip_addr, state=state, message=message),
+                        update_device_status, STATUS_COLUMNS)
+
+
+def lock_values(ip_addr, os_name, ttl, node=None):
+    return dict(ip_addr=ip_addr, os_name=os_name, token=uuid.uuid4().hex,
+                expires_at=time_now() + timedelta(seconds=ttl), node=node)
+
+
+def acquire_bootstrap_lock(db, ip_addr, os_name, ttl):
+    """
+    Takes the bootstrap lock of a device, see BootstrapLock, and commits.
+    The lock is taken with single atomic statements, so of several concurrent
+    callers only one gets it.
+
+    :param db: database
+    :param ip_addr: device ip_addr
+    :param os_name: device os_name
+    :param ttl: seconds after which the lock lapses
+    :return: token of the lock, or None if a bootstrap of the device holds it
+    """
+    values = lock_values(ip_addr, os_name, ttl)
+    insert = 'INTO bootstrap_locks (ip_addr, os_name, token, expires_at, node)' \
+             ' VALUES (:ip_addr, :os_name, :token, :expires_at, :node)'
+
+    if db.bind.dialect.name == 'postgresql':
+        statement = 'INSERT {} ON CONFLICT (ip_addr) DO NOTHING'.format(insert)
+    else:
+        statement = 'INSERT OR IGNORE ' + insert
+
+    acquired = db.execute(text(statement), values).rowcount == 1
+    if not acquired:
+        table = BootstrapLock.__table__
+        match = and_(table.c.ip_addr == ip_addr, table.c.expires_at <= time_now())
+        acquired = db.execute(table.update().where(match).values(values)).rowcount == 1
+
+    db.commit()
+    return values['token'] if acquired else None
+
+
+def take_over_bootstrap_lock(db, ip_addr, os_name, ttl, node):
+    """
+    Takes over the existing bootstrap lock of a device, if it has lapsed or is
+    held by node, eg: to resume the bootstrap interrupted by a restart of that
+    node, and commits.  A device without a lock has no bootstrap to resume.
+
+    :param db: database
+    :param ip_addr: device ip_addr
+    :param os_name: device os_name
+    :param ttl: seconds after which the lock lapses
+    :param node: celery worker node taking the lock
+    :return: token of the lock, or None if the device has no lock or a
+             bootstrap running elsewhere holds it
+    """
+    table = BootstrapLock.__table__
+    values = lock_values(ip_addr, os_name, ttl, node=node)
+    held = table.c.expires_at <= time_now()
+    if node:
+        held = or_(held, table.c.node == node)
+    match = and_(table.c.ip_addr == ip_addr, table.c.os_name == os_name, held)
+    acquired = db.execute(table.update().where(match).values(values)).rowcount == 1
+
+    db.commit()
+    return values['token'] if acquired else None
+
+
+def claim_bootstrap_lock(db, ip_addr, token, node):
+    """
+    Records the celery worker node running the bootstrap that holds the lock
+    of a device with the token, and commits.
+    """
+    table = BootstrapLock.__table__
+    db.execute(table.update().where(and_(table.c.ip_addr == ip_addr, table.c.token == token)).values(node=node))
+    db.commit()
+
+
+def release_bootstrap_lock(db, ip_addr, token):
+    """
+    Releases the bootstrap lock of a device, if it is still held with the
+    token, and commits.
+    """
+    table = BootstrapLock.__table__
+    db.execute(table.delete().where(and_(table.c.ip_addr == ip_addr, table.c.token == token)))
+    db.commit()
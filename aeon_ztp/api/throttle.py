@@ -0,0 +1,88 @@
+# Copyright 2014-present, Apstra, Inc. All rights reserved.
+#
+# This source code is licensed under End User License Agreement found in the
+# LICENSE file at http://www.apstra.com/community/eula
+#
+# Aggregate bandwidth budget of the image downloads.
+#
+# Every chunk of every image sent by any of the server processes books its
+# share of the budget on a single timeline: the time at which the budget is
+# next free, kept in a small memory mapped file.  A chunk is sent once its
+# booked time comes, so the downloads together never go faster than the
+# budget, however many of them there are, and share it evenly.
+
+import fcntl
+import mmap
+import os
+import struct
+import threading
+import time
+
+_AEON_TRANSFER_FILE = os.getenv('AEON_TRANSFER_FILE')
+_AEON_TRANSFER_RATE_MBPS = float(os.getenv('AEON_TRANSFER_RATE_MBPS', 0))
+
+_NEXT_FREE = struct.Struct('=d')
+
+# the budget does not carry over more than this many seconds of idle time
+_MAX_BURST = 0.25
+
+
+class RateLimiter(object):
+    """ Bandwidth budget shared by the server processes.
+
+    Attributes:
+        rate (float): Bytes per second, 0 for no limit
+        fpath (str): File backing the timeline, or None for an anonymous
+                     mapping shared only with forked processes
+    """
+    def __init__(self, rate, fpath=None):
+        self.rate = rate
+        self.fpath = fpath
+        self._lock = threading.Lock()
+        self._fd = None
+
+        if fpath:
+            self._fd = os.open(fpath, os.O_RDWR | os.O_CREAT, 0o664)
+            if os.fstat(self._fd).st_size < _NEXT_FREE.size:
+                os.ftruncate(self._fd, _NEXT_FREE.size)
+            self._map = mmap.mmap(self._fd, _NEXT_FREE.size)
+        else:
+            self._map = mmap.mmap(-1, _NEXT_FREE.size)
+
+    def reserve(self, nbytes):
+        """ Books the sending of nbytes.
+
+        Returns:
+            float: seconds to wait before sending them
+        """
+        if not self.rate:
+            return 0
+
+        with self._lock:
+            if self._fd is not None:
+                fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                now = time.time()
+                start = max(_NEXT_FREE.unpack_from(self._map, 0)[0], now - _MAX_BURST)
+                _NEXT_FREE.pack_into(self._map, 0, start + nbytes / float(self.rate))
+            finally:
+                if self._fd is not None:
+                    fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+        return max(0, start - now)
+
+    def stream(self, fpath, chunk_size=64 * 1024):
+        """ Yields the content of a file, no faster than the budget allows.
+        """
+        with open(fpath, 'rb') as f:
+            while True:
+                chunk = f.read(chunk_size)
+                if not chunk:
+                    return
+                delay = self.reserve(len(chunk))
+                if delay:
+                    time.sleep(delay)
+                yield chunk
+
+
+image_limiter = RateLimiter(_AEON_TRANSFER_RATE_MBPS * 1000000 / 8, _AEON_TRANSFER_FILE)
@@ -5,24 +5,97 @@
 # LICENSE file at http://www.apstra.com/community/eula
 
 
+import base64
+import mimetypes
 import os
-from datetime import datetime
+import time
+from datetime import datetime, timedelta
 from os import path
 
 import aeon_ztp
 import pkg_resources
 
-from flask import Blueprint, request, jsonify
-from flask import send_from_directory
-from sqlalchemy.orm.exc import NoResultFound
-
-from models import device_schema, Device
-from aeon_ztp import ztp_celery
+from flask import Blueprint, Response, g, request, jsonify, json
+from flask import safe_join, send_from_directory, stream_with_context
+from flask_sqlalchemy import SignallingSession
+from sqlalchemy import and_, event, func, or_
+from sqlalchemy.orm import load_only
+
+from models import device_schema, device_event_schema, Device, DeviceEvent, DeviceSchema
+from aeon_ztp import ztp_celery, ztp_logging, ztp_os_selector
+from aeon_ztp.api import changes, events
+from aeon_ztp.api.cache import device_cache, device_values
+from aeon_ztp.api.repository import FACTS_COLUMNS, STATUS_COLUMNS, filter_devices, find_devices, register_device, \
+    update_device_checkpoint, update_device_facts, update_device_status, write_device
+from aeon_ztp.api.throttle import image_limiter
+from aeon_ztp.ztp_metrics import metrics, exposition
 
 api = Blueprint('api', __name__)
 
 _AEON_TOPDIR = os.getenv('AEON_TOPDIR')
 
+# GET /api/devices arguments that are not device column filters
+_PAGING_ARGS = ('limit', 'cursor', 'fields', 'updated_since')
+_DEFAULT_PAGE_LIMIT = 100
+_MAX_PAGE_LIMIT = 1000
+
+# GET /api/devices streams newline delimited JSON when the client asks for it
+_NDJSON_MIMETYPE = 'application/x-ndjson'
+_DEVICE_MIMETYPES = ['application/json', _NDJSON_MIMETYPE]
+_STREAM_BATCH_SIZE = 500
+
+# GET /api/devices/changes long-poll settings, in seconds.  Changes written by
+# another server process are picked up by re-checking the database every
+# _CHANGES_POLL_INTERVAL seconds.
+_CHANGES_ARGS = ('since', 'timeout', 'fields')
+_CHANGES_TIMEOUT = 25
+_CHANGES_MAX_TIMEOUT = 60
+_CHANGES_POLL_INTERVAL = 2
+
+# updated_at is stamped before the commit, so a device can be committed after
+# the cursor has moved past its updated_at; the feed returns again the devices
+# stamped up to _CHANGES_OVERLAP seconds before the cursor, and the clients
+# skip the ones they already have by id and updated_at.
+_CHANGES_OVERLAP = 5
+
+# cursor returned when there are no devices, sorts before any device row
+_EPOCH = datetime(1970, 1, 1)
+
+
+# -----------------------------------------------------------------------------
+#                                 Instrumentation
+# -----------------------------------------------------------------------------
+
+@api.before_request
+def _start_request_timer():
+    g.request_started = time.time()
+
+
+@api.after_request
+def _record_request_metrics(response):
+    endpoint = request.url_rule.rule if request.url_rule else 'unmatched'
+    labels = dict(endpoint=endpoint, method=request.method, status=str(response.status_code))
+    metrics.inc('aeon_ztp_http_requests_total', labels)
+    metrics.observe('aeon_ztp_http_request_duration_seconds',
+                    time.time() - g.request_started, labels)
+
+    if request.endpoint in ('api.get_vendor_file', 'api.download_file') and response.content_length:
+        metrics.inc('aeon_ztp_image_bytes_served_total', dict(endpoint=endpoint),
+                    value=response.content_length)
+    return response
+
+
+@event.listens_for(SignallingSession, 'before_commit')
+def _start_commit_timer(session):
+    session.info['commit_started'] = time.time()
+
+
+@event.listens_for(SignallingSession, 'after_commit')
+def _record_commit_metrics(session):
+    started = session.info.pop('commit_started', None)
+    if started is not None:
+        metrics.observe('aeon_ztp_db_commit_duration_seconds', time.time() - started)
+
 
 @api.route('/downloads/<path:filename>', methods=['GET'])
 def download_file(filename):
@@ -33,7 +106,18 @@ def download_file(filename):
 @api.route('/images/<path:filename>', methods=['GET'])
 def get_vendor_file(filename):
     from_dir = path.join(_AEON_TOPDIR, 'vendor_images')
-    return send_from_directory(from_dir, filename)
+    if not image_limiter.rate:
+        return send_from_directory(from_dir, filename)
+
+    # sent within the image bandwidth budget, AEON_TRANSFER_RATE_MBPS
+    fpath = safe_join(from_dir, filename)
+    if not path.isfile(fpath):
+        return jsonify(ok=False, message='Not Found: %s' % filename), 404
+
+    return Response(image_limiter.stream(fpath),
+                    mimetype=mimetypes.guess_type(fpath)[0] or 'application/octet-stream',
+                    headers={'Content-Length': str(path.getsize(fpath))},
+                    direct_passthrough=True)
 
 
 @api.route('/api/about')
@@ -51,7 +135,7 @@ def nxos_bootconf(os_name):
 @api.route('/api/register/<os_name>', methods=['GET', 'POST'])
 def nxos_register(os_name):
     from_ipaddr = request.args.get('ipaddr') or request.remote_addr
-    ztp_celery.ztp_bootstrapper.delay(os_name=os_name, target=from_ipaddr)
+    ztp_celery.enqueue_bootstrap(os_name, from_ipaddr)
     return ""
 
 
@@ -62,6 +146,26 @@ def api_finalizer(os_name):
     return "OK"
 
 
+@api.route('/api/metrics')
+def api_metrics():
+    """
+    Prometheus text exposition of the API, database and celery metrics.
+    """
+    db = aeon_ztp.db.session
+    entries = metrics.collect()
+
+    in_flight = db.query(Device.os_name, func.count(Device.id)) \
+        .filter(~Device.state.in_(events.TERMINAL_STATES)) \
+        .group_by(Device.os_name)
+    for os_name, count in in_flight:
+        entries.append(['aeon_ztp_bootstraps_in_flight', dict(os_name=os_name), count])
+
+    for queue, depth in ztp_celery.queue_depths():
+        entries.append(['aeon_ztp_celery_queue_depth', dict(queue=queue), depth])
+
+    return Response(exposition(entries), mimetype='text/plain; version=0.0.4')
+
+
 @api.route('/api/env')
 def api_env():
     my_env = os.environ.copy()
@@ -74,27 +178,114 @@ def api_env():
 # -----------------------------------------------------------------------------
 
 
-def find_device(db, dev_data):
-    return db.query(Device).filter(Device.os_name == dev_data['os_name'],
-                                   Device.ip_addr == dev_data['ip_addr'])
+def parse_time(value):
+    """
+    :param value: ISO-8601 UTC timestamp, as returned in the device items
+    :return: naive UTC datetime
+    :raises ValueError: if the value is not a valid timestamp
+    """
+    value = value.strip().replace(' ', 'T')
+    for suffix in ('Z', '+00:00'):
+        if value.endswith(suffix):
+            value = value[:-len(suffix)]
+
+    for fmt in ('%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S', '%Y-%m-%d'):
+        try:
+            return datetime.strptime(value, fmt)
+        except ValueError:
+            pass
+
+    raise ValueError('invalid timestamp: %s' % value)
+
+
+def encode_cursor(rec):
+    """
+    :param rec: last Device of a page
+    :return: opaque keyset cursor for the rows after rec
+    """
+    return encode_key(rec.updated_at, rec.id)
+
+
+def encode_key(updated_at, dev_id):
+    """
+    :param updated_at: keyset updated_at value
+    :param dev_id: keyset id value
+    :return: opaque keyset cursor for the rows after (updated_at, dev_id)
+    """
+    key = '%s|%d' % (updated_at.isoformat(), dev_id)
+    return base64.urlsafe_b64encode(key)
+
 
+def decode_cursor(cursor):
+    """
+    :param cursor: value previously returned by encode_cursor
+    :return: tuple of (updated_at, id)
+    :raises ValueError: if the cursor cannot be decoded
+    """
+    try:
+        updated_at, dev_id = base64.urlsafe_b64decode(str(cursor)).split('|')
+        return parse_time(updated_at), int(dev_id)
+    except (TypeError, ValueError):
+        raise ValueError('invalid cursor: %s' % cursor)
 
-def find_devices(db, matching):
+
+def after_cursor(query, cursor):
+    """
+    :param query: Device query
+    :param cursor: value previously returned by encode_cursor
+    :return: query filtered on the rows after the cursor, in keyset order
+    :raises ValueError: if the cursor cannot be decoded
+    """
+    updated_at, dev_id = decode_cursor(cursor)
+    return query.filter(or_(
+        Device.updated_at > updated_at,
+        and_(Device.updated_at == updated_at, Device.id > dev_id)))
+
+
+def overlap_cursor(query, cursor, seconds):
+    """
+    :param query: Device query
+    :param cursor: value previously returned by encode_cursor
+    :param seconds: length of the overlap
+    :return: query filtered on the rows before the cursor, updated at most
+        seconds before it, in keyset order
+    :raises ValueError: if the cursor cannot be decoded
+    """
+    updated_at, dev_id = decode_cursor(cursor)
+    return query.filter(
+        Device.updated_at >= updated_at - timedelta(seconds=seconds),
+        or_(Device.updated_at < updated_at,
+            and_(Device.updated_at == updated_at, Device.id < dev_id)))
+
+
+def device_head_cursor(db, matching=None):
     """
     :param db: database
     :param matching: dictionary of column name:value parings
-    :return: filtered query items
+    :return: cursor positioned after the most recently updated matching device
     """
+    query = filter_devices(db.query(Device.updated_at, Device.id), matching or {})
+    head = query.order_by(Device.updated_at.desc(), Device.id.desc()).first()
+    return encode_key(*head) if head else encode_key(_EPOCH, 0)
 
-    query = db.query(Device)
-    for _filter, value in matching.items():
-        query = query.filter(getattr(Device, _filter) == value)
-    return query.all()
 
+def device_projection(fields):
+    """
+    :param fields: comma separated list of Device column names, or None for all columns
+    :return: tuple of (schema, columns) used to load and dump only the requested columns
+    :raises ValueError: if any of the fields is not a Device column
+    """
+    if not fields:
+        return device_schema, None
+
+    columns = [field.strip() for field in fields.split(',') if field.strip()]
+    invalid = [col for col in columns if col not in Device.__table__.columns]
+    if invalid or not columns:
+        raise ValueError('invalid fields: %s' % ','.join(invalid))
 
-def time_now():
-    now = datetime.now()
-    return datetime.isoformat(now)
+    # the keyset columns are always loaded so the next cursor can be computed
+    load = set(columns) | set(['id', 'updated_at'])
+    return DeviceSchema(only=columns), [getattr(Device, col) for col in load]
 
 
 # -----------------------------------------------------------------------------
@@ -112,32 +303,154 @@ def time_now():
 @api.route('/api/devices', methods=['GET'])
 def _get_devices():
     db = aeon_ztp.db.session
-    to_json = device_schema
 
     # ---------------------------------------------------------------
-    # if the request has arguments, use these to form an "and" filter
-    # and return only the subset of items matching
+    # paging arguments are handled here, any remaining arguments are
+    # used to form an "and" filter on the device columns
     # ---------------------------------------------------------------
 
-    if request.args:
-        try:
-            recs = find_devices(db, request.args.to_dict())
-            if len(recs) == 0:
-                return jsonify(ok=False,
-                               message='Not Found: %s' % request.query_string), 404
+    matching = request.args.to_dict()
+    paging = dict((arg, matching.pop(arg)) for arg in _PAGING_ARGS if arg in matching)
+    ndjson = request.accept_mimetypes.best_match(_DEVICE_MIMETYPES) == _NDJSON_MIMETYPE
+
+    # ---------------------------------------------------------------
+    # a lookup of a single device, eg: the celery state checks, is
+    # answered from the device cache when it has a current copy
+    # ---------------------------------------------------------------
 
-            items = [to_json.dump(rec).data for rec in recs]
-            return jsonify(count=len(items), items=items)
+    cache_version = None
+    if set(matching) == set(['os_name', 'ip_addr']) and not paging and not ndjson:
+        cached = device_cache.get(matching['os_name'], matching['ip_addr'])
+        if cached is not None:
+            return jsonify(count=1, items=[device_schema.dump(cached).data])
+        cache_version = device_cache.version(matching['os_name'], matching['ip_addr'])
 
-        except AttributeError:
-            return jsonify(ok=False, message='invalid arguments'), 500
+    try:
+        to_json, columns = device_projection(paging.get('fields'))
+        query = filter_devices(db.query(Device), matching)
+        if columns:
+            query = query.options(load_only(*columns))
 
-    # -------------------------------------------
-    # otherwise, return all items in the database
-    # -------------------------------------------
+        if 'updated_since' in paging:
+            query = query.filter(Device.updated_at > parse_time(paging['updated_since']))
 
-    items = [to_json.dump(rec).data for rec in db.query(Device).all()]
-    return jsonify(count=len(items), items=items)
+        limit = None
+        if 'limit' in paging or 'cursor' in paging:
+            limit = int(paging.get('limit', _DEFAULT_PAGE_LIMIT))
+            if not 0 < limit <= _MAX_PAGE_LIMIT:
+                raise ValueError('limit must be between 1 and %d' % _MAX_PAGE_LIMIT)
+
+            if 'cursor' in paging:
+                query = after_cursor(query, paging['cursor'])
+
+            query = query.order_by(Device.updated_at, Device.id)
+
+    except ValueError as exc:
+        return jsonify(ok=False, message=str(exc)), 400
+
+    except AttributeError:
+        return jsonify(ok=False, message='invalid arguments'), 500
+
+    # ---------------------------------------------------------------
+    # streaming export: one JSON document per device per line, read
+    # from the database in batches so memory use stays flat
+    # ---------------------------------------------------------------
+
+    if ndjson:
+        if limit:
+            query = query.limit(limit)
+
+        def generate():
+            for rec in query.yield_per(_STREAM_BATCH_SIZE):
+                yield json.dumps(to_json.dump(rec).data) + '\n'
+
+        return Response(stream_with_context(generate()), mimetype=_NDJSON_MIMETYPE)
+
+    recs = query.all() if limit is None else query.limit(limit + 1).all()
+
+    # a plain column filter keeps reporting unmatched queries as not found;
+    # an empty page or an empty change set is a valid result
+
+    if matching and not paging and len(recs) == 0:
+        return jsonify(ok=False,
+                       message='Not Found: %s' % request.query_string), 404
+
+    if cache_version is not None:
+        device_cache.put(device_values(recs[0]), cache_version)
+
+    if limit is None:
+        items = to_json.dump(recs, many=True).data
+        return jsonify(count=len(items), items=items)
+
+    next_cursor = encode_cursor(recs[limit - 1]) if len(recs) > limit else None
+    items = to_json.dump(recs[:limit], many=True).data
+    return jsonify(count=len(items), items=items, next_cursor=next_cursor)
+
+
+# -----------------------------------------------------------------------------
+#                                 GET /api/devices/changes
+# -----------------------------------------------------------------------------
+
+@api.route('/api/devices/changes', methods=['GET'])
+def _get_device_changes():
+    """
+    Long-poll change feed.  Returns the devices updated after the 'since'
+    cursor, waiting up to 'timeout' seconds for a change when there are none
+    yet.  The returned cursor is passed as 'since' on the next request.
+    Without 'since' the current head cursor is returned immediately.
+
+    The devices updated up to _CHANGES_OVERLAP seconds before the 'since'
+    cursor are returned first, those committed late would be missed
+    otherwise; a client skips the devices whose id and updated_at it has
+    already seen.
+
+    Any other arguments filter the devices the same way as GET /api/devices.
+    'total' is the number of matching devices, so a client can tell when
+    devices were added or deleted.
+    """
+    db = aeon_ztp.db.session
+
+    matching = request.args.to_dict()
+    args = dict((arg, matching.pop(arg)) for arg in _CHANGES_ARGS if arg in matching)
+
+    try:
+        to_json, columns = device_projection(args.get('fields'))
+        timeout = min(float(args.get('timeout', _CHANGES_TIMEOUT)), _CHANGES_MAX_TIMEOUT)
+        query = filter_devices(db.query(Device), matching)
+
+        if 'since' not in args:
+            return jsonify(count=0, items=[], cursor=device_head_cursor(db, matching),
+                           total=query.count())
+
+        changed = after_cursor(query, args['since'])
+        overlap = overlap_cursor(query, args['since'], _CHANGES_OVERLAP)
+        if columns:
+            changed = changed.options(load_only(*columns))
+            overlap = overlap.options(load_only(*columns))
+        changed = changed.order_by(Device.updated_at, Device.id).limit(_MAX_PAGE_LIMIT)
+        overlap = overlap.order_by(Device.updated_at, Device.id).limit(_MAX_PAGE_LIMIT)
+
+    except ValueError as exc:
+        return jsonify(ok=False, message=str(exc)), 400
+
+    except AttributeError:
+        return jsonify(ok=False, message='invalid arguments'), 500
+
+    deadline = time.time() + timeout
+    while True:
+        version = changes.notifier.version
+        recs = changed.all()
+        remaining = deadline - time.time()
+        if recs or remaining <= 0:
+            break
+
+        # end the read transaction so the next query sees new commits
+        db.rollback()
+        changes.notifier.wait(version, min(remaining, _CHANGES_POLL_INTERVAL))
+
+    cursor = encode_cursor(recs[-1]) if recs else args['since']
+    items = to_json.dump(overlap.all() + recs, many=True).data
+    return jsonify(count=len(items), items=items, cursor=cursor, total=query.count())
 
 
 # -----------------------------------------------------------------------------
@@ -155,32 +468,12 @@ def _create_device():
             ok=False, message="Error: rqst-body missing os_name, ip_addr values",
             rqst_data=device_data), 400
 
-    # ----------------------------------------------------------
-    # check to see if the device already exists
-    # ----------------------------------------------------------
-
-    try:
-        rec = find_device(db, device_data).one()
-        rec.updated_at = time_now()
-        rec.message = 'device with os_name, ip_addr already exists'
-        db.commit()
-
-        return jsonify(
-            ok=True, message='device already exists',
-            data=device_data)
-
-    except NoResultFound:
-        pass
-
-    # ---------------------------------------------
-    # now try to add the new device to the database
-    # ---------------------------------------------
+    # ---------------------------------------------------------------
+    # add the device, or touch it if it already exists, in one step
+    # ---------------------------------------------------------------
 
     try:
-        db.add(Device(created_at=time_now(),
-                     updated_at=time_now(),
-                     **device_data))
-        db.commit()
+        state, created = register_device(db, device_data)
 
     except Exception as exc:
         return jsonify(
@@ -189,8 +482,11 @@ def _create_device():
             message=exc.message,
             rqst_data=device_data), 500
 
+    changes.notifier.notify()
+
     return jsonify(
-        ok=True, message='device added',
+        ok=True, message='device added' if created else 'device already exists',
+        created=created, state=state,
         data=device_data)
 
 
@@ -204,21 +500,12 @@ def _put_device_status():
 
     db = aeon_ztp.db.session
 
-    try:
-        rec = find_device(db, rqst_data).one()
-
-        if rqst_data['state']:
-            rec.state = rqst_data['state']
-
-        rec.message = rqst_data.get('message')
-        rec.updated_at = time_now()
-        db.commit()
-
-    except NoResultFound:
+    if not write_device(db, rqst_data, update_device_status, STATUS_COLUMNS):
         return jsonify(
             ok=False, message='Not Found',
             item=rqst_data), 400
 
+    changes.notifier.notify()
     return jsonify(ok=True)
 
 # -----------------------------------------------------------------------------
@@ -232,26 +519,212 @@ def _put_device_facts():
 
     db = aeon_ztp.db.session
 
-    try:
-        rec = find_device(db, rqst_data).one()
-        rec.serial_number = rqst_data.get('serial_number')
-        rec.hw_model = rqst_data.get('hw_model')
-        rec.os_version = rqst_data.get('os_version')
-        rec.facts = rqst_data.get('facts')
-        rec.updated_at = time_now()
-        rec.image_name = rqst_data.get('image_name')
-        rec.finally_script = rqst_data.get('finally_script')
-
-        db.commit()
-
-    except NoResultFound:
+    if not write_device(db, rqst_data, update_device_facts, FACTS_COLUMNS):
         return jsonify(
             ok=False, message='Not Found',
             item=rqst_data), 404
 
+    changes.notifier.notify()
     return jsonify(ok=True)
 
 
+# -----------------------------------------------------------------------------
+#                  PUT: /api/devices/batch
+# -----------------------------------------------------------------------------
+
+@api.route('/api/devices/batch', methods=['PUT'])
+def _put_device_batch():
+    """
+    Applies many facts, checkpoint and status updates in a single
+    transaction.  The request body is {"facts": [...], "checkpoints": [...],
+    "status": [...]}, where facts and status items have the same content as
+    the body of PUT /api/devices/facts or PUT /api/devices/status, and
+    checkpoint items are {"os_name", "ip_addr", "checkpoint", "data"}.  Facts
+    are applied first, then checkpoints, then status updates, each list in
+    the order given.
+    """
+    rqst_data = request.get_json(silent=True)
+    if not isinstance(rqst_data, dict):
+        return jsonify(ok=False, message='Error: rqst-body must be a JSON object'), 400
+
+    updates = [(update_device_facts, item) for item in rqst_data.get('facts') or []]
+    updates += [(update_device_checkpoint, item) for item in rqst_data.get('checkpoints') or []]
+    updates += [(update_device_status, item) for item in rqst_data.get('status') or []]
+
+    if not all(isinstance(item, dict) and 'os_name' in item and 'ip_addr' in item
+               for _, item in updates):
+        return jsonify(
+            ok=False, message='Error: rqst-body items missing os_name, ip_addr values'), 400
+
+    db = aeon_ztp.db.session
+
+    # one query for all of the devices named in the batch
+
+    ip_addrs = set(item['ip_addr'] for _, item in updates)
+    recs = {}
+    if ip_addrs:
+        for rec in db.query(Device).filter(Device.ip_addr.in_(ip_addrs)):
+            recs[(rec.os_name, rec.ip_addr)] = rec
+
+    not_found = []
+    updated = set()
+    for update, item in updates:
+        key = (item['os_name'], item['ip_addr'])
+        rec = recs.get(key)
+        if rec is None:
+            not_found.append(dict(os_name=item['os_name'], ip_addr=item['ip_addr']))
+            continue
+        event = update(rec, item)
+        if event:
+            db.add(event)
+        updated.add(key)
+
+    written = [device_values(recs[dev_key]) for dev_key in updated]
+
+    try:
+        db.commit()
+
+    except Exception as exc:
+        db.rollback()
+        return jsonify(
+            ok=False,
+            error_type=str(type(exc)),
+            message=exc.message), 500
+
+    for values in written:
+        device_cache.written(values)
+    changes.notifier.notify()
+    return jsonify(ok=True, count=len(updates) - len(not_found), not_found=not_found)
+
+
+# -----------------------------------------------------------------------------
+#                  GET: /api/devices/events
+# -----------------------------------------------------------------------------
+
+def filter_events(db, args, columns=('os_name', 'ip_addr', 'state')):
+    """
+    :param db: database
+    :param args: request arguments; the columns and since are used as filters
+    :param columns: DeviceEvent columns that can be filtered on
+    :return: DeviceEvent query
+    :raises ValueError: if since is not a valid timestamp
+    """
+    query = db.query(DeviceEvent)
+    for column in columns:
+        if column in args:
+            query = query.filter(getattr(DeviceEvent, column) == args[column])
+    if 'since' in args:
+        query = query.filter(DeviceEvent.created_at >= parse_time(args['since']))
+    return query
+
+
+@api.route('/api/devices/events', methods=['GET'])
+def _get_device_events():
+    """
+    Returns the state transition history, oldest first.  Optional filters
+    are os_name, ip_addr, state and since=<timestamp>, at most 'limit' events
+    (default 100) are returned.
+    """
+    db = aeon_ztp.db.session
+
+    try:
+        limit = int(request.args.get('limit', _DEFAULT_PAGE_LIMIT))
+        if not 0 < limit <= _MAX_PAGE_LIMIT:
+            raise ValueError('limit must be between 1 and %d' % _MAX_PAGE_LIMIT)
+        query = filter_events(db, request.args)
+
+    except ValueError as exc:
+        return jsonify(ok=False, message=str(exc)), 400
+
+    recs = query.order_by(DeviceEvent.created_at, DeviceEvent.id).limit(limit).all()
+    items = device_event_schema.dump(recs, many=True).data
+    return jsonify(count=len(items), items=items)
+
+
+@api.route('/api/devices/events/durations', methods=['GET'])
+def _get_device_event_durations():
+    """
+    Returns the p50, p90 and p99 time in seconds spent in each state, per
+    os_name, hw_model and state, and in each of the bootstrap phases
+    reported by the bootstrappers, per os_name, hw_model and phase.
+    Optional filters are os_name, hw_model and since=<timestamp>.
+    """
+    db = aeon_ztp.db.session
+
+    try:
+        query = filter_events(db, request.args, columns=('os_name',))
+
+    except ValueError as exc:
+        return jsonify(ok=False, message=str(exc)), 400
+
+    query = query.order_by(DeviceEvent.device_id, DeviceEvent.created_at, DeviceEvent.id)
+    durations, timings = events.phase_durations(query.yield_per(_STREAM_BATCH_SIZE))
+    stats = events.duration_stats(durations)
+    phases = events.duration_stats(timings, key=('os_name', 'hw_model', 'phase'))
+
+    if 'hw_model' in request.args:
+        stats = [item for item in stats if item['hw_model'] == request.args['hw_model']]
+        phases = [item for item in phases if item['hw_model'] == request.args['hw_model']]
+
+    return jsonify(count=len(stats), items=stats, phases=phases)
+
+
+@api.route('/api/devices/os-plan', methods=['GET'])
+def _get_device_os_plan():
+    """
+    Returns the OS image and finally script the os-selector.cfg of its
+    profile selects for each device, as its bootstrap would, and the number
+    of devices per image; nothing is changed.  Device column filters work as
+    for GET /api/devices.  With 'Accept: application/x-ndjson', one device is
+    streamed per line, followed by a {"summary": ...} line.
+    """
+    db = aeon_ztp.db.session
+    ndjson = request.accept_mimetypes.best_match(_DEVICE_MIMETYPES) == _NDJSON_MIMETYPE
+
+    try:
+        query = filter_devices(db.query(Device), request.args.to_dict())
+    except AttributeError:
+        return jsonify(ok=False, message='invalid arguments'), 400
+
+    summary = ztp_os_selector.PlanSummary()
+    items = (device_schema.dump(rec).data for rec in query.order_by(Device.id).yield_per(_STREAM_BATCH_SIZE))
+    decisions = (summary.add(decision) for decision in ztp_os_selector.plan_os(items, topdir=_AEON_TOPDIR))
+
+    if ndjson:
+        def generate():
+            for decision in decisions:
+                yield json.dumps(decision) + '\n'
+            yield json.dumps(dict(summary=summary.report())) + '\n'
+
+        return Response(stream_with_context(generate()), mimetype=_NDJSON_MIMETYPE)
+
+    items = list(decisions)
+    return jsonify(count=len(items), items=items, summary=summary.report())
+
+
+@api.route('/api/devices/log', methods=['GET'])
+def _get_device_log():
+    """
+    Returns the log of the bootstraps of the ip_addr device, one JSON record
+    per line, oldest first.  The bootstrappers write the device logs into
+    AEON_DEVICE_LOG_DIR.
+    """
+    ip_addr = request.args.get('ip_addr')
+    if not ip_addr:
+        return jsonify(ok=False, message='ip_addr is required'), 400
+
+    log_dir = ztp_logging.pipeline.device_log_dir
+    try:
+        fpath = ztp_logging.device_log_path(log_dir or '', ip_addr)
+    except ValueError as exc:
+        return jsonify(ok=False, message=str(exc)), 400
+
+    if not log_dir or not path.isfile(fpath):
+        return jsonify(ok=False, message='Not Found: no log of {}'.format(ip_addr)), 404
+
+    return send_from_directory(log_dir, path.basename(fpath), mimetype=_NDJSON_MIMETYPE, cache_timeout=0)
+
+
 # -----------------------------------------------------------------------------
 #                  DELETE: /api/devices
 # -----------------------------------------------------------------------------
@@ -263,6 +736,8 @@ def _delete_devices():
             db = aeon_ztp.db.session
             db.query(Device).delete()
             db.commit()
+            device_cache.clear()
+            changes.notifier.notify()
 
         except Exception as exc:
             return jsonify(
@@ -280,9 +755,13 @@ def _delete_devices():
                 return jsonify(ok=False,
                                message='Not Found: %s' % request.query_string), 404
 
+            keys = [(dev.os_name, dev.ip_addr) for dev in recs]
             for dev in recs:
                 db.delete(dev)
             db.commit()
+            for os_name, ip_addr in keys:
+                device_cache.invalidate(os_name, ip_addr)
+            changes.notifier.notify()
             return jsonify(
                 ok=True, count=n_recs,
                 message='{} records deleted'.format(n_recs))
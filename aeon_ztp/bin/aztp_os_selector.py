@@ -1,27 +1,14 @@
 #!/usr/bin/env python
 
+import os
 import sys
 import json
 import argparse
-import yaml
-import re
-import operator
-from collections import namedtuple
-from yaml.scanner import ScannerError
 
-_PROGNAME = 'aztp_os_selector'
-
-
-class HwNoMatchError(Exception):
-    pass
-
-
-class HwMultiMatchError(Exception):
-    pass
+from aeon_ztp import ztp_os_selector
+from aeon_ztp.ztp_os_selector import SelectorError
 
-
-class CfgError(Exception):
-    pass
+_PROGNAME = 'aztp_os_selector'
 
 
 class ArgumentParser(argparse.ArgumentParser):
@@ -41,14 +28,29 @@ def cli_parse(cmdargs=None):
     psr.add_argument(
         '-c', '--config',
         dest='config_file',
-        help='configuration file',
-        default='os-selector.cfg')
+        help='configuration file; in batch mode, the default is the '
+             'os-selector.cfg of the profile of each device',
+        default=None)
 
-    psr.add_argument(
-        '-j', '--json', required=True,
+    devices = psr.add_mutually_exclusive_group(required=True)
+
+    devices.add_argument(
+        '-j', '--json',
         help='Device data in JSON format'
     )
 
+    devices.add_argument(
+        '-b', '--batch',
+        help='File of device data, one JSON document per line, eg: from '
+             'GET /api/devices; - for stdin'
+    )
+
+    psr.add_argument(
+        '-t', '--topdir',
+        default=os.getenv('AEON_TOPDIR'),
+        help='Aeon-ZTP directory of the profiles, in batch mode'
+    )
+
     # any error with args parsing will raise an exception;
     # this will be caught in the calling environment and
     # handled properly
@@ -69,106 +71,39 @@ def exit_results(results, exit_error=None):
 
 def load_cfg(filepath):
     try:
-        return yaml.safe_load(open(filepath))
-    except (IOError, ScannerError) as e:
-        if isinstance(e, IOError):
-            exit_results({
-                'ok': False,
-                'error_type': 'args',
-                'error_message': 'Unable to load file: %s' % filepath
-            })
-        else:
-            exit_results({
-                'ok': False,
-                'error_type': 'args',
-                'error_message': 'YAML syntax error in file: {filepath}, {e}'.format(filepath=filepath, e=e)
-            })
-
-
-def match_hw_model(dev_data, cfg_data):
-    # find entry matching the hw_model
-    item_match = namedtuple('item_match', ['hw_match', 'data'])
-
-    matches = []
+        return ztp_os_selector.load_cfg(filepath)
+    except SelectorError as exc:
+        exit_results(exc.results())
 
-    for group in cfg_data.iteritems():
-        if group[0] != 'default':
-            for fact_key, fact_value in group[1]['matches'].iteritems():
-                if dev_data[fact_key] not in str(fact_value):
-                    # Stop checking this device group if any of the matches don't match
-                    break
-            else:
-                # If all matches in match group match, return item_match
-                matches.append(group[0])
 
-    # validate on the number of matches found
+def run_batch(devices, out, config_file=None, topdir=None):
+    """ Writes the OS selected for each of the devices, then the aggregate
+    counts as a {"summary": ...} document, one JSON document per line.
 
-    n_found = len(matches)
-    if 0 == n_found:
-        if 'default' in cfg_data:
-            return item_match('default', cfg_data['default'])
-        else:
-            raise HwNoMatchError()
-    elif n_found > 1:
-        raise HwMultiMatchError(
-            'matches multiple os-selector groups: {}'
-            .format(matches)
-        )
-
-    return item_match(matches[0], cfg_data[matches[0]])
-
-
-def match_os_version(dev_data, hw_match):
+    Args:
+        devices (file): Device data, one JSON document per line
+        out (file): Where the results are written
     """
-    Examines the matched hw_model entry and compares
-    the expected vs. actual OS versions.  If the actual OS
-    version does match the Users intent, then return the
-    image name for the system to load.  Otherwise return None.
-    """
-    os_ver = dev_data['os_version'].lower()
-    _keys = ['exact_match', 'regex_match']
-    if not any(k in hw_match for k in _keys):
-        raise CfgError(
-            'Expecting one of: {}'
-            .format(_keys))
-
-    # if the User specifies a regex match, then check for
-    # that match; ignoring case
-
-    match = hw_match.get('regex_match')
-    if match:
-        found = re.match(pattern=match, string=os_ver,
-                         flags=re.IGNORECASE)
-        return False if found else hw_match['image']
-
-    # 'listify' the exact value and then check the actual os
-    # version against one of the one's specified by the User.
-    # make the values lower-case to ignore case
-
-    exact = hw_match.get('exact_match')
-    exact = exact if isinstance(exact, list) else [exact]
-    found = any(operator.eq(os_ver, this.lower()) for this in exact)
-    return False if found else hw_match['image']
+    summary = ztp_os_selector.PlanSummary()
+    for lineno, line in enumerate(devices, 1):
+        if not line.strip():
+            continue
+        try:
+            item = json.loads(line)
+        except ValueError:
+            decision = dict(line=lineno, ok=False, error_type='args',
+                            error_message='JSON line formatted incorrectly.')
+        else:
+            decision = ztp_os_selector.plan_device(item, config_file=config_file, topdir=topdir)
+        out.write(json.dumps(summary.add(decision)) + '\n')
+    out.write(json.dumps(dict(summary=summary.report())) + '\n')
 
 
 def main():
+    # the OS selection is done by aeon_ztp.ztp_os_selector.select(), which the
+    # bootstrappers call directly
     try:
-
         cli_args = cli_parse()
-        cfg_data = load_cfg(cli_args.config_file)
-        try:
-            dev_data = json.loads(cli_args.json)
-            hw_match = match_hw_model(dev_data, cfg_data)
-            sw_match = match_os_version(dev_data, hw_match.data)
-            finally_script = hw_match.data.get('finally')
-
-        except ValueError:
-            exit_results({
-                'ok': False,
-                'error_type': 'args',
-                'error_message': 'JSON argument formatted incorrectly.'
-            })
-
     except ArgumentParser.ParserError as exc:
         exit_results({
             'ok': False,
@@ -176,32 +111,35 @@ def main():
             'error_message': exc.message
         })
 
-    except HwNoMatchError:
-        exit_results({
-            'ok': False,
-            'error_type': 'hw_match',
-            'error_message': 'no matching hw_model value'
-        })
-
-    except HwMultiMatchError as exc:
-        exit_results({
-            'ok': False,
-            'error_type': 'hw_match',
-            'error_message': exc.message
-        })
+    if cli_args.batch:
+        if not (cli_args.config_file or cli_args.topdir):
+            exit_results({
+                'ok': False,
+                'error_type': 'args',
+                'error_message': 'Batch mode needs --config or --topdir.'
+            })
+        try:
+            devices = sys.stdin if cli_args.batch == '-' else open(cli_args.batch)
+        except IOError:
+            exit_results({
+                'ok': False,
+                'error_type': 'args',
+                'error_message': 'Unable to load file: %s' % cli_args.batch
+            })
+        run_batch(devices, sys.stdout, config_file=cli_args.config_file, topdir=cli_args.topdir)
+        sys.exit(0)
 
-    except CfgError as exc:
+    cfg_data = load_cfg(cli_args.config_file or 'os-selector.cfg')
+    try:
+        dev_data = json.loads(cli_args.json)
+    except ValueError:
         exit_results({
             'ok': False,
-            'error_type': 'cfg_error',
-            'error_message': exc.message
+            'error_type': 'args',
+            'error_message': 'JSON argument formatted incorrectly.'
         })
 
-    exit_results({
-        'ok': True,
-        'image_name': sw_match,
-        'finally': finally_script
-    })
+    exit_results(ztp_os_selector.select(dev_data, cfg_data))
 
 
 if __name__ == '__main__':
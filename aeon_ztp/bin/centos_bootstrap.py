@@ -4,15 +4,15 @@ import sys
 import os
 import json
 import argparse
-import subprocess
-import logging
-import logging.handlers
 import time
-import requests
 
 from aeon.centos.device import Device
 from paramiko import AuthenticationException
 from paramiko.ssh_exception import NoValidConnectionsError
+from aeon_ztp.api.client import DeviceUpdateBatch
+from aeon_ztp.ztp_logging import device_logger
+from aeon_ztp.ztp_os_selector import select_os
+from aeon_ztp.ztp_timing import PhaseTimer, timed
 
 
 # ##### -----------------------------------------------------------------------
@@ -78,6 +78,8 @@ def cli_parse(cmdargs=None):
 class CentOSBootstrap(object):
     def __init__(self, server, cli_args):
         self.server = server
+        self.updates = DeviceUpdateBatch(server)
+        self.timer = PhaseTimer()
         self.cli_args = cli_args
         self.target = self.cli_args.target
         self.os_name = 'centos'
@@ -90,18 +92,7 @@ class CentOSBootstrap(object):
         self.dev = None
 
     def setup_logging(self, logname):
-        log = logging.getLogger(name=logname)
-        log.setLevel(logging.INFO)
-
-        fmt = logging.Formatter(
-            '%(name)s %(levelname)s {target}: %(message)s'
-            .format(target=self.target))
-
-        handler = logging.handlers.SysLogHandler(address='/dev/log')
-        handler.setFormatter(fmt)
-        log.addHandler(handler)
-
-        return log
+        return device_logger(logname, self.target, timer=self.timer)
 
     # ##### -----------------------------------------------------------------------
     # #####
@@ -123,15 +114,13 @@ class CentOSBootstrap(object):
         dev_data['image_name'] = self.image_name
         dev_data['finally_script'] = self.finally_script
 
-        requests.put(url='http://%s/api/devices/facts' % self.server, json=dev_data)
+        self.updates.add_facts(dev_data)
 
-    def post_device_status(self, message=None, state=None):
-        requests.put(
-            url='http://%s/api/devices/status' % self.server,
-            json=dict(
-                os_name=self.os_name,
-                ip_addr=self.target or self.dev.target,
-                state=state, message=message))
+    def post_device_status(self, message=None, state=None, phases=None):
+        self.updates.add_status(
+            os_name=self.os_name,
+            ip_addr=self.target or self.dev.target,
+            state=state, message=message, phases=phases)
 
     # ##### -----------------------------------------------------------------------
     # #####
@@ -141,10 +130,16 @@ class CentOSBootstrap(object):
 
     def exit_results(self, results, exit_error=None):
         if results['ok']:
-            self.post_device_status(message='bootstrap completed OK', state='DONE')
+            self.timer.close(ok=True)
+            self.post_device_status(message='bootstrap completed OK', state='DONE',
+                                    phases=self.timer.report())
+            self.updates.flush()
             sys.exit(0)
         else:
-            self.post_device_status(message=results['message'], state='ERROR')
+            self.timer.close(ok=False)
+            self.post_device_status(message=results['message'], state='ERROR',
+                                    phases=self.timer.report())
+            self.updates.flush()
             sys.exit(exit_error or 1)
 
     def get_user_and_passwd(self):
@@ -170,7 +165,14 @@ class CentOSBootstrap(object):
         return user, passwd
 
     def wait_for_device(self, countdown, poll_delay):
-
+        for delay in self.wait_for_device_steps(countdown, poll_delay):
+            time.sleep(delay)
+
+    @timed('wait-for-device')
+    def wait_for_device_steps(self, countdown, poll_delay):
+        """ wait_for_device() as a generator of the seconds to wait between
+        attempts, see bootstrap_steps()
+        """
         dev = None
 
         # first we need to wait for the device to be 'reachable' via the API.
@@ -200,7 +202,7 @@ class CentOSBootstrap(object):
                         error_type='login',
                         message='Failed to connect to target %s within reload countdown' % self.target))
 
-                time.sleep(poll_delay)
+                yield poll_delay
 
         self.dev = dev
         self.post_device_facts()
@@ -211,44 +213,49 @@ class CentOSBootstrap(object):
     # #####
     # ##### -----------------------------------------------------------------------
 
+    @timed('os-select')
     def check_os_install_and_finally(self):
         profile_dir = os.path.join(self.cli_args.topdir, 'etc', 'profiles', self.os_name)
         conf_fpath = os.path.join(profile_dir, 'os-selector.cfg')
 
-        cmd = "{topdir}/bin/aztp_os_selector.py -j '{dev_json}' -c {config}".format(
-            topdir=self.cli_args.topdir,
-            dev_json=json.dumps(self.dev.facts),
-            config=conf_fpath)
+        self.log.info('os-select: [%s]' % conf_fpath)
+        try:
+            results = select_os(self.dev.facts, conf_fpath)
+        except Exception as exc:
+            errmsg = 'Unable to select the OS: {}'.format(str(exc))
+            self.exit_results(results=dict(
+                ok=False,
+                error_type='install',
+                message=errmsg
+            ), exit_error=errmsg)
 
-        self.log.info('os-select: [%s]' % cmd)
+        self.log.info('os-select results={}'.format(results))
+        self.image_name = results.get('image', None)
+        self.finally_script = results.get('finally', None)
 
-        child = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE)
+        self.post_device_facts()
+        return results
 
-        _stdout, _stderr = child.communicate()
-        self.log.info('os-select rc={}, stdout={}'.format(child.returncode, _stdout))
-        self.log.info('os-select stderr={}'.format(_stderr))
+    def bootstrap_steps(self):
+        """ Runs the bootstrap.  Yields the number of seconds to wait each
+        time the bootstrap has to wait for the device, so that the caller can
+        either sleep or do something else in the meantime; ends by calling
+        exit_results().
+        """
+        self.log.info("bootstrap init-delay: {} seconds".format(self.cli_args.init_delay))
 
-        try:
-            results = json.loads(_stdout)
-            image = results.get('image', None)
-            finally_script = results.get('finally', None)
+        self.post_device_status(message='bootstrap started, waiting for device access', state='START')
 
-            self.image_name = image
-            self.finally_script = finally_script
+        with self.timer.phase('init-delay'):
+            yield self.cli_args.init_delay
+        for delay in self.wait_for_device_steps(countdown=self.cli_args.reload_delay, poll_delay=10):
+            yield delay
 
-            self.post_device_facts()
-            return results
+        self.log.info("proceeding with bootstrap")
 
-        except Exception as exc:
-            errmsg = 'Unable to load os-select output as JSON: {}\n {}'.format(_stdout, str(exc))
-            self.exit_results(
-                results=dict(
-                    ok=False,
-                    error_type='install',
-                    message=errmsg
-                ),
-                exit_error=errmsg
-            )
+        self.check_os_install_and_finally()
+        self.log.info("bootstrap process finished")
+        self.exit_results(dict(ok=True))
 
 
 # ##### -----------------------------------------------------------------------
@@ -257,8 +264,8 @@ class CentOSBootstrap(object):
 # #####
 # ##### -----------------------------------------------------------------------
 
-def main():
-    cli_args = cli_parse()
+def create_bootstrapper(cmdargs=None):
+    cli_args = cli_parse(cmdargs)
     server = cli_args.server
     cboot = CentOSBootstrap(server, cli_args)
     if not os.path.isdir(cli_args.topdir):
@@ -266,19 +273,13 @@ def main():
             ok=False,
             error_type='args',
             message='{} is not a directory'.format(cli_args.topdir)))
+    return cboot
 
-    cboot.log.info("bootstrap init-delay: {} seconds".format(cli_args.init_delay))
-
-    cboot.post_device_status(message='bootstrap started, waiting for device access', state='START')
-
-    time.sleep(cli_args.init_delay)
-    cboot.wait_for_device(countdown=cli_args.reload_delay, poll_delay=10)
-
-    cboot.log.info("proceeding with bootstrap")
 
-    cboot.check_os_install_and_finally()
-    cboot.log.info("bootstrap process finished")
-    cboot.exit_results(dict(ok=True))
+def main(cmdargs=None):
+    cboot = create_bootstrapper(cmdargs)
+    for delay in cboot.bootstrap_steps():
+        time.sleep(delay)
 
 
 if '__main__' == __name__:
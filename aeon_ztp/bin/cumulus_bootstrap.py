@@ -4,11 +4,7 @@ import sys
 import os
 import json
 import argparse
-import subprocess
-import logging
-import logging.handlers
 import time
-import requests
 import semver
 from retrying import retry
 from pexpect import pxssh
@@ -19,12 +15,25 @@ from aeon.cumulus.device import Device
 from paramiko import AuthenticationException
 from paramiko.ssh_exception import NoValidConnectionsError
 from aeon.exceptions import LoginNotReadyError
+from aeon_ztp.api.client import Checkpoints, DeviceUpdateBatch
+from aeon_ztp.ztp_admission import Ticket, wait_for_transfer_slot_steps
+from aeon_ztp.ztp_logging import device_logger
+from aeon_ztp.ztp_os_selector import select_os
+from aeon_ztp.ztp_timing import PhaseTimer, timed
 
 _DEFAULTS = {
     'init-delay': 5,
     'reload-delay': 10 * 60,
 }
 
+# checkpointed bootstrap phases, in order; a bootstrap run with --resume
+# carries on after the last one completed.  On Cumulus 3.x the image is copied
+# and checked from ONIE, which reboots into the installer right away.
+PHASES = ('image-selected', 'image-copied', 'rebooted')
+
+# seconds the OS install may take once the device rebooted into the installer
+_INSTALL_COUNTDOWN = 1800
+
 # ##### -----------------------------------------------------------------------
 # #####
 # #####                           Command Line Arguments
@@ -64,6 +73,10 @@ def cli_parse(cmdargs=None):
         type=int, default=_DEFAULTS['init-delay'],
         help="amount of time/s to wait before starting the bootstrap process")
 
+    psr.add_argument(
+        '--resume', action='store_true',
+        help="resume an interrupted bootstrap after its last checkpoint")
+
     # ##### -------------------------
     # ##### authentication
     # ##### -------------------------
@@ -88,9 +101,13 @@ def cli_parse(cmdargs=None):
 class CumulusBootstrap(object):
     def __init__(self, server, cli_args):
         self.server = server
+        self.updates = DeviceUpdateBatch(server)
+        self.timer = PhaseTimer()
         self.cli_args = cli_args
         self.target = self.cli_args.target
         self.os_name = 'cumulus'
+        self.checkpoints = Checkpoints(self.updates, self.os_name, self.target, PHASES)
+        self.transfer = Ticket()
         self.progname = '%s-bootstrap' % self.os_name
         self.logfile = self.cli_args.logfile
         self.log = self.setup_logging(logname=self.progname)
@@ -100,18 +117,7 @@ class CumulusBootstrap(object):
         self.dev = None
 
     def setup_logging(self, logname):
-        log = logging.getLogger(name=logname)
-        log.setLevel(logging.INFO)
-
-        fmt = logging.Formatter(
-            '%(name)s %(levelname)s {target}: %(message)s'
-            .format(target=self.target))
-
-        handler = logging.handlers.SysLogHandler(address='/dev/log')
-        handler.setFormatter(fmt)
-        log.addHandler(handler)
-
-        return log
+        return device_logger(logname, self.target, timer=self.timer)
 
     # ##### -----------------------------------------------------------------------
     # #####
@@ -132,18 +138,16 @@ class CumulusBootstrap(object):
             facts=facts)
         dev_data['image_name'] = self.image_name
         dev_data['finally_script'] = self.finally_script
-        requests.put(url='http://%s/api/devices/facts' % self.server, json=dev_data)
+        self.updates.add_facts(dev_data)
 
-    def post_device_status(self, message=None, state=None):
+    def post_device_status(self, message=None, state=None, phases=None):
         if not (self.dev or self.target):
             self.log.error('Either dev or target is required to post device status. Message was: {}'.format(message))
             return
-        requests.put(
-            url='http://%s/api/devices/status' % self.server,
-            json=dict(
-                os_name=self.os_name,
-                ip_addr=self.target or self.dev.target,
-                state=state, message=message))
+        self.updates.add_status(
+            os_name=self.os_name,
+            ip_addr=self.target or self.dev.target,
+            state=state, message=message, phases=phases)
 
     # ##### -----------------------------------------------------------------------
     # #####
@@ -153,10 +157,16 @@ class CumulusBootstrap(object):
 
     def exit_results(self, results, exit_error=None):
         if results['ok']:
-            self.post_device_status(message='bootstrap completed OK', state='DONE')
+            self.timer.close(ok=True)
+            self.post_device_status(message='bootstrap completed OK', state='DONE',
+                                    phases=self.timer.report())
+            self.updates.flush()
             sys.exit(0)
         else:
-            self.post_device_status(message=results['message'], state='FAILED')
+            self.timer.close(ok=False)
+            self.post_device_status(message=results['message'], state='FAILED',
+                                    phases=self.timer.report())
+            self.updates.flush()
             sys.exit(exit_error or 1)
 
     def get_user_and_passwd(self):
@@ -181,6 +191,14 @@ class CumulusBootstrap(object):
         return user, passwd
 
     def wait_for_device(self, countdown, poll_delay, msg=None):
+        for delay in self.wait_for_device_steps(countdown, poll_delay, msg=msg):
+            time.sleep(delay)
+
+    @timed('wait-for-device')
+    def wait_for_device_steps(self, countdown, poll_delay, msg=None):
+        """ wait_for_device() as a generator of the seconds to wait between
+        attempts, see bootstrap_steps()
+        """
         dev = None
 
         # first we need to wait for the device to be 'reachable' via the API.
@@ -218,12 +236,18 @@ class CumulusBootstrap(object):
                         error_type='login',
                         message='Failed to connect to target %s within reload countdown' % self.target))
 
-                time.sleep(poll_delay)
+                yield poll_delay
 
         self.dev = dev
         self.post_device_facts()
 
     def wait_for_onie_rescue(self, countdown, poll_delay, user='root'):
+        for delay in self.wait_for_onie_rescue_steps(countdown, poll_delay, user=user):
+            time.sleep(delay)
+        return True
+
+    @timed('wait-for-onie-rescue')
+    def wait_for_onie_rescue_steps(self, countdown, poll_delay, user='root'):
         """Polls for SSH access to cumulus device in ONIE rescue mode.
 
         The poll functionality was necessary in addition to the current wait_for_device function
@@ -235,6 +259,8 @@ class CumulusBootstrap(object):
             poll_delay (int): Countdown in seconds between poll attempts.
             user (str): SSH username to use. Defaults to 'root'.
 
+        Yields:
+            int: Seconds to wait before the next poll attempt.
         """
 
         while countdown >= 0:
@@ -248,12 +274,12 @@ class CumulusBootstrap(object):
                 ssh.sendline('\n')
                 ssh.prompt()
 
-                return True
+                return
             except (ExceptionPxssh, EOF) as e:
                 if (str(e) == 'Could not establish connection to host') or isinstance(e, EOF):
                     ssh.close()
                     countdown -= poll_delay
-                    time.sleep(poll_delay)
+                    yield poll_delay
                 else:
                     self.log.error('Error accessing {} in ONIE rescue mode: {}.'.format(self.target, str(e)))
                     self.exit_results(results=dict(
@@ -273,42 +299,30 @@ class CumulusBootstrap(object):
     # #####
     # ##### -----------------------------------------------------------------------
 
+    @timed('os-select')
     def check_os_install_and_finally(self):
         profile_dir = os.path.join(self.cli_args.topdir, 'etc', 'profiles', self.os_name)
         conf_fpath = os.path.join(profile_dir, 'os-selector.cfg')
 
-        cmd = "{topdir}/bin/aztp_os_selector.py -j '{dev_json}' -c {config}".format(
-            topdir=self.cli_args.topdir,
-            dev_json=json.dumps(self.dev.facts),
-            config=conf_fpath)
-
-        self.log.info('os-select: [%s]' % cmd)
-
-        child = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE)
-
-        _stdout, _stderr = child.communicate()
-        self.log.info('os-select rc={}, stdout={}'.format(child.returncode, _stdout))
-        self.log.info('os-select stderr={}'.format(_stderr))
-
+        self.log.info('os-select: [%s]' % conf_fpath)
         try:
-            results = json.loads(_stdout)
-            image_name = results.get('image_name', None)
-            finally_script = results.get('finally', None)
-
-            self.image_name = image_name
-            self.finally_script = finally_script
-
-            self.post_device_facts()
-            return results
-
+            results = select_os(self.dev.facts, conf_fpath)
         except Exception as exc:
-            errmsg = 'Unable to load os-select output as JSON: {}\n {}'.format(_stdout, str(exc))
+            errmsg = 'Unable to select the OS: {}'.format(str(exc))
             self.exit_results(results=dict(
                 ok=False,
                 error_type='install',
                 message=errmsg
             ), exit_error=errmsg)
 
+        self.log.info('os-select results={}'.format(results))
+        self.image_name = results.get('image_name', None)
+        self.finally_script = results.get('finally', None)
+
+        self.post_device_facts()
+        return results
+
+    @timed('onie-install')
     @retry(wait_fixed=15000, stop_max_attempt_number=3)
     def onie_install(self, user='root'):
         """Initiates install in ONIE-RESCUE mode.
@@ -354,6 +368,11 @@ class CumulusBootstrap(object):
             ssh.close()
 
     def install_os(self):
+        for delay in self.install_os_steps():
+            time.sleep(delay)
+
+    @timed('os-install')
+    def install_os_steps(self):
         vendor_dir = os.path.join(self.cli_args.topdir, 'vendor_images', self.os_name)
 
         image_fpath = os.path.join(vendor_dir, self.image_name)
@@ -374,13 +393,19 @@ class CumulusBootstrap(object):
         # Cumulus 2.x upgrade
         if os_semver.major == 2:
             install_command = 'sudo /usr/cumulus/bin/cl-img-install -sf http://{server}/images/{os_name}/{image_name}'.format(server=self.cli_args.server, os_name=self.os_name, image_name=self.image_name)
-            all_good, results = self.dev.api.execute([install_command])
+            for delay in wait_for_transfer_slot_steps(self):
+                yield delay
+            try:
+                all_good, results = self.dev.api.execute([install_command])
+            finally:
+                self.transfer.release()
             if not all_good:
                 errmsg = 'Unable to run command: {}. Error message: {}'.format(install_command, results)
                 self.exit_results(results=dict(
                     ok=False,
                     error_type='install',
                     message=errmsg))
+            self.checkpoints.save('image-copied')
         # Cumulus 3.x upgrade
         else:
             install_command = 'sudo onie-select -rf'
@@ -392,30 +417,61 @@ class CumulusBootstrap(object):
                     error_type='install',
                     message=errmsg))
             self.dev.api.execute(['sudo reboot'])
-            time.sleep(60)
+            yield 60
 
             # Boot into ONIE rescue mode
-            self.wait_for_onie_rescue(countdown=300, poll_delay=10, user='root')
+            for delay in self.wait_for_onie_rescue_steps(countdown=300, poll_delay=10, user='root'):
+                yield delay
 
             # Download and verify OS
-            self.onie_install()
+            for delay in wait_for_transfer_slot_steps(self):
+                yield delay
+            try:
+                self.onie_install()
+            finally:
+                self.transfer.release()
+            self.checkpoints.save('rebooted')
 
             # Wait for onie-rescue shell to terminate
-            time.sleep(60)
+            yield 60
 
             # Wait for actual install to occur. This takes up to 30 min.
-            self.wait_for_device(countdown=1800, poll_delay=30)
+            for delay in self.wait_for_device_steps(countdown=_INSTALL_COUNTDOWN, poll_delay=30):
+                yield delay
 
     def ensure_os_version(self):
-        self.check_os_install_and_finally()
+        for delay in self.ensure_os_version_steps():
+            time.sleep(delay)
+        return self.dev
+
+    def select_image(self):
+        """ Selects the image to install and the finally script, or restores
+        the selection of an interrupted bootstrap.
+        """
+        if not self.checkpoints.done('image-selected'):
+            self.check_os_install_and_finally()
+            self.checkpoints.save('image-selected', image_name=self.image_name, finally_script=self.finally_script)
+            return
+
+        self.image_name = self.checkpoints.get('image-selected', 'image_name')
+        self.finally_script = self.checkpoints.get('image-selected', 'finally_script')
+        self.post_device_facts()
+
+    def ensure_os_version_steps(self):
+        self.select_image()
         if not self.image_name:
             self.log.info('no software install required')
-            return self.dev
+            return
+        if self.checkpoints.done('rebooted'):
+            self.log.info('software image %s installed before the bootstrap was interrupted' % self.image_name)
+            return
 
-        self.log.info('software image install required: %s' % self.image_name)
-        self.install_os()
+        if not self.checkpoints.done('image-copied'):
+            self.log.info('software image install required: %s' % self.image_name)
+            for delay in self.install_os_steps():
+                yield delay
 
-        self.log.info('software install OK')
+            self.log.info('software install OK')
 
         os_semver = semver.parse_version_info(self.dev.facts['os_version'])
         if os_semver.major < 3:
@@ -425,8 +481,50 @@ class CumulusBootstrap(object):
                                     state='OS-REBOOTING')
 
             self.dev.api.execute(['sudo reboot'])
-            time.sleep(self.cli_args.init_delay)
-            return self.wait_for_device(countdown=self.cli_args.reload_delay, poll_delay=10)
+            self.checkpoints.save('rebooted')
+            with self.timer.phase('reboot'):
+                yield self.cli_args.init_delay
+                for delay in self.wait_for_device_steps(countdown=self.cli_args.reload_delay, poll_delay=10):
+                    yield delay
+
+    def bootstrap_steps(self):
+        """ Runs the bootstrap.  Yields the number of seconds to wait each
+        time the bootstrap has to wait for the device, so that the caller can
+        either sleep or do something else in the meantime; ends by calling
+        exit_results().  With --resume the phases completed by an interrupted
+        bootstrap are skipped.
+        """
+        countdown = self.cli_args.reload_delay
+        if self.cli_args.resume and self.checkpoints.load(self.server):
+            msg = 'bootstrap resumed after {}, waiting for device access'.format(self.checkpoints.last)
+            self.log.info(msg)
+            self.post_device_status(message=msg, state='START')
+            if self.checkpoints.done('rebooted'):
+                # the device may still be installing the image
+                countdown = max(countdown, _INSTALL_COUNTDOWN)
+        else:
+            self.log.info("bootstrap init-delay: {} seconds"
+                          .format(self.cli_args.init_delay))
+
+            self.checkpoints.reset()
+            self.post_device_status(message='bootstrap started, waiting for device access', state='START')
+
+            with self.timer.phase('init-delay'):
+                yield self.cli_args.init_delay
+        for delay in self.wait_for_device_steps(countdown=countdown, poll_delay=10,
+                                                msg='Waiting for device access'):
+            yield delay
+
+        self.log.info("proceeding with bootstrap")
+
+        if self.dev.facts['virtual']:
+            self.log.info('Virtual device. No OS upgrade necessary.')
+            self.check_os_install_and_finally()
+        else:
+            for delay in self.ensure_os_version_steps():
+                yield delay
+        self.log.info("bootstrap process finished")
+        self.exit_results(dict(ok=True))
 
 
 # ##### -----------------------------------------------------------------------
@@ -435,8 +533,8 @@ class CumulusBootstrap(object):
 # #####
 # ##### -----------------------------------------------------------------------
 
-def main():
-    cli_args = cli_parse()
+def create_bootstrapper(cmdargs=None):
+    cli_args = cli_parse(cmdargs)
     self_server = cli_args.server
     cboot = CumulusBootstrap(self_server, cli_args)
     if not os.path.isdir(cli_args.topdir):
@@ -444,24 +542,13 @@ def main():
             ok=False,
             error_type='args',
             message='{} is not a directory'.format(cli_args.topdir)))
+    return cboot
 
-    cboot.log.info("bootstrap init-delay: {} seconds"
-                  .format(cli_args.init_delay))
-
-    cboot.post_device_status(message='bootstrap started, waiting for device access', state='START')
-
-    time.sleep(cli_args.init_delay)
-    cboot.wait_for_device(countdown=cli_args.reload_delay, poll_delay=10, msg='Waiting for device access')
-
-    cboot.log.info("proceeding with bootstrap")
 
-    if cboot.dev.facts['virtual']:
-        cboot.log.info('Virtual device. No OS upgrade necessary.')
-        cboot.check_os_install_and_finally()
-    else:
-        cboot.ensure_os_version()
-    cboot.log.info("bootstrap process finished")
-    cboot.exit_results(dict(ok=True))
+def main(cmdargs=None):
+    cboot = create_bootstrapper(cmdargs)
+    for delay in cboot.bootstrap_steps():
+        time.sleep(delay)
 
 
 if '__main__' == __name__:
@@ -4,18 +4,23 @@ import sys
 import os
 import json
 import argparse
-import subprocess
-import logging
-import logging.handlers
 import tempfile
 import time
-import requests
 import hashlib
 
 from aeon.eos.device import Device
 from aeon.exceptions import ProbeError, UnauthorizedError
 from aeon.exceptions import ConfigError, CommandError
 from retrying import retry
+from aeon_ztp.api.client import Checkpoints, DeviceUpdateBatch
+from aeon_ztp.ztp_admission import Ticket, wait_for_transfer_slot_steps
+from aeon_ztp.ztp_logging import device_logger
+from aeon_ztp.ztp_os_selector import select_os
+from aeon_ztp.ztp_timing import PhaseTimer, timed
+
+# checkpointed bootstrap phases, in order; a bootstrap run with --resume
+# carries on after the last one completed
+PHASES = ('config-pushed', 'image-selected', 'image-copied', 'md5-verified', 'rebooted')
 
 
 # ##### -----------------------------------------------------------------------
@@ -57,6 +62,10 @@ def cli_parse(cmdargs=None):
         type=int, default=60,
         help="amount of time/s to wait before starting the bootstrap process")
 
+    psr.add_argument(
+        '--resume', action='store_true',
+        help="resume an interrupted bootstrap after its last checkpoint")
+
     # ##### -------------------------
     # ##### authentication
     # ##### -------------------------
@@ -81,9 +90,13 @@ def cli_parse(cmdargs=None):
 class EosBootstrap(object):
     def __init__(self, server, cli_args):
         self.server = server
+        self.updates = DeviceUpdateBatch(server)
+        self.timer = PhaseTimer()
         self.cli_args = cli_args
         self.target = self.cli_args.target
         self.os_name = 'eos'
+        self.checkpoints = Checkpoints(self.updates, self.os_name, self.target, PHASES)
+        self.transfer = Ticket()
         self.progname = '%s-bootstrap' % self.os_name
         self.logfile = self.cli_args.logfile
         self.log = self.setup_logging(logname=self.progname)
@@ -95,18 +108,7 @@ class EosBootstrap(object):
         self.image_fpath = None
 
     def setup_logging(self, logname):
-        log = logging.getLogger(name=logname)
-        log.setLevel(logging.INFO)
-
-        fmt = logging.Formatter(
-            '%(name)s %(levelname)s {target}: %(message)s'
-            .format(target=self.target))
-
-        handler = logging.handlers.SysLogHandler(address='/dev/log')
-        handler.setFormatter(fmt)
-        log.addHandler(handler)
-
-        return log
+        return device_logger(logname, self.target, timer=self.timer)
 
     # ##### -----------------------------------------------------------------------
     # #####
@@ -128,18 +130,16 @@ class EosBootstrap(object):
         dev_data['image_name'] = self.image_name
         dev_data['finally_script'] = self.finally_script
 
-        requests.put(url='http://%s/api/devices/facts' % self.server, json=dev_data)
+        self.updates.add_facts(dev_data)
 
-    def post_device_status(self, message=None, state=None):
+    def post_device_status(self, message=None, state=None, phases=None):
         if not (self.dev or self.target):
             self.log.error('Either dev or target is required to post device status. Message was: {}'.format(message))
             return
-        requests.put(
-            url='http://%s/api/devices/status' % self.server,
-            json=dict(
-                os_name=self.os_name,
-                ip_addr=self.target or self.dev.target,
-                state=state, message=message))
+        self.updates.add_status(
+            os_name=self.os_name,
+            ip_addr=self.target or self.dev.target,
+            state=state, message=message, phases=phases)
 
     # ##### -----------------------------------------------------------------------
     # #####
@@ -149,10 +149,16 @@ class EosBootstrap(object):
 
     def exit_results(self, results, exit_error=None):
         if results['ok']:
-            self.post_device_status(message='bootstrap completed OK', state='DONE')
+            self.timer.close(ok=True)
+            self.post_device_status(message='bootstrap completed OK', state='DONE',
+                                    phases=self.timer.report())
+            self.updates.flush()
             sys.exit(0)
         else:
-            self.post_device_status(message=results['message'], state='FAILED')
+            self.timer.close(ok=False)
+            self.post_device_status(message=results['message'], state='FAILED',
+                                    phases=self.timer.report())
+            self.updates.flush()
             sys.exit(exit_error or 1)
 
     def get_user_and_passwd(self):
@@ -178,7 +184,14 @@ class EosBootstrap(object):
         return user, passwd
 
     def wait_for_device(self, countdown, poll_delay):
-
+        for delay in self.wait_for_device_steps(countdown, poll_delay):
+            time.sleep(delay)
+
+    @timed('wait-for-device')
+    def wait_for_device_steps(self, countdown, poll_delay):
+        """ wait_for_device() as a generator of the seconds to wait between
+        attempts, see bootstrap_steps()
+        """
         dev = None
 
         # first we need to wait for the device to be 'reachable' via the API.
@@ -203,7 +216,7 @@ class EosBootstrap(object):
                         ok=False,
                         error_type='login',
                         message=errmsg), exit_error=errmsg)
-                time.sleep(poll_delay)
+                yield poll_delay
 
             except ProbeError:
                 countdown -= poll_delay
@@ -230,6 +243,7 @@ class EosBootstrap(object):
     # #####
     # ##### -----------------------------------------------------------------------
 
+    @timed('push-config')
     def do_push_config(self):
         topdir = self.cli_args.topdir
         config_dir = os.path.join(topdir, 'etc', 'configs', self.os_name)
@@ -304,42 +318,30 @@ class EosBootstrap(object):
 
         return md5sum
 
+    @timed('os-select')
     def check_os_install_and_finally(self):
         profile_dir = os.path.join(self.cli_args.topdir, 'etc', 'profiles', self.os_name)
         conf_fpath = os.path.join(profile_dir, 'os-selector.cfg')
 
-        cmd = "{topdir}/bin/aztp_os_selector.py -j '{dev_json}' -c {config}".format(
-            topdir=self.cli_args.topdir,
-            dev_json=json.dumps(self.dev.facts),
-            config=conf_fpath)
-
-        self.log.info('os-select: [%s]' % cmd)
-
-        child = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE)
-
-        _stdout, _stderr = child.communicate()
-        self.log.info('os-select rc={}, stdout={}'.format(child.returncode, _stdout))
-        self.log.info('os-select stderr={}'.format(_stderr))
-
+        self.log.info('os-select: [%s]' % conf_fpath)
         try:
-            results = json.loads(_stdout)
-            image_name = results.get('image_name', None)
-            finally_script = results.get('finally', None)
-
-            self.image_name = image_name
-            self.finally_script = finally_script
-
-            self.post_device_facts()
-            return results
-
+            results = select_os(self.dev.facts, conf_fpath)
         except Exception as exc:
-            errmsg = 'Unable to load os-select output as JSON: {}\n {}'.format(_stdout, str(exc))
+            errmsg = 'Unable to select the OS: {}'.format(str(exc))
             self.exit_results(results=dict(
                 ok=False,
                 error_type='install',
                 message=errmsg
             ), exit_error=errmsg)
 
+        self.log.info('os-select results={}'.format(results))
+        self.image_name = results.get('image_name', None)
+        self.finally_script = results.get('finally', None)
+
+        self.post_device_facts()
+        return results
+
+    @timed('os-install')
     @retry(stop_max_attempt_number=10, wait_fixed=1000, stop_max_delay=600000)
     def do_os_install(self):
         self.image_fpath = os.path.join(self.vendor_dir, self.image_name)
@@ -359,18 +361,23 @@ class EosBootstrap(object):
         # check for file already on device
         # --------------------------------
 
-        try:
-            self.dev.api.execute('dir flash:%s' % self.image_name)
-            self.log.info('file already exists on device, skipping copy.')
+        if self.checkpoints.done('image-copied'):
+            self.log.info('file copied to device before the bootstrap was interrupted, skipping copy.')
             has_file = True
-        except CommandError:
-            has_file = False
+        else:
+            try:
+                self.dev.api.execute('dir flash:%s' % self.image_name)
+                self.log.info('file already exists on device, skipping copy.')
+                has_file = True
+                self.checkpoints.save('image-copied')
+            except CommandError:
+                has_file = False
 
         if has_file:
             # ---------------------------------------------
             # Configure switch to boot from existing upgrade image
             # ---------------------------------------------
-            self.check_md5()
+            self.verify_image()
             self.dev.api.configure(['boot system flash:%s' % self.image_name])
 
         else:
@@ -382,14 +389,21 @@ class EosBootstrap(object):
                             filename=self.image_name)]
             try:
                 self.dev.api.execute(cmds)
+                self.checkpoints.save('image-copied')
             except CommandError as e:
                 self.log.error('Error while installing image: {}'.format(str(e)))
-            self.check_md5()
+            self.verify_image()
 
         # Write config
         self.dev.api.execute('copy running-config startup-config')
         return
 
+    def verify_image(self):
+        if self.checkpoints.done('md5-verified'):
+            return
+        self.check_md5()
+        self.checkpoints.save('md5-verified')
+
     def check_md5(self):
         """"""
         md5sum = self.ensure_md5sum(filepath=self.image_fpath)
@@ -409,13 +423,40 @@ class EosBootstrap(object):
         self.log.info('md5sum checksum OK.')
 
     def do_ensure_os_version(self):
-        self.check_os_install_and_finally()
+        for delay in self.do_ensure_os_version_steps():
+            time.sleep(delay)
+        return self.dev
+
+    def select_image(self):
+        """ Selects the image to install and the finally script, or restores
+        the selection of an interrupted bootstrap.
+        """
+        if not self.checkpoints.done('image-selected'):
+            self.check_os_install_and_finally()
+            self.checkpoints.save('image-selected', image_name=self.image_name, finally_script=self.finally_script)
+            return
+
+        self.image_name = self.checkpoints.get('image-selected', 'image_name')
+        self.finally_script = self.checkpoints.get('image-selected', 'finally_script')
+        self.post_device_facts()
+
+    def do_ensure_os_version_steps(self):
+        self.select_image()
         if not self.image_name:
             self.log.info('no software install required')
-            return self.dev
+            return
+        if self.checkpoints.done('rebooted'):
+            self.log.info('software image %s installed before the bootstrap was interrupted' % self.image_name)
+            return
 
         self.log.info('software image install required: %s' % self.image_name)
-        self.do_os_install()
+        if not self.checkpoints.done('image-copied'):
+            for delay in wait_for_transfer_slot_steps(self):
+                yield delay
+        try:
+            self.do_os_install()
+        finally:
+            self.transfer.release()
 
         self.log.info('software install OK')
         self.log.info('rebooting device ... please be patient')
@@ -428,9 +469,49 @@ class EosBootstrap(object):
         except CommandError:
             # Ignore errors during disconnect due to reboot
             pass
+        self.checkpoints.save('rebooted')
+
+        with self.timer.phase('reboot'):
+            yield self.cli_args.init_delay
+            for delay in self.wait_for_device_steps(countdown=self.cli_args.reload_delay, poll_delay=10):
+                yield delay
+
+    def bootstrap_steps(self):
+        """ Runs the bootstrap.  Yields the number of seconds to wait each
+        time the bootstrap has to wait for the device, so that the caller can
+        either sleep or do something else in the meantime; ends by calling
+        exit_results().  With --resume the phases completed by an interrupted
+        bootstrap are skipped.
+        """
+        if self.cli_args.resume and self.checkpoints.load(self.server):
+            msg = 'bootstrap resumed after {}, waiting for device access'.format(self.checkpoints.last)
+            self.log.info(msg)
+            self.post_device_status(message=msg, state='START')
+        else:
+            self.log.info("starting bootstrap process in {} seconds"
+                          .format(self.cli_args.init_delay))
+
+            self.checkpoints.reset()
+            self.post_device_status(message='bootstrap started, waiting for device access', state='START')
+
+            with self.timer.phase('init-delay'):
+                yield self.cli_args.init_delay
+        for delay in self.wait_for_device_steps(countdown=self.cli_args.reload_delay, poll_delay=10):
+            yield delay
 
-        time.sleep(self.cli_args.init_delay)
-        return self.wait_for_device(countdown=self.cli_args.reload_delay, poll_delay=10)
+        self.log.info("proceeding with bootstrap")
+
+        if not self.checkpoints.done('config-pushed'):
+            self.do_push_config()
+            self.checkpoints.save('config-pushed')
+        if self.dev.facts['virtual']:
+            self.log.info('Virtual device. No OS upgrade necessary.')
+            self.check_os_install_and_finally()
+        else:
+            for delay in self.do_ensure_os_version_steps():
+                yield delay
+        self.log.info("bootstrap process finished")
+        self.exit_results(dict(ok=True))
 
 
 # ##### -----------------------------------------------------------------------
@@ -439,8 +520,8 @@ class EosBootstrap(object):
 # #####
 # ##### -----------------------------------------------------------------------
 
-def main():
-    cli_args = cli_parse()
+def create_bootstrapper(cmdargs=None):
+    cli_args = cli_parse(cmdargs)
     server = cli_args.server
     eboot = EosBootstrap(server, cli_args)
     if not os.path.isdir(cli_args.topdir):
@@ -448,25 +529,13 @@ def main():
             ok=False,
             error_type='args',
             message='{} is not a directory'.format(cli_args.topdir)))
+    return eboot
 
-    eboot.log.info("starting bootstrap process in {} seconds"
-               .format(cli_args.init_delay))
-
-    eboot.post_device_status(message='bootstrap started, waiting for device access', state='START')
-
-    time.sleep(cli_args.init_delay)
-    eboot.wait_for_device(countdown=cli_args.reload_delay, poll_delay=10)
-
-    eboot.log.info("proceeding with bootstrap")
 
-    eboot.do_push_config()
-    if eboot.dev.facts['virtual']:
-        eboot.log.info('Virtual device. No OS upgrade necessary.')
-        eboot.check_os_install_and_finally()
-    else:
-        eboot.do_ensure_os_version()
-    eboot.log.info("bootstrap process finished")
-    eboot.exit_results(dict(ok=True))
+def main(cmdargs=None):
+    eboot = create_bootstrapper(cmdargs)
+    for delay in eboot.bootstrap_steps():
+        time.sleep(delay)
 
 
 if '__main__' == __name__:
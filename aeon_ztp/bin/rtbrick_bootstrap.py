@@ -4,10 +4,8 @@ import sys
 import os
 import json
 import argparse
-import subprocess
 import logging
 import time
-import requests
 import semver
 from pexpect import pxssh
 from pexpect.exceptions import EOF
@@ -18,6 +16,9 @@ from paramiko import AuthenticationException
 from paramiko.ssh_exception import NoValidConnectionsError
 from aeon.exceptions import LoginNotReadyError
 from aeon.rtbrick.accton import RtBrick_AS7712
+from aeon_ztp.api.client import DeviceUpdateBatch
+from aeon_ztp.ztp_os_selector import select_os
+from aeon_ztp.ztp_timing import PhaseTimer, timed
 
 _DEFAULTS = {
     'init-delay': 5,
@@ -87,6 +88,8 @@ def cli_parse(cmdargs=None):
 class RtbrickBootstrap(object):
     def __init__(self, server, cli_args):
         self.server = server
+        self.updates = DeviceUpdateBatch(server)
+        self.timer = PhaseTimer()
         self.cli_args = cli_args
         self.target = self.cli_args.target
         self.os_name = 'rtbrick'
@@ -100,7 +103,8 @@ class RtbrickBootstrap(object):
         self.dev = None
 
     def setup_logging(self, logname):
-        log = logging.getLogger(name=logname)
+        # one logger per target, a process may bootstrap several devices at once
+        log = logging.getLogger(name='{}.{}'.format(logname, self.target))
         log.setLevel(logging.INFO)
 
         fmt = logging.Formatter(
@@ -133,18 +137,16 @@ class RtbrickBootstrap(object):
             facts=facts)
         dev_data['image_name'] = self.image_name
         dev_data['finally_script'] = self.finally_script
-        requests.put(url='http://%s/api/devices/facts' % self.server, json=dev_data)
+        self.updates.add_facts(dev_data)
 
-    def post_device_status(self, message=None, state=None):
+    def post_device_status(self, message=None, state=None, phases=None):
         if not (self.dev or self.target):
             self.log.error('Either dev or target is required to post device status. Message was: {}'.format(message))
             return
-        requests.put(
-            url='http://%s/api/devices/status' % self.server,
-            json=dict(
-                os_name=self.os_name,
-                ip_addr=self.target or self.dev.target,
-                state=state, message=message))
+        self.updates.add_status(
+            os_name=self.os_name,
+            ip_addr=self.target or self.dev.target,
+            state=state, message=message, phases=phases)
 
     # ##### -----------------------------------------------------------------------
     # #####
@@ -154,10 +156,16 @@ class RtbrickBootstrap(object):
 
     def exit_results(self, results, exit_error=None):
         if results['ok']:
-            self.post_device_status(message='bootstrap completed OK', state='DONE')
+            self.timer.close(ok=True)
+            self.post_device_status(message='bootstrap completed OK', state='DONE',
+                                    phases=self.timer.report())
+            self.updates.flush()
             sys.exit(0)
         else:
-            self.post_device_status(message=results['message'], state='FAILED')
+            self.timer.close(ok=False)
+            self.post_device_status(message=results['message'], state='FAILED',
+                                    phases=self.timer.report())
+            self.updates.flush()
             sys.exit(exit_error or 1)
 
     def get_user_and_passwd(self):
@@ -182,6 +190,14 @@ class RtbrickBootstrap(object):
         return user, passwd
 
     def wait_for_device(self, countdown, poll_delay, msg=None):
+        for delay in self.wait_for_device_steps(countdown, poll_delay, msg=msg):
+            time.sleep(delay)
+
+    @timed('wait-for-device')
+    def wait_for_device_steps(self, countdown, poll_delay, msg=None):
+        """ wait_for_device() as a generator of the seconds to wait between
+        attempts, see bootstrap_steps()
+        """
         dev = None
 
         # first we need to wait for the device to be 'reachable' via the API.
@@ -223,13 +239,14 @@ class RtbrickBootstrap(object):
                         message='Failed to connect to target %s within reload countdown' % self.target))
   		print "Login Not ready error"
 
-                time.sleep(poll_delay)
+                yield poll_delay
 
         self.dev = dev
         self.post_device_facts()
         rdev = RtBrick_AS7712(self.target, self.server)
         rdev.config()
 
+    @timed('wait-for-onie-rescue')
     def wait_for_onie_rescue(self, countdown, poll_delay, user='root'):
         """Polls for SSH access to cumulus device in ONIE rescue mode.
 
@@ -280,42 +297,30 @@ class RtbrickBootstrap(object):
     # #####
     # ##### -----------------------------------------------------------------------
 
+    @timed('os-select')
     def check_os_install_and_finally(self):
         profile_dir = os.path.join(self.cli_args.topdir, 'etc', 'profiles', self.os_name)
         conf_fpath = os.path.join(profile_dir, 'os-selector.cfg')
 
-        cmd = "{topdir}/bin/aztp_os_selector.py -j '{dev_json}' -c {config}".format(
-            topdir=self.cli_args.topdir,
-            dev_json=json.dumps(self.dev.facts),
-            config=conf_fpath)
-
-        self.log.info('os-select: [%s]' % cmd)
-
-        child = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE)
-
-        _stdout, _stderr = child.communicate()
-        self.log.info('os-select rc={}, stdout={}'.format(child.returncode, _stdout))
-        self.log.info('os-select stderr={}'.format(_stderr))
-
+        self.log.info('os-select: [%s]' % conf_fpath)
         try:
-            results = json.loads(_stdout)
-            image_name = results.get('image_name', None)
-            finally_script = results.get('finally', None)
-
-            self.image_name = image_name
-            self.finally_script = finally_script
-
-            self.post_device_facts()
-            return results
-
+            results = select_os(self.dev.facts, conf_fpath)
         except Exception as exc:
-            errmsg = 'Unable to load os-select output as JSON: {}\n {}'.format(_stdout, str(exc))
+            errmsg = 'Unable to select the OS: {}'.format(str(exc))
             self.exit_results(results=dict(
                 ok=False,
                 error_type='install',
                 message=errmsg
             ), exit_error=errmsg)
 
+        self.log.info('os-select results={}'.format(results))
+        self.image_name = results.get('image_name', None)
+        self.finally_script = results.get('finally', None)
+
+        self.post_device_facts()
+        return results
+
+    @timed('onie-install')
     def onie_install(self, user='root'):
         """Initiates install in ONIE-RESCUE mode.
 
@@ -358,6 +363,7 @@ class RtbrickBootstrap(object):
             self.log.info(str(e))
             self.exit_results(results=dict(ok=False, error_type='install', message=e))
 
+    @timed('os-install')
     def install_os(self):
         vendor_dir = os.path.join(self.cli_args.topdir, 'vendor_images', self.os_name)
 
@@ -433,6 +439,33 @@ class RtbrickBootstrap(object):
 #            time.sleep(self.cli_args.init_delay)
 #            return self.wait_for_device(countdown=self.cli_args.reload_delay, poll_delay=10)
 
+    def bootstrap_steps(self):
+        """ Runs the bootstrap.  Yields the number of seconds to wait each
+        time the bootstrap has to wait for the device, so that the caller can
+        either sleep or do something else in the meantime; ends by calling
+        exit_results().
+        """
+        self.log.info("bootstrap init-delay: {} seconds"
+                      .format(self.cli_args.init_delay))
+
+        self.post_device_status(message='bootstrap started, waiting for device access', state='START')
+
+        with self.timer.phase('init-delay'):
+            yield self.cli_args.init_delay
+        for delay in self.wait_for_device_steps(countdown=self.cli_args.reload_delay, poll_delay=10,
+                                                msg='Waiting for device access'):
+            yield delay
+
+        self.log.info("proceeding with bootstrap")
+
+        if self.dev.facts['virtual']:
+            self.log.info('Virtual device. No OS upgrade necessary.')
+            self.check_os_install_and_finally()
+        else:
+            self.ensure_os_version()
+        self.log.info("bootstrap process finished")
+        self.exit_results(dict(ok=True))
+
 
 # ##### -----------------------------------------------------------------------
 # #####
@@ -440,8 +473,8 @@ class RtbrickBootstrap(object):
 # #####
 # ##### -----------------------------------------------------------------------
 
-def main():
-    cli_args = cli_parse()
+def create_bootstrapper(cmdargs=None):
+    cli_args = cli_parse(cmdargs)
     self_server = cli_args.server
     cboot = RtbrickBootstrap(self_server, cli_args)
     if not os.path.isdir(cli_args.topdir):
@@ -449,24 +482,13 @@ def main():
             ok=False,
             error_type='args',
             message='{} is not a directory'.format(cli_args.topdir)))
+    return cboot
 
-    cboot.log.info("bootstrap init-delay: {} seconds"
-                  .format(cli_args.init_delay))
-
-    cboot.post_device_status(message='bootstrap started, waiting for device access', state='START')
-
-    time.sleep(cli_args.init_delay)
-    cboot.wait_for_device(countdown=cli_args.reload_delay, poll_delay=10, msg='Waiting for device access')
-
-    cboot.log.info("proceeding with bootstrap")
 
-    if cboot.dev.facts['virtual']:
-        cboot.log.info('Virtual device. No OS upgrade necessary.')
-        cboot.check_os_install_and_finally()
-    else:
-        cboot.ensure_os_version()
-    cboot.log.info("bootstrap process finished")
-    cboot.exit_results(dict(ok=True))
+def main(cmdargs=None):
+    cboot = create_bootstrapper(cmdargs)
+    for delay in cboot.bootstrap_steps():
+        time.sleep(delay)
 
 
 if '__main__' == __name__:
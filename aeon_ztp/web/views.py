@@ -27,7 +27,10 @@ from pygments.util import ClassNotFound
 from werkzeug.utils import secure_filename
 
 from aeon_ztp import ztp_os_selector
-from aeon_ztp.api import models
+from aeon_ztp.api import changes, models
+from aeon_ztp.api.cache import device_cache
+from aeon_ztp.api.repository import filter_devices
+from aeon_ztp.api.views import device_head_cursor
 from ztp_sudo import flush_dhcp
 
 _syslog_file = "/var/log/syslog"
@@ -323,14 +326,26 @@ def site_map():
     return render_template('links.html', links=links)
 
 
+def render_status(matching):
+    """ Renders the device status page for the devices matching all of the given column values.
+        The page keeps itself up to date using the GET /api/devices/changes long-poll API.
+
+    Args:
+        matching (dict): Device column name:value pairings
+
+    """
+    db = aeon_ztp.db.session
+    devices = filter_devices(db.query(models.Device), matching).order_by(models.Device.id)
+    g.title = "Device Status"
+    return render_template('status.html', devices=devices, matching=matching,
+                           cursor=device_head_cursor(db, matching))
+
+
 @web.route('/status')
 def status():
     """ Renders a simple device status webpage for all ZTP-DB devices
     """
-    db = aeon_ztp.db.session
-    devices = db.query(models.Device)
-    g.title = "Device Status"
-    return render_template('status.html', devices=devices)
+    return render_status({})
 
 
 @web.route('/status/ip/<ip>')
@@ -341,11 +356,8 @@ def status_for_ip(ip):
         ip (str): dotted-quad IP address to check ZTP database for.
 
     """
-    db = aeon_ztp.db.session
     g.ip = ip
-    devices = db.query(models.Device).filter(models.Device.ip_addr == ip)
-    g.title = "Device Status"
-    return render_template('status.html', devices=devices)
+    return render_status({'ip_addr': ip})
 
 
 @web.route('/status/os/<osname>')
@@ -357,10 +369,7 @@ def status_for_os(osname):
 
 
     """
-    db = aeon_ztp.db.session
-    devices = db.query(models.Device).filter(models.Device.os_name == osname)
-    g.title = "Device Status"
-    return render_template('status.html', devices=devices)
+    return render_status({'os_name': osname})
 
 
 @web.route('/status/hw/<hw>')
@@ -371,10 +380,7 @@ def status_for_hw(hw):
         hw (str): Hardware type to filter by
 
     """
-    db = aeon_ztp.db.session
-    devices = db.query(models.Device).filter(models.Device.hw_model == hw)
-    g.title = "Device Status"
-    return render_template('status.html', devices=devices)
+    return render_status({'hw_model': hw})
 
 
 @web.route('/dhcp/flush')
@@ -539,6 +545,8 @@ def delete_device(ip):
     count = deldevices.count()
     deldevices.delete(synchronize_session=False)
     db.commit()
+    device_cache.clear()
+    changes.notifier.notify()
     flash('Deleted {} entries from ZTP DB'.format(count), 'success')
     return redirect(url_for('web.status'))
 
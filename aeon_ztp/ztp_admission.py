@@ -0,0 +1,134 @@
+# Copyright 2014-present, Apstra, Inc. All rights reserved.
+#
+# This source code is licensed under End User License Agreement found in the
+# LICENSE file at http://www.apstra.com/community/eula
+#
+# Admission control of the bootstraps run by the celery worker.
+#
+# A bootstrap must hold a slot of its os_name, and a global slot, while it
+# runs.  A slot is an exclusive flock() on one of a fixed number of lock files,
+# so the slots are shared by all of the worker processes, and the slots of a
+# worker process that dies are released by the kernel.  A bootstrap that finds
+# no free slot is put back on its queue by the caller.
+#
+# The image downloads the bootstrappers start on the devices are capped the
+# same way, by the image_transfers slots.
+
+import errno
+import fcntl
+import os
+import tempfile
+
+_AEON_ADMISSION_DIR = os.getenv('AEON_ADMISSION_DIR',
+                                os.path.join(tempfile.gettempdir(), 'aeon-ztp-admission'))
+_AEON_MAX_TRANSFERS = int(os.getenv('AEON_MAX_TRANSFERS', 0))
+
+
+def parse_os_values(value):
+    """ Parses an 'os_name=number,...' setting, eg: 'cumulus=4,eos=8'.
+
+    Returns:
+        dict: os_name: int
+    """
+    values = {}
+    for item in (value or '').split(','):
+        if '=' not in item:
+            continue
+        os_name, number = item.split('=', 1)
+        values[os_name.strip()] = int(number)
+    return values
+
+
+class Ticket(object):
+    """ Slots held by a bootstrap.
+    """
+    def __init__(self, fds=None):
+        self._fds = list(fds or [])
+
+    def release(self):
+        fds, self._fds = self._fds, []
+        for fd in fds:
+            os.close(fd)
+
+    def transfer(self):
+        """ Hands the slots over to a new ticket, eg: to the code that ends
+        the bootstrap later on; this ticket no longer holds them.
+        """
+        ticket = Ticket(self._fds)
+        self._fds = []
+        return ticket
+
+
+class Admission(object):
+    """ Caps the number of bootstraps running at once.
+
+    Attributes:
+        directory (str): Where the slot lock files are kept
+        limit (int): Bootstraps of any os_name, 0 for no limit
+        os_limits (dict): os_name: bootstraps of that os_name, 0 or missing for no limit
+    """
+    def __init__(self, directory=_AEON_ADMISSION_DIR, limit=0, os_limits=None):
+        self.directory = directory
+        self.limit = limit
+        self.os_limits = os_limits or {}
+
+    def acquire(self, os_name):
+        """ Returns:
+            Ticket: holding the slots of the bootstrap, or None if the os_name
+            or global limit is reached
+        """
+        ticket = Ticket()
+        for name, limit in ((os_name, self.os_limits.get(os_name)), ('all', self.limit)):
+            if not limit:
+                continue
+            fd = self._lock_slot(name, limit)
+            if fd is None:
+                ticket.release()
+                return None
+            ticket._fds.append(fd)
+        return ticket
+
+    def _lock_slot(self, name, limit):
+        if not os.path.isdir(self.directory):
+            try:
+                os.makedirs(self.directory)
+            except OSError as exc:
+                if exc.errno != errno.EEXIST:
+                    raise
+
+        for idx in range(limit):
+            fd = os.open(os.path.join(self.directory, '%s.%d.lock' % (name, idx)), os.O_RDWR | os.O_CREAT, 0o664)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError:
+                os.close(fd)
+                continue
+            return fd
+        return None
+
+
+# a bootstrapper holds one of these slots while its device downloads an image
+image_transfers = Admission(directory=os.path.join(_AEON_ADMISSION_DIR, 'transfers'), limit=_AEON_MAX_TRANSFERS)
+
+
+def wait_for_transfer_slot_steps(boot, poll_delay=10):
+    """ Waits for one of the image_transfers slots, so that no more than
+    AEON_MAX_TRANSFERS devices download an image at once; the Ticket is kept
+    in boot.transfer.  Yields the seconds to wait between attempts, see the
+    bootstrap_steps() of the bootstrappers.
+
+    Args:
+        boot: Bootstrapper with os_name, timer, log and post_device_status()
+        poll_delay (int): Seconds between attempts
+    """
+    boot.transfer = image_transfers.acquire(boot.os_name)
+    if boot.transfer is not None:
+        return
+
+    with boot.timer.phase('await-transfer'):
+        while boot.transfer is None:
+            msg = 'waiting for an image transfer slot'
+            boot.post_device_status(message=msg, state='AWAIT-TRANSFER')
+            boot.log.info(msg)
+            yield poll_delay
+            boot.transfer = image_transfers.acquire(boot.os_name)
@@ -5,20 +5,94 @@
 
 import subprocess
 import logging
-import logging.handlers
 import os
-import socket
-import requests
+import random
+import threading
 import json
-
+import time
+import traceback
+from contextlib import contextmanager
+from datetime import timedelta
+from functools import partial
+from importlib import import_module
+
+import aeon_ztp
 from celery import Celery
+from celery.signals import task_prerun, task_postrun, worker_process_init, worker_process_shutdown, worker_ready
+from flask import has_app_context
+from kombu import Queue
+
+from aeon_ztp.api import repository
+from aeon_ztp.ztp_admission import Admission, parse_os_values
+from aeon_ztp.ztp_engine import BOOTSTRAPPERS, BootstrapEngine, exit_status, release_logging
+from aeon_ztp.ztp_logging import device_logger
+from aeon_ztp.ztp_metrics import metrics
+from aeon_ztp.ztp_routes import server_addresses
 
 __all__ = ['ztp_bootstrapper']
 
+# Bootstraps go to the queue of their os_name, or to BOOTSTRAP_QUEUE for the
+# other os_names, and finally scripts to FINALIZE_QUEUE, so that a burst of
+# one platform does not bury the others.  Messages carry a priority: finally
+# scripts first, then resumed bootstraps, then new ones by os_name priority,
+# see AEON_BOOTSTRAP_PRIORITY.
+BOOTSTRAP_QUEUE = 'aeon-bootstrap'
+FINALIZE_QUEUE = 'aeon-finalize'
+_MAX_PRIORITY = 9
+_FINALIZE_PRIORITY = 9
+_RESUME_PRIORITY = 7
+_BOOTSTRAP_PRIORITY = 5
+
+# os_name=priority,... of the new bootstraps, eg: 'cumulus=3' lets the quick
+# config only turn-ups of the other platforms go ahead of Cumulus installs
+_AEON_BOOTSTRAP_PRIORITY = parse_os_values(os.getenv('AEON_BOOTSTRAP_PRIORITY'))
+
+
+def bootstrap_queue(os_name):
+    return '%s-%s' % (BOOTSTRAP_QUEUE, os_name) if os_name in BOOTSTRAPPERS else BOOTSTRAP_QUEUE
+
+
+def _priority_queue(name):
+    return Queue(name, routing_key=name, queue_arguments={'x-max-priority': _MAX_PRIORITY})
+
+
+class TaskRouter(object):
+    """ Routes the tasks to their queue, with their priority.
+    """
+    def route_for_task(self, task, args=None, kwargs=None):
+        kwargs = kwargs or {}
+        if task == ztp_finalizer.name:
+            return dict(queue=FINALIZE_QUEUE, priority=_FINALIZE_PRIORITY)
+        if task == ztp_bootstrapper.name:
+            os_name = kwargs.get('os_name', args[0] if args else None)
+            if kwargs.get('resume'):
+                priority = _RESUME_PRIORITY
+            else:
+                priority = _AEON_BOOTSTRAP_PRIORITY.get(os_name, _BOOTSTRAP_PRIORITY)
+            return dict(queue=bootstrap_queue(os_name), priority=priority)
+        return None
+
+
 celery_config = dict()
 celery_config['CELERY_BROKER_URL'] = 'amqp://'
 celery_config['CELERY_RESULT_BACKEND'] = 'rpc://'
 
+# the default 'celery' queue is still consumed for the messages queued before
+# an upgrade
+celery_config['CELERY_QUEUES'] = [Queue('celery', routing_key='celery'), _priority_queue(FINALIZE_QUEUE),
+                                  _priority_queue(BOOTSTRAP_QUEUE)]
+celery_config['CELERY_QUEUES'] += [_priority_queue(bootstrap_queue(os_name)) for os_name in sorted(BOOTSTRAPPERS)]
+celery_config['CELERY_ROUTES'] = [TaskRouter()]
+
+# a worker process only reserves the message it runs, the priorities decide
+# which message comes next
+celery_config['CELERYD_PREFETCH_MULTIPLIER'] = 1
+
+# bootstrappers run in the worker processes in the 'inprocess' and 'engine'
+# modes; replace the processes now and then so that their memory use stays
+# bounded.  A process running engine bootstraps waits for them before it exits.
+celery_config['CELERYD_MAX_TASKS_PER_CHILD'] = 100
+
 celery = Celery('aeon-ztp', broker=celery_config['CELERY_BROKER_URL'])
 celery.conf.update(celery_config)
 
@@ -26,54 +100,266 @@ _AEON_PORT = os.getenv('AEON_HTTP_PORT')
 _AEON_DIR = os.getenv('AEON_TOPDIR')
 _AEON_LOGFILE = os.getenv('AEON_LOGFILE')
 
+# 'subprocess' runs each bootstrapper as a new process, 'inprocess' runs the
+# bootstrappers of ztp_engine.BOOTSTRAPPERS in the celery worker process
+# itself, which imports them once at startup instead of once per device.
+# 'engine' hands them to a BootstrapEngine running in the worker process, the
+# task ends once the device is registered and the engine posts the final
+# status, so a worker process is not tied up by a single device.
+_AEON_BOOTSTRAP_MODE = os.getenv('AEON_BOOTSTRAP_MODE', 'subprocess')
+_AEON_ENGINE_WORKERS = int(os.getenv('AEON_ENGINE_WORKERS', 16))
+
+# bootstraps allowed to run at once, in total and per os_name, eg:
+# AEON_OS_MAX_BOOTSTRAPS='cumulus=4'; 0 or unset for no limit.  A bootstrap
+# over the limit goes back to its queue for AEON_ADMISSION_RETRY seconds,
+# doubled on each retry up to AEON_ADMISSION_RETRY_MAX, and is dropped after
+# AEON_ADMISSION_MAX_RETRIES retries, see admission_countdown().
+_AEON_MAX_BOOTSTRAPS = int(os.getenv('AEON_MAX_BOOTSTRAPS', 0))
+_AEON_OS_MAX_BOOTSTRAPS = parse_os_values(os.getenv('AEON_OS_MAX_BOOTSTRAPS'))
+_AEON_ADMISSION_RETRY = int(os.getenv('AEON_ADMISSION_RETRY', 30))
+_AEON_ADMISSION_RETRY_MAX = int(os.getenv('AEON_ADMISSION_RETRY_MAX', 600))
+_AEON_ADMISSION_MAX_RETRIES = int(os.getenv('AEON_ADMISSION_MAX_RETRIES', 12))
+
+admission = Admission(limit=_AEON_MAX_BOOTSTRAPS, os_limits=_AEON_OS_MAX_BOOTSTRAPS)
+
+# seconds after which the bootstrap lock of a device lapses, in case the
+# worker running its bootstrap dies, see enqueue_bootstrap()
+_AEON_BOOTSTRAP_LOCK_TTL = int(os.getenv('AEON_BOOTSTRAP_LOCK_TTL', 7200))
+
+# BootstrapEngine of this worker process, started on first use
+_engine = None
+
+# Flask app of this worker process, created on first use; the tasks read and
+# write the device rows directly through aeon_ztp.api.repository, with its
+# pooled database connections, rather than through the HTTP API
+_app = None
+_app_lock = threading.Lock()
+
+# bootstrappers that save checkpoints, and can resume after them with --resume
+RESUMABLE = ('cumulus', 'eos', 'nxos')
+
+# device states of a bootstrap that has ended
+_ENDED_STATES = ('DONE', 'ERROR', 'FAILED')
+
+# task_id: start time of the tasks running in this worker process
+_task_started = {}
+
+
+@task_prerun.connect
+def _start_task_timer(task_id=None, **kwargs):
+    _task_started[task_id] = time.time()
+
+
+@task_postrun.connect
+def _record_task_metrics(task_id=None, task=None, kwargs=None, state=None, **_kwargs):
+    started = _task_started.pop(task_id, None)
+    labels = dict(task=task.name, os_name=(kwargs or {}).get('os_name'))
+    metrics.inc('aeon_ztp_celery_tasks_total', dict(labels, state=state))
+    if started is not None:
+        metrics.observe('aeon_ztp_celery_task_duration_seconds', time.time() - started, labels)
+
+
+@worker_process_init.connect
+def _import_bootstrappers(**kwargs):
+    if _AEON_BOOTSTRAP_MODE not in ('inprocess', 'engine'):
+        return
+    for module in BOOTSTRAPPERS.values():
+        try:
+            import_module(module)
+        except Exception:
+            # reported when a device of this os_name registers
+            pass
+
+
+@worker_process_init.connect
+def _reset_db_pool(**kwargs):
+    # the connections of the parent process must not be shared with it
+    if _app is not None:
+        aeon_ztp.db.get_engine(_app).dispose()
+
+
+@worker_process_shutdown.connect
+def _join_engine(**kwargs):
+    if _engine is not None:
+        _engine.join()
+
+
+@worker_ready.connect
+def _resume_bootstraps(sender=None, **kwargs):
+    resume_bootstraps(node=getattr(sender, 'hostname', None))
+
+
+def resume_bootstraps(node=None):
+    """ Restarts the bootstraps interrupted by a restart of the celery worker
+    node.  A bootstrap that has not ended, of a device updated within
+    _AEON_BOOTSTRAP_LOCK_TTL, is resumed if its device lock has lapsed, or is
+    held by this node; the others are running on another node, or waiting in
+    a queue.  The devices without a lock have no bootstrap in flight.
+    Checkpointing bootstrappers resume after their last checkpoint, the others
+    start over.
+
+    Args:
+        node (str): Name of this celery worker node
+
+    Returns:
+        list: (os_name, ip_addr) of the devices restarted
+    """
+    log = logging.getLogger('aeon-bootstrapper')
+    try:
+        with device_db() as db:
+            updated_since = repository.time_now() - timedelta(seconds=_AEON_BOOTSTRAP_LOCK_TTL)
+            states = repository.locked_device_states(db, updated_since=updated_since)
+    except Exception as exc:
+        log.error('unable to look for interrupted bootstraps: {}'.format(exc))
+        return []
+
+    resumed = []
+    for os_name, ip_addr, state in states:
+        if state in _ENDED_STATES:
+            continue
+        try:
+            with device_db() as db:
+                lock = repository.take_over_bootstrap_lock(db, ip_addr, os_name, _AEON_BOOTSTRAP_LOCK_TTL, node)
+            if lock is None:
+                log.info('bootstrap of {} device {} is held by another worker'.format(os_name, ip_addr))
+                continue
+            log.info('resuming interrupted bootstrap of {} device {}'.format(os_name, ip_addr))
+            ztp_bootstrapper.delay(os_name=os_name, target=ip_addr, resume=True, lock=lock)
+        except Exception as exc:
+            # the other devices are still resumed
+            log.error('unable to resume bootstrap of {} device {}: {}'.format(os_name, ip_addr, exc))
+            continue
+        resumed.append((os_name, ip_addr))
+    return resumed
+
+
+def enqueue_bootstrap(os_name, target):
+    """ Enqueues the bootstrap of a device, unless one is already in flight.
+    Devices call the register API several times; the bootstrap lock of the
+    device makes the repeated calls cost a single statement.
+
+    Returns:
+        bool: True if the bootstrap was enqueued
+    """
+    with device_db() as db:
+        lock = repository.acquire_bootstrap_lock(db, target, os_name, _AEON_BOOTSTRAP_LOCK_TTL)
+    if lock is None:
+        return False
 
-def get_server_ipaddr(dst):
-    dst_s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    dst_s.connect((dst, 0))
-    return dst_s.getsockname()[0]
-
-
-def post_device_status(server, target, os_name, message=None, state=None):
-    requests.put(
-        url='http://%s/api/devices/status' % server,
-        json=dict(
-            os_name=os_name, ip_addr=target,
-            state=state, message=message))
+    try:
+        ztp_bootstrapper.delay(os_name=os_name, target=target, lock=lock)
+    except Exception:
+        DeviceLock(target, lock).release()
+        raise
+    return True
+
+
+class DeviceLock(object):
+    """ Bootstrap lock of a device held by a task, see enqueue_bootstrap().
+    """
+    def __init__(self, target, token=None):
+        self.target = target
+        self.token = token
+
+    def claim(self, node):
+        """ Records node as the celery worker node running the bootstrap.
+        """
+        if self.token and node:
+            with device_db() as db:
+                repository.claim_bootstrap_lock(db, self.target, self.token, node)
+
+    def release(self):
+        token, self.token = self.token, None
+        if token:
+            with device_db() as db:
+                repository.release_bootstrap_lock(db, self.target, token)
+
+    def transfer(self):
+        """ Hands the lock over to a new DeviceLock, eg: to the code that ends
+        the bootstrap later on; this one no longer holds it.
+        """
+        lock = DeviceLock(self.target, self.token)
+        self.token = None
+        return lock
+
+
+@contextmanager
+def device_db():
+    """ Yields the database session of the calling thread, for the device
+    reads and writes of aeon_ztp.api.repository.  Outside of an app context,
+    eg: in a task, the session belongs to an app context of this worker
+    process's own app, popped on exit so that its connection goes back to
+    the pool.
+    """
+    global _app
+    if has_app_context():
+        yield aeon_ztp.db.session
+        return
+
+    with _app_lock:
+        if _app is None:
+            # a worker may start before the web app has served its first
+            # request, which creates the tables of a new release
+            app = aeon_ztp.create_app('production')
+            with app.app_context():
+                aeon_ztp.initialize_database()
+            _app = app
+    with _app.app_context():
+        yield aeon_ztp.db.session
+
+
+def bootstrap_engine():
+    global _engine
+    if _engine is None:
+        _engine = BootstrapEngine(workers=_AEON_ENGINE_WORKERS)
+    return _engine
+
+
+def queue_depths():
+    """ Returns:
+        list: (queue name, number of messages waiting) of the celery queues,
+        empty if the broker cannot be reached
+    """
+    depths = []
+    try:
+        with celery.connection(connect_timeout=1) as conn:
+            for queue in celery.conf.CELERY_QUEUES:
+                # a failed passive declare closes the channel
+                channel = conn.channel()
+                try:
+                    _, depth, _ = channel.queue_declare(queue=queue.name, passive=True)
+                except conn.channel_errors:
+                    # not declared by a worker yet
+                    continue
+                channel.close()
+                depths.append((queue.name, depth))
+    except Exception:
+        return []
+    return depths
 
 
-def get_device_state(server, target):
-    r = requests.get(url='http://{server}/api/devices?ip_addr={ip_addr}'
-                     .format(server=server, ip_addr=target))
-    try:
-        state = r.json()['items'][0]['state']
-    except KeyError:
-        state = None
-    return state
+def get_server_ipaddr(dst):
+    return server_addresses.get(dst)
 
 
-def get_device_facts(server, target):
-    r = requests.get(url='http://{server}/api/devices?ip_addr={ip_addr}'
-                     .format(server=server, ip_addr=target))
+def post_device_status(target, os_name, message=None, state=None):
+    with device_db() as db:
+        repository.set_device_status(db, os_name, target, state=state, message=message)
 
-    facts = r.json().get('items')[0]
-    if facts and 'facts' in facts:
-        facts_column = json.loads(facts.pop('facts'))
-        facts.update(facts_column)
 
-        return facts
-    else:
-        return facts
+def get_device_state(target, os_name):
+    with device_db() as db:
+        item = repository.get_device_item(db, os_name, target)
+    return item['state'] if item else None
 
 
-def setup_logging(logname, target):
-    log = logging.getLogger(name=logname)
-    log.setLevel(logging.INFO)
-    handler = logging.handlers.SysLogHandler(address='/dev/log')
-    fmt = logging.Formatter(
-        '%(name)s %(levelname)s {target}: %(message)s'.format(target=target))
-    handler.setFormatter(fmt)
-    log.addHandler(handler)
-    return log
+def get_device_facts(target, os_name):
+    with device_db() as db:
+        facts = repository.get_device_item(db, os_name, target) or {}
+    if 'facts' in facts:
+        facts_column = json.loads(facts.pop('facts') or '{}')
+        facts.update(facts_column)
+    return facts
 
 
 def do_finalize(server, os_name, target, log, finally_script=None):
@@ -90,7 +376,7 @@ def do_finalize(server, os_name, target, log, finally_script=None):
         log.info('no user provided finally script found at: "{}"'.format(profile_dir))
         return 0, None
 
-    json_facts = json.dumps(get_device_facts(server, target))
+    json_facts = json.dumps(get_device_facts(target, os_name))
 
     cmd_args = [
         finalizer,
@@ -116,8 +402,7 @@ def do_finalize(server, os_name, target, log, finally_script=None):
 
     message = "executing 'finally' script:[pid={pid}] {cmd}".format(pid=child.pid, cmd=cmd_str)
     log.info(message)
-    post_device_status(server=server,
-                       os_name=os_name, target=target,
+    post_device_status(os_name=os_name, target=target,
                        state='FINALLY', message=message)
 
     _stdout, _stderr = child.communicate()
@@ -130,32 +415,72 @@ def do_finalize(server, os_name, target, log, finally_script=None):
     return rc, _stderr
 
 
-def do_bootstrapper(server, os_name, target, log):
-    prog = '%s/bin/%s_bootstrap*' % (_AEON_DIR, os_name)
-
+def bootstrapper_args(server, target, resume=False):
     cmd_args = [
-        prog,
-        '--target %s' % target,
-        '--server %s' % server,
-        '--topdir %s' % _AEON_DIR,
-        '-U AEON_TUSER',
-        '-P AEON_TPASSWD',
-        '--logfile %s' % _AEON_LOGFILE
+        '--target', target,
+        '--server', server,
+        '--topdir', _AEON_DIR,
+        '-U', 'AEON_TUSER',
+        '-P', 'AEON_TPASSWD'
     ]
+    if _AEON_LOGFILE:
+        cmd_args += ['--logfile', _AEON_LOGFILE]
+    if resume:
+        cmd_args.append('--resume')
+    return cmd_args
 
-    cmd_str = ' '.join(cmd_args)
 
-    # must pass command as a single string; using shell=True
+def run_bootstrapper(os_name, cmd_args):
+    """ Runs a bootstrapper in this process.
 
-    this = subprocess.Popen(
-        cmd_str, shell=True,
-        stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    Args:
+        os_name (str): Key of BOOTSTRAPPERS
+        cmd_args (list): Bootstrapper command line arguments
+
+    Returns:
+        tuple: (exit code, error text); the error text is the traceback of an
+        unexpected exception, or an empty string
+    """
+    boot = None
+    try:
+        boot = import_module(BOOTSTRAPPERS[os_name]).create_bootstrapper(cmd_args)
+        for delay in boot.bootstrap_steps():
+            time.sleep(delay)
+        rc, _stderr = 0, ''
+    except SystemExit as exc:
+        rc, _stderr = exit_status(exc)
+    except Exception:
+        rc, _stderr = 1, traceback.format_exc()
+    finally:
+        if boot is not None:
+            release_logging(boot.log)
+
+    return rc, _stderr
+
+
+def do_bootstrapper(server, os_name, target, log, resume=False):
+    cmd_args = bootstrapper_args(server, target, resume=resume and os_name in RESUMABLE)
+
+    if _AEON_BOOTSTRAP_MODE == 'inprocess' and os_name in BOOTSTRAPPERS:
+        log.info("starting bootstrapper[pid={pid}] [{name} {args}]".format(
+            pid=os.getpid(), name=BOOTSTRAPPERS[os_name], args=' '.join(cmd_args)))
+        rc, _stderr = run_bootstrapper(os_name, cmd_args)
+
+    else:
+        prog = '%s/bin/%s_bootstrap*' % (_AEON_DIR, os_name)
+        cmd_str = ' '.join([prog] + cmd_args)
+
+        # must pass command as a single string; using shell=True
 
-    log.info("starting bootstrapper[pid={pid}] [{cmd_str}]".format(
-        pid=this.pid, cmd_str=cmd_str))
+        this = subprocess.Popen(
+            cmd_str, shell=True,
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
 
-    _stdout, _stderr = this.communicate()
-    rc = this.returncode
+        log.info("starting bootstrapper[pid={pid}] [{cmd_str}]".format(
+            pid=this.pid, cmd_str=cmd_str))
+
+        _stdout, _stderr = this.communicate()
+        rc = this.returncode
 
     log.info("bootstrapper complete: rc={}".format(rc))
     if len(_stderr):
@@ -164,73 +489,156 @@ def do_bootstrapper(server, os_name, target, log):
     return rc, _stderr
 
 
-@celery.task
-def ztp_bootstrapper(os_name, target):
+def admission_countdown(retries):
+    """ Returns:
+        float: seconds a bootstrap over the admission limits waits before its
+        next try, once it was retried retries times; the delay doubles on each
+        retry, and is jittered so that the bootstraps turned down together do
+        not all come back at once
+    """
+    delay = min(_AEON_ADMISSION_RETRY * 2 ** min(retries, 16), _AEON_ADMISSION_RETRY_MAX)
+    return delay / 2.0 + random.uniform(0, delay / 2.0)
+
+
+@celery.task(bind=True)
+def ztp_bootstrapper(self, os_name, target, resume=False, lock=None):
+    """ Registers a device and runs its bootstrapper.  resume restarts a
+    bootstrap interrupted by a worker restart, see resume_bootstraps().  lock
+    is the token of the bootstrap lock of the device, released when the
+    bootstrap ends.
+    """
 
     server = "{}:{}".format(get_server_ipaddr(target), _AEON_PORT)
 
-    log = setup_logging(logname='aeon-bootstrapper', target=target)
+    # before the registration, which is only done once
+    ticket = admission.acquire(os_name)
+    if ticket is None:
+        retries = self.request.retries or 0
+        if retries < _AEON_ADMISSION_MAX_RETRIES:
+            raise self.retry(countdown=admission_countdown(retries), max_retries=_AEON_ADMISSION_MAX_RETRIES)
+
+        # the device registers again, and gets a new bootstrap, once its lock is released
+        log = device_logger(logname='aeon-bootstrapper', target=target)
+        try:
+            log.error('Bootstrap of device at {} dropped: still over the admission limits after {} '
+                      'retries.'.format(target, retries))
+        finally:
+            DeviceLock(target, lock).release()
+            release_logging(log)
+        return
+
+    device_lock = DeviceLock(target, lock)
+    log = device_logger(logname='aeon-bootstrapper', target=target)
     try:
-        state = get_device_state(server, target)
-        if state and state not in ('ERROR', 'DONE'):
+        # a restart of this node resumes the bootstrap, see resume_bootstraps()
+        device_lock.claim(self.request.hostname)
+        if resume:
+            state = get_device_state(target, os_name)
+            if state is None or state in _ENDED_STATES:
+                log.info('Device at {} has no interrupted bootstrap to resume.'.format(target))
+                return
+            return run_bootstrap(server, os_name, target, log, ticket, resume=True, device_lock=device_lock)
+
+        # registration is atomic: only one of several concurrent runs for the
+        # same device sees it created, the others see the state it is in
+        try:
+            with device_db() as db:
+                state, created = repository.register_device(db, dict(
+                    ip_addr=target, os_name=os_name,
+                    state='REGISTERED',
+                    message='device registered, waiting for bootstrap start'))
+        except Exception as exc:
+            log.error('Unable to register device: %s' % exc)
+            return
+
+        if not created and state and state not in ('ERROR', 'DONE'):
             log.warning('Device at {} has already registered. This is likely a duplicate bootstrap run and will '
                         'be terminated.'.format(target))
             return
         if state == 'DONE':
             log.warning('Device at {} has previously successfully completed ZTP process. '
                         'ZTP process has been initiated again.'.format(target))
-        got = requests.post(
-            url='http://%s/api/devices' % server,
-            json=dict(
-                ip_addr=target, os_name=os_name,
-                state='REGISTERED',
-                message='device registered, waiting for bootstrap start'))
-
-        if not got.ok:
-            body = got.json()
-            log.error('Unable to register device: %s' % body['message'])
-            return got.status_code
-
-        rc, _stderr = do_bootstrapper(server=server, os_name=os_name, target=target, log=log)
-        if 0 != rc:
-            post_device_status(server=server,
-                               os_name=os_name, target=target,
-                               state='ERROR', message='Error running bootstrapper: {}'.format(_stderr))
-            return rc
 
-        facts = get_device_facts(server, target)
-        finally_script = facts.get('finally_script', None)
-        rc, _stderr = do_finalize(server=server, os_name=os_name, target=target, log=log, finally_script=finally_script)
-        if rc != 0:
-            post_device_status(server=server,
-                               os_name=os_name,
-                               target=target,
-                               state='ERROR',
-                               message='Error running finally script: {}'.format(_stderr))
-            return rc
-
-        post_device_status(server=server,
-                           os_name=os_name, target=target,
-                           state='DONE', message='device bootstrap completed')
+        return run_bootstrap(server, os_name, target, log, ticket, device_lock=device_lock)
     finally:
-        log.handlers.pop()
+        ticket.release()
+        device_lock.release()
+        release_logging(log)
+
+
+def run_bootstrap(server, os_name, target, log, ticket, resume=False, device_lock=None):
+    """ Runs the bootstrapper of a registered device, then finish_bootstrap();
+    in the 'engine' mode the engine finishes the bootstrap later on, and
+    releases the admission ticket and device lock then.
+    """
+    if _AEON_BOOTSTRAP_MODE == 'engine' and os_name in BOOTSTRAPPERS:
+        log.info("handing bootstrap over to the bootstrap engine[pid={pid}]".format(pid=os.getpid()))
+        cmd_args = bootstrapper_args(server, target, resume=resume and os_name in RESUMABLE)
+        bootstrap_engine().submit(os_name, target, cmd_args,
+                                  callback=partial(finish_engine_bootstrap, server, os_name, target,
+                                                   ticket=ticket.transfer(),
+                                                   device_lock=device_lock.transfer() if device_lock else None))
+        return 0
+
+    rc, _stderr = do_bootstrapper(server=server, os_name=os_name, target=target, log=log, resume=resume)
+    return finish_bootstrap(server, os_name, target, log, rc, _stderr)
+
+
+def finish_bootstrap(server, os_name, target, log, rc, _stderr):
+    """ Runs the finally script after a successful bootstrap and posts the
+    final device status.
+
+    Returns:
+        int: 0, or the exit code of the bootstrapper or finally script that failed
+    """
+    if 0 != rc:
+        post_device_status(os_name=os_name, target=target,
+                           state='ERROR', message='Error running bootstrapper: {}'.format(_stderr))
+        return rc
+
+    facts = get_device_facts(target, os_name)
+    finally_script = facts.get('finally_script', None)
+    rc, _stderr = do_finalize(server=server, os_name=os_name, target=target, log=log, finally_script=finally_script)
+    if rc != 0:
+        post_device_status(os_name=os_name,
+                           target=target,
+                           state='ERROR',
+                           message='Error running finally script: {}'.format(_stderr))
+        return rc
+
+    post_device_status(os_name=os_name, target=target,
+                       state='DONE', message='device bootstrap completed')
     return rc
 
 
+def finish_engine_bootstrap(server, os_name, target, rc, _stderr, ticket=None, device_lock=None):
+    log = device_logger(logname='aeon-bootstrapper', target=target)
+    try:
+        log.info("bootstrapper complete: rc={}".format(rc))
+        if len(_stderr):
+            log.error("stderr={}".format(_stderr))
+        return finish_bootstrap(server, os_name, target, log, rc, _stderr)
+    finally:
+        if ticket is not None:
+            ticket.release()
+        if device_lock is not None:
+            device_lock.release()
+        release_logging(log)
+
+
 @celery.task
 def ztp_finalizer(os_name, target):
     server = "{}:{}".format(get_server_ipaddr(target), _AEON_PORT)
-    facts = get_device_facts(server, target)
+    facts = get_device_facts(target, os_name)
     finally_script = facts.get('finally_script', None)
 
-    log = setup_logging(logname='aeon-finalizer', target=target)
+    log = device_logger(logname='aeon-finalizer', target=target)
 
     try:
         rc, _stderr = do_finalize(server=server, os_name=os_name, target=target, log=log, finally_script=finally_script)
         if 0 != rc:
-            post_device_status(server=server,
-                               os_name=os_name, target=target,
+            post_device_status(os_name=os_name, target=target,
                                state='ERROR', message='Error running finally script: {}'.format(_stderr))
             return rc, _stderr
     finally:
-        log.handlers.pop()
+        release_logging(log)
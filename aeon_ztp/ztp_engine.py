@@ -0,0 +1,230 @@
+# Copyright 2014-present, Apstra, Inc. All rights reserved.
+#
+# This source code is licensed under End User License Agreement found in the
+# LICENSE file at http://www.apstra.com/community/eula
+#
+# Bootstrap engine: runs many bootstraps concurrently in a single process.
+#
+# Each bootstrapper describes its run as a generator, bootstrap_steps(), that
+# talks to the device between its yields and yields the number of seconds to
+# wait before it goes on.  The bootstrapper main() sleeps on those waits.  The
+# engine runs the device work on a small pool of threads and waits on tornado
+# IOLoop timers instead, so a bootstrap only holds a thread while the device
+# is being talked to.  Most of a bootstrap is spent waiting for the device to
+# come up, so one process can supervise many more bootstraps than it has
+# threads.
+
+import logging
+import sys
+import threading
+import traceback
+from Queue import Queue
+from importlib import import_module
+
+from tornado import gen
+from tornado.concurrent import Future
+from tornado.ioloop import IOLoop
+
+# os_name: bootstrapper module run in-process, by the celery worker or the engine
+BOOTSTRAPPERS = {
+    'centos': 'aeon_ztp.bin.centos_bootstrap',
+    'cumulus': 'aeon_ztp.bin.cumulus_bootstrap',
+    'eos': 'aeon_ztp.bin.eos_bootstrap',
+    'nxos': 'aeon_ztp.bin.nxos_bootstrap',
+    'rtbrick': 'aeon_ztp.bin.rtbrick_bootstrap',
+    'ubuntu': 'aeon_ztp.bin.ubuntu_bootstrap',
+}
+
+
+class BootstrapExit(Exception):
+    """ SystemExit raised by a bootstrapper on a pool thread; tornado only
+    hands Exception subclasses back to the coroutine.
+    """
+    def __init__(self, code):
+        super(BootstrapExit, self).__init__(code)
+        self.code = code
+
+
+def exit_status(exc):
+    """ Returns:
+        tuple: (exit code, error text) of the SystemExit, or BootstrapExit,
+        raised by a bootstrapper
+    """
+    if exc.code is None or isinstance(exc.code, int):
+        return exc.code or 0, ''
+    return 1, str(exc.code)
+
+
+def release_logging(log):
+    """ Closes the handlers a bootstrap added to its logger.
+    """
+    for handler in log.handlers[:]:
+        log.removeHandler(handler)
+        handler.close()
+
+
+def _call(fn, *args):
+    try:
+        return fn(*args)
+    except SystemExit as exc:
+        raise BootstrapExit(exc.code)
+
+
+def _next_step(steps):
+    # StopIteration must not reach the engine coroutine, it would end it
+    try:
+        return True, _call(next, steps)
+    except StopIteration:
+        return False, None
+
+
+class ThreadPool(object):
+    """ Runs blocking calls on a fixed number of threads and hands the results
+    back to an IOLoop.
+
+    Attributes:
+        size (int): Number of threads
+        io_loop (IOLoop): Loop the returned futures are resolved on
+    """
+    def __init__(self, size, io_loop):
+        self.size = size
+        self.io_loop = io_loop
+        self._queue = Queue()
+        self._threads = []
+        self._lock = threading.Lock()
+
+    def submit(self, fn, *args):
+        """ Returns:
+            Future: resolved with the result of fn(*args), or what it raised
+        """
+        with self._lock:
+            if not self._threads:
+                for idx in range(self.size):
+                    thread = threading.Thread(target=self._work, name='bootstrap-pool-%d' % idx)
+                    thread.daemon = True
+                    thread.start()
+                    self._threads.append(thread)
+
+        future = Future()
+        self._queue.put((future, fn, args))
+        return future
+
+    def shutdown(self):
+        with self._lock:
+            threads, self._threads = self._threads, []
+        for _ in threads:
+            self._queue.put(None)
+        for thread in threads:
+            thread.join()
+
+    def _work(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            future, fn, args = item
+            try:
+                result = fn(*args)
+            except Exception:
+                self.io_loop.add_callback(future.set_exc_info, sys.exc_info())
+            else:
+                self.io_loop.add_callback(future.set_result, result)
+
+
+class BootstrapEngine(object):
+    """ Runs bootstraps as tornado coroutines.
+
+    Attributes:
+        io_loop (IOLoop): Loop the bootstraps run on
+        pool (ThreadPool): Threads doing the device work of the bootstraps
+        running (dict): target: os_name of the bootstraps in progress
+    """
+    def __init__(self, workers=16, io_loop=None):
+        self.io_loop = io_loop or IOLoop()
+        self.pool = ThreadPool(workers, self.io_loop)
+        self.running = {}
+        self._thread = None
+        self._idle = threading.Condition()
+
+    @gen.coroutine
+    def bootstrap(self, os_name, cmd_args):
+        """ Runs the bootstrapper of an os_name.
+
+        Args:
+            os_name (str): Key of BOOTSTRAPPERS
+            cmd_args (list): Bootstrapper command line arguments
+
+        Returns:
+            tuple: (exit code, error text); the error text is the traceback
+            of an unexpected exception, or an empty string
+        """
+        boot = None
+        try:
+            module = import_module(BOOTSTRAPPERS[os_name])
+            boot = yield self.pool.submit(_call, module.create_bootstrapper, cmd_args)
+            steps = boot.bootstrap_steps()
+            while True:
+                more, delay = yield self.pool.submit(_next_step, steps)
+                if not more:
+                    break
+                yield gen.sleep(delay)
+            rc, _stderr = 0, ''
+        except BootstrapExit as exc:
+            rc, _stderr = exit_status(exc)
+        except Exception:
+            rc, _stderr = 1, traceback.format_exc()
+        finally:
+            if boot is not None:
+                release_logging(boot.log)
+
+        raise gen.Return((rc, _stderr))
+
+    def start(self):
+        """ Runs the IOLoop in a background thread.
+        """
+        if self._thread is None:
+            self._thread = threading.Thread(target=self.io_loop.start, name='bootstrap-engine')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def submit(self, os_name, target, cmd_args, callback=None):
+        """ Starts a bootstrap, may be called from any thread.
+
+        Args:
+            os_name (str): Key of BOOTSTRAPPERS
+            target (str): Device ip_addr
+            cmd_args (list): Bootstrapper command line arguments
+            callback (callable): Called with the exit code and error text when
+                                 the bootstrap ends, on a pool thread
+        """
+        with self._idle:
+            self.running[target] = os_name
+        self.start()
+        self.io_loop.add_callback(self._run, os_name, target, cmd_args, callback)
+
+    def join(self, timeout=None):
+        """ Waits for the running bootstraps to end.
+
+        Returns:
+            bool: True if no bootstrap is running
+        """
+        with self._idle:
+            while self.running:
+                self._idle.wait(timeout)
+                if timeout is not None:
+                    break
+            return not self.running
+
+    @gen.coroutine
+    def _run(self, os_name, target, cmd_args, callback):
+        try:
+            rc, _stderr = yield self.bootstrap(os_name, cmd_args)
+            if callback:
+                yield self.pool.submit(callback, rc, _stderr)
+        except Exception:
+            logging.getLogger('aeon-engine').exception('bootstrap of %s failed', target)
+        finally:
+            with self._idle:
+                self.running.pop(target, None)
+                if not self.running:
+                    self._idle.notify_all()
@@ -0,0 +1,283 @@
+# Copyright 2014-present, Apstra, Inc. All rights reserved.
+#
+# This source code is licensed under End User License Agreement found in the
+# LICENSE file at http://www.apstra.com/community/eula
+#
+# Log pipeline of the bootstrappers and celery tasks.
+#
+# Each bootstrap logs to a logger of its own, eg: 'eos-bootstrap.10.1.2.3',
+# whose handler only puts the records on an in-memory queue.  A listener
+# thread of the process formats them as JSON, tagged with the target and the
+# bootstrap phase, and writes them to syslog and to the log file of the
+# device.  A bootstrap never waits on a log write: a record that finds the
+# queue full is dropped, and counted.
+
+import atexit
+import errno
+import json
+import logging
+import logging.handlers
+import os
+import socket
+import threading
+from collections import OrderedDict
+from datetime import datetime
+from Queue import Full, Queue
+
+_AEON_DEVICE_LOG_DIR = os.getenv('AEON_DEVICE_LOG_DIR')
+_AEON_LOG_QUEUE_SIZE = int(os.getenv('AEON_LOG_QUEUE_SIZE', 10000))
+
+_SYSLOG_ADDRESS = '/dev/log'
+
+# put on the queue to stop the listener
+_STOP = object()
+
+
+class JsonFormatter(logging.Formatter):
+    """ Formats a record as a JSON object of its time, level, program,
+    target, phase and message; the syslog lines are prefixed with the program
+    so they can still be told apart in the syslog file.
+    """
+    def __init__(self, syslog=False):
+        super(JsonFormatter, self).__init__()
+        self.syslog = syslog
+
+    def format(self, record):
+        program = getattr(record, 'program', record.name)
+        item = dict(
+            time=datetime.utcfromtimestamp(record.created).isoformat() + 'Z',
+            level=record.levelname,
+            program=program,
+            target=getattr(record, 'target', None),
+            phase=getattr(record, 'phase', None),
+            message=record.getMessage())
+        if record.exc_info:
+            item['exc'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            item['exc'] = record.exc_text
+
+        text = json.dumps(item, sort_keys=True)
+        return '{}: {}'.format(program, text) if self.syslog else text
+
+
+class BootstrapContext(logging.Filter):
+    """ Tags the records of a bootstrap with its program and target, and with
+    the phase it is in when the record is logged.
+
+    Attributes:
+        program (str): eg: 'eos-bootstrap'
+        target (str): IP address of the device
+        timer (PhaseTimer): Phases of the bootstrap, or None
+    """
+    def __init__(self, program, target, timer=None):
+        super(BootstrapContext, self).__init__()
+        self.program = program
+        self.target = target
+        self.timer = timer
+
+    def filter(self, record):
+        record.program = self.program
+        record.target = self.target
+        record.phase = self.timer.current() if self.timer is not None else None
+        return True
+
+
+class PipelineHandler(logging.Handler):
+    """ Hands the records over to a LogPipeline, without waiting.
+    """
+    def __init__(self, pipeline):
+        super(PipelineHandler, self).__init__()
+        self.pipeline = pipeline
+
+    def prepare(self, record):
+        # the message and traceback are rendered now, the listener may only
+        # see the record after its arguments have changed
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def emit(self, record):
+        try:
+            self.pipeline.put(self.prepare(record))
+        except Exception:
+            self.handleError(record)
+
+
+def device_log_path(directory, target):
+    """ Returns:
+        str: path of the log file of the target device in directory
+
+    Raises:
+        ValueError: target is not a plain file name
+    """
+    if not target or target.startswith('.') or os.path.basename(target) != target:
+        raise ValueError('invalid target: {}'.format(target))
+    return os.path.join(directory, '{}.log'.format(target))
+
+
+class DeviceLogHandler(logging.Handler):
+    """ Writes the records of each target to its own file, <directory>/<target>.log.
+    The files of the targets last logged to are kept open.
+
+    Attributes:
+        directory (str): Where the device log files are kept
+        max_open (int): Files kept open at most
+    """
+    def __init__(self, directory, max_open=64):
+        super(DeviceLogHandler, self).__init__()
+        self.directory = directory
+        self.max_open = max_open
+        self._streams = OrderedDict()
+
+    def emit(self, record):
+        target = getattr(record, 'target', None)
+        if not target:
+            return
+        try:
+            stream = self._stream(target)
+            stream.write(self.format(record) + '\n')
+            stream.flush()
+        except Exception:
+            self.handleError(record)
+
+    def _stream(self, target):
+        stream = self._streams.pop(target, None)
+        if stream is None:
+            if not os.path.isdir(self.directory):
+                try:
+                    os.makedirs(self.directory)
+                except OSError as exc:
+                    if exc.errno != errno.EEXIST:
+                        raise
+            stream = open(device_log_path(self.directory, target), 'a')
+            while len(self._streams) >= self.max_open:
+                self._streams.popitem(last=False)[1].close()
+        self._streams[target] = stream
+        return stream
+
+    def close(self):
+        while self._streams:
+            self._streams.popitem()[1].close()
+        super(DeviceLogHandler, self).close()
+
+
+class LogPipeline(object):
+    """ Queue and listener thread writing the bootstrap records to the sinks:
+    syslog, and the device log files if device_log_dir is set.  The listener
+    is started by the first record a process logs, so each of the forked
+    worker processes runs its own.
+
+    Attributes:
+        maxsize (int): Records queued at most
+        device_log_dir (str): Where the device log files are kept, or None
+        syslog_address (str): Syslog socket, or None
+        dropped (int): Records dropped since the queue was full
+    """
+    def __init__(self, maxsize=_AEON_LOG_QUEUE_SIZE, device_log_dir=_AEON_DEVICE_LOG_DIR,
+                 syslog_address=_SYSLOG_ADDRESS):
+        self.maxsize = maxsize
+        self.device_log_dir = device_log_dir
+        self.syslog_address = syslog_address
+        self.dropped = 0
+        self.handlers = []
+        self._queue = None
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def sinks(self):
+        """ Returns:
+            list: logging.Handler the records are written to
+        """
+        handlers = []
+        if self.syslog_address:
+            try:
+                handler = logging.handlers.SysLogHandler(address=self.syslog_address)
+            except socket.error:
+                handler = None
+            if handler is not None:
+                handler.setFormatter(JsonFormatter(syslog=True))
+                handlers.append(handler)
+        if self.device_log_dir:
+            handler = DeviceLogHandler(self.device_log_dir)
+            handler.setFormatter(JsonFormatter())
+            handlers.append(handler)
+        return handlers
+
+    def start(self):
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._queue = Queue(self.maxsize)
+            self.handlers = self.sinks()
+            self._thread = threading.Thread(target=self._listen, args=(self._queue, self.handlers),
+                                            name='aeon-log-pipeline')
+            self._thread.daemon = True
+            self._thread.start()
+            self._pid = os.getpid()
+
+    def put(self, record):
+        """ Queues a record, unless the queue is full.
+
+        Returns:
+            bool: True if the record was queued
+        """
+        self.start()
+        try:
+            self._queue.put_nowait(record)
+        except Full:
+            self.dropped += 1
+            return False
+        return True
+
+    def stop(self, timeout=5):
+        """ Writes out the queued records, then stops the listener and closes the sinks.
+        """
+        with self._lock:
+            if self._pid != os.getpid():
+                return
+            self._pid = None
+            try:
+                self._queue.put(_STOP, timeout=timeout)
+            except Full:
+                pass
+            self._thread.join(timeout)
+            for handler in self.handlers:
+                handler.close()
+            self.handlers = []
+
+    @staticmethod
+    def _listen(queue, handlers):
+        while True:
+            record = queue.get()
+            if record is _STOP:
+                return
+            for handler in handlers:
+                if record.levelno >= handler.level:
+                    handler.handle(record)
+
+
+pipeline = LogPipeline()
+atexit.register(pipeline.stop)
+
+
+def device_logger(logname, target, timer=None):
+    """ Returns the logger of a bootstrap, or of a celery task, of the target
+    device; its records go through the log pipeline.  The handler is removed
+    with ztp_engine.release_logging() when the bootstrap ends.
+
+    Args:
+        logname (str): Program name, eg: 'eos-bootstrap'
+        target (str): IP address of the device
+        timer (PhaseTimer): Phases the records are tagged with, or None
+    """
+    # one logger per target, a process may bootstrap several devices at once
+    log = logging.getLogger(name='{}.{}'.format(logname, target))
+    log.setLevel(logging.INFO)
+    handler = PipelineHandler(pipeline)
+    handler.addFilter(BootstrapContext(logname, target, timer))
+    log.addHandler(handler)
+    return log
@@ -0,0 +1,328 @@
+# Copyright 2014-present, Apstra, Inc. All rights reserved.
+#
+# This source code is licensed under End User License Agreement found in the
+# LICENSE file at http://www.apstra.com/community/eula
+#
+# Lightweight in-process metrics exposed in the Prometheus text format by
+# GET /api/metrics.
+#
+# The API runs in several uwsgi worker processes and the celery tasks run in
+# the celery worker processes.  When AEON_METRICS_DIR is set every process
+# writes a snapshot of its metrics to that directory, at most once per
+# flush interval, and collect() adds up the snapshots of all processes.
+#
+# A snapshot file is named after the pid and start time of its process, so a
+# reused pid gets a file of its own.  collect() folds the counters of the
+# processes that have ended into retired.json, and removes their files, so
+# that the totals never go backwards.
+
+import errno
+import fcntl
+import json
+import os
+import threading
+import time
+from bisect import bisect_left
+
+_AEON_METRICS_DIR = os.getenv('AEON_METRICS_DIR')
+
+LATENCY_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+TASK_BUCKETS = (1, 10, 30, 60, 120, 300, 600, 900, 1200, 1800, 2700, 3600)
+
+# name: (type, help, histogram buckets)
+METRICS = {
+    'aeon_ztp_http_requests_total': (
+        'counter', 'HTTP requests handled by the API', None),
+    'aeon_ztp_http_request_duration_seconds': (
+        'histogram', 'API request latency', LATENCY_BUCKETS),
+    'aeon_ztp_image_bytes_served_total': (
+        'counter', 'Bytes of vendor images and downloads served', None),
+    'aeon_ztp_db_commit_duration_seconds': (
+        'histogram', 'Database commit latency', LATENCY_BUCKETS),
+    'aeon_ztp_device_cache_lookups_total': (
+        'counter', 'Device cache lookups by result, hit or miss', None),
+    'aeon_ztp_celery_tasks_total': (
+        'counter', 'Celery tasks run', None),
+    'aeon_ztp_celery_task_duration_seconds': (
+        'histogram', 'Celery task run time', TASK_BUCKETS),
+    'aeon_ztp_celery_queue_depth': (
+        'gauge', 'Messages waiting in the celery queue', None),
+    'aeon_ztp_bootstraps_in_flight': (
+        'gauge', 'Devices with a bootstrap in progress', None),
+}
+
+
+RETIRED_FILE = 'retired.json'
+
+
+def _key(name, labels):
+    return name, tuple(sorted((labels or {}).items()))
+
+
+def process_start(pid):
+    """ Returns:
+        int: start time of the pid process, in clock ticks since boot, or
+        None if there is no such process or it cannot be told
+    """
+    try:
+        with open('/proc/%d/stat' % pid) as f:
+            stat = f.read()
+    except (IOError, OSError):
+        return None
+    # the fields after the command name, which may contain spaces
+    return int(stat.rsplit(')', 1)[1].split()[19])
+
+
+def process_alive(pid, start=None):
+    """ Returns:
+        bool: True if the pid process runs, and started at start if given
+    """
+    if start:
+        return process_start(pid) == start
+    try:
+        os.kill(pid, 0)
+    except OSError as exc:
+        return exc.errno == errno.EPERM
+    return True
+
+
+def snapshot_process(fname):
+    """ Returns:
+        tuple: (pid, start time or None) of a '<pid>-<start>.json' or
+        '<pid>.json' snapshot file name, or None for other file names
+    """
+    parts = fname[:-len('.json')].split('-')
+    try:
+        return int(parts[0]), int(parts[1]) if len(parts) > 1 else None
+    except ValueError:
+        return None
+
+
+def merge(merged, entries, gauges=True):
+    """ Adds up snapshot entries into merged, a dict of (name, labels): value.
+    """
+    for name, labels, value in entries:
+        if not gauges and METRICS.get(name, ('gauge',))[0] == 'gauge':
+            continue
+        key = _key(name, labels)
+        if key not in merged:
+            merged[key] = value
+        elif isinstance(value, dict):
+            total = merged[key]
+            total['buckets'] = [a + b for a, b in zip(total['buckets'], value['buckets'])]
+            total['sum'] += value['sum']
+            total['count'] += value['count']
+        else:
+            merged[key] += value
+    return merged
+
+
+class Metrics(object):
+    """ Counters and histograms of a single process.
+
+    Attributes:
+        directory (str): Where the process snapshots are shared, or None to
+                         only report the metrics of this process
+        flush_interval (float): Minimum number of seconds between snapshots
+    """
+    def __init__(self, directory=None, flush_interval=1.0):
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._start = process_start(self._pid)
+        self._values = {}
+        self._flushed = 0
+        self._timer = None
+
+    def inc(self, name, labels=None, value=1):
+        """ Adds value to a counter.
+        """
+        with self._lock:
+            self._check_fork()
+            key = _key(name, labels)
+            self._values[key] = self._values.get(key, 0) + value
+        self._schedule_flush()
+
+    def observe(self, name, value, labels=None):
+        """ Records a value in a histogram.
+        """
+        buckets = METRICS[name][2]
+        with self._lock:
+            self._check_fork()
+            key = _key(name, labels)
+            hist = self._values.get(key)
+            if hist is None:
+                hist = self._values[key] = dict(buckets=[0] * len(buckets), sum=0.0, count=0)
+            idx = bisect_left(buckets, value)
+            if idx < len(buckets):
+                hist['buckets'][idx] += 1
+            hist['sum'] += value
+            hist['count'] += 1
+        self._schedule_flush()
+
+    def snapshot(self):
+        """ Returns:
+            list: [name, labels, value] entries; histogram values are dicts of
+            per-bucket (not cumulative) counts, sum and count
+        """
+        with self._lock:
+            self._check_fork()
+            return [[name, dict(labels), json.loads(json.dumps(value))]
+                    for (name, labels), value in self._values.items()]
+
+    def flush(self):
+        """ Writes the snapshot of this process to the metrics directory.
+        """
+        with self._lock:
+            self._timer = None
+            self._flushed = time.time()
+        if not self.directory:
+            return
+
+        try:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            fpath = os.path.join(self.directory, self.snapshot_name())
+            with open(fpath + '.tmp', 'w') as f:
+                json.dump(self.snapshot(), f)
+            os.rename(fpath + '.tmp', fpath)
+        except (IOError, OSError):
+            pass
+
+    def snapshot_name(self):
+        """ Returns:
+            str: name of the snapshot file of this process
+        """
+        with self._lock:
+            self._check_fork()
+            if self._start is None:
+                return '%d.json' % self._pid
+            return '%d-%d.json' % (self._pid, self._start)
+
+    def collect(self):
+        """ Returns:
+            list: snapshot entries of all processes, added up by name and
+            labels, including the counters of the processes that have ended
+        """
+        if not self.directory:
+            return self.snapshot()
+
+        self.flush()
+        try:
+            merged = self.retire()
+            fnames = [fname for fname in os.listdir(self.directory) if fname.endswith('.json')]
+        except (IOError, OSError):
+            merged, fnames = {}, []
+
+        for fname in fnames:
+            if snapshot_process(fname) is None:
+                continue
+            try:
+                with open(os.path.join(self.directory, fname)) as f:
+                    merge(merged, json.load(f))
+            except (IOError, OSError, ValueError):
+                continue
+
+        return [[name, dict(labels), value] for (name, labels), value in merged.items()]
+
+    def retire(self):
+        """ Folds the counters and histograms of the snapshot files of the
+        processes that have ended into the retired file, and removes them.
+
+        Returns:
+            dict: (name, labels): value of the retired file
+        """
+        # one process at a time, or the dead snapshots could be counted twice
+        with open(os.path.join(self.directory, '.retire.lock'), 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            retired_path = os.path.join(self.directory, RETIRED_FILE)
+            try:
+                with open(retired_path) as f:
+                    retired = merge({}, json.load(f))
+            except (IOError, OSError, ValueError):
+                retired = {}
+
+            dead = []
+            for fname in os.listdir(self.directory):
+                proc = snapshot_process(fname) if fname.endswith('.json') else None
+                if proc is None or process_alive(*proc):
+                    continue
+                try:
+                    with open(os.path.join(self.directory, fname)) as f:
+                        merge(retired, json.load(f), gauges=False)
+                except ValueError:
+                    pass
+                dead.append(fname)
+
+            if dead:
+                entries = [[name, dict(labels), value] for (name, labels), value in retired.items()]
+                with open(retired_path + '.tmp', 'w') as f:
+                    json.dump(entries, f)
+                os.rename(retired_path + '.tmp', retired_path)
+                for fname in dead:
+                    os.remove(os.path.join(self.directory, fname))
+        return retired
+
+    def _check_fork(self):
+        # celery forks its pool processes, they start from zero
+        if self._pid != os.getpid():
+            self._reset()
+
+    def _schedule_flush(self):
+        if not self.directory:
+            return
+        with self._lock:
+            if self._timer is not None:
+                return
+            delay = max(0, self._flushed + self.flush_interval - time.time())
+            self._timer = threading.Timer(delay, self.flush)
+            self._timer.daemon = True
+        self._timer.start()
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    items = ('%s="%s"' % (key, str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n'))
+             for key, value in sorted(labels.items()))
+    return '{%s}' % ','.join(items)
+
+
+def exposition(entries):
+    """ Formats metrics in the Prometheus text format.
+
+    Args:
+        entries (list): [name, labels, value] entries, see Metrics.snapshot()
+
+    Returns:
+        str: Text exposition, metrics without any entry are left out
+    """
+    by_name = {}
+    for name, labels, value in entries:
+        by_name.setdefault(name, []).append((labels, value))
+
+    lines = []
+    for name in sorted(by_name):
+        mtype, mhelp, buckets = METRICS[name]
+        lines.append('# HELP %s %s' % (name, mhelp))
+        lines.append('# TYPE %s %s' % (name, mtype))
+        for labels, value in sorted(by_name[name], key=lambda item: sorted(item[0].items())):
+            if mtype != 'histogram':
+                lines.append('%s%s %s' % (name, _format_labels(labels), value))
+                continue
+            cumulative = 0
+            for bound, count in zip(buckets, value['buckets']):
+                cumulative += count
+                lines.append('%s_bucket%s %d' % (name, _format_labels(dict(labels, le=repr(float(bound)))), cumulative))
+            lines.append('%s_bucket%s %d' % (name, _format_labels(dict(labels, le='+Inf')), value['count']))
+            lines.append('%s_sum%s %s' % (name, _format_labels(labels), value['sum']))
+            lines.append('%s_count%s %d' % (name, _format_labels(labels), value['count']))
+
+    return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics(_AEON_METRICS_DIR)
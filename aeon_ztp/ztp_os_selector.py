@@ -5,11 +5,19 @@
 # LICENSE file at http://www.apstra.com/community/eula
 
 
+import json
 import os
+import re
+import threading
+from collections import Counter, defaultdict, namedtuple
+
 import yaml
 
 _AEON_TOPDIR = os.getenv('AEON_TOPDIR')
 
+# the os-selector.cfg group a device matches, and its settings
+item_match = namedtuple('item_match', ['hw_match', 'data'])
+
 
 def vendor_list():
     """ Returns a list of software currently supported by Aeon-ZTP server by name.
@@ -60,9 +68,15 @@ def get(vendor):
     Returns:
         dict: Dictionary representation of specified OS-selector configuration file for the specified vendor (eg: eos)
 
+    Raises:
+        IOError: Raised if the file cannot be loaded
+
     """
     filename = os.path.join(_AEON_TOPDIR, 'etc/profiles/{vendor}/os-selector.cfg'.format(vendor=vendor))
-    return load_yaml(filename)
+    try:
+        return selectors.get(filename).cfg_data
+    except SelectorError as exc:
+        raise IOError(str(exc))
 
 
 class Vendor:
@@ -93,3 +107,430 @@ class Vendor:
         except IOError:
             self.check_firmware = False
             self.default_image = "Missing Config"
+
+
+# ##### -----------------------------------------------------------------------
+# #####
+# #####                           OS selection
+# #####
+# ##### -----------------------------------------------------------------------
+
+
+class SelectorError(Exception):
+    """ An OS selection failure, reported in the results as error_type and
+    error_message.
+    """
+    error_type = 'args'
+
+    def results(self):
+        return dict(ok=False, error_type=self.error_type, error_message=str(self))
+
+
+class CfgLoadError(SelectorError):
+    pass
+
+
+class HwNoMatchError(SelectorError):
+    error_type = 'hw_match'
+
+    def __init__(self, message='no matching hw_model value'):
+        super(HwNoMatchError, self).__init__(message)
+
+
+class HwMultiMatchError(SelectorError):
+    error_type = 'hw_match'
+
+
+class CfgError(SelectorError):
+    error_type = 'cfg_error'
+
+
+def load_cfg(filepath):
+    """ Loads an os-selector.cfg file.
+
+    Returns:
+        dict: group name: group settings
+
+    Raises:
+        CfgLoadError: the file cannot be read, or is not valid YAML
+    """
+    try:
+        with open(filepath) as f:
+            return yaml.safe_load(f)
+    except IOError:
+        raise CfgLoadError('Unable to load file: %s' % filepath)
+    except yaml.YAMLError as e:
+        raise CfgLoadError('YAML syntax error in file: {filepath}, {e}'.format(filepath=filepath, e=e))
+
+
+def as_list(values):
+    return values if isinstance(values, list) else [values]
+
+
+def group_matches(name, group_data):
+    """ Returns:
+        dict: fact key: listed values, of the matches of a group
+
+    Raises:
+        CfgError: the group has no matches
+    """
+    matches = group_data.get('matches')
+    if not isinstance(matches, dict):
+        raise CfgError('Expecting matches in group: {}'.format(name))
+    return matches
+
+
+def matched_group(cfg_data, matches):
+    """ Returns:
+        item_match: of the only group name in matches, or of the 'default'
+        group if there is none
+
+    Raises:
+        HwNoMatchError: matches is empty and there is no 'default' group
+        HwMultiMatchError: matches has more than one group name
+    """
+    if not matches:
+        if 'default' in cfg_data:
+            return item_match('default', cfg_data['default'])
+        raise HwNoMatchError()
+    if len(matches) > 1:
+        raise HwMultiMatchError('matches multiple os-selector groups: {}'.format(matches))
+    return item_match(matches[0], cfg_data[matches[0]])
+
+
+def match_hw_model(dev_data, cfg_data):
+    """ Finds the os-selector.cfg group whose matches all match the device
+    facts, or the 'default' group.  A fact matches if it equals one of the
+    listed values.
+
+    This is a single pass over cfg_data, for one-off selections; to select
+    many devices, compile the file once with Selector(cfg_data), or use the
+    cached Selector of an os-selector.cfg file, selectors.get(filepath).
+
+    Returns:
+        item_match: (group name, group settings)
+
+    Raises:
+        HwNoMatchError: no group matches and there is no 'default' group
+        HwMultiMatchError: more than one group matches
+    """
+    cfg_data = cfg_data or {}
+    matches = []
+    for name, data in cfg_data.iteritems():
+        if name == 'default':
+            continue
+        facts = group_matches(name, data)
+        if all(key in dev_data and str(dev_data[key]) in [str(this) for this in as_list(values)]
+               for key, values in facts.iteritems()):
+            matches.append(name)
+    return matched_group(cfg_data, matches)
+
+
+def match_os_version(dev_data, hw_match):
+    """
+    Examines the matched hw_model entry and compares
+    the expected vs. actual OS versions.  If the actual OS
+    version does match the Users intent, then return the
+    image name for the system to load.  Otherwise return False.
+    """
+    return VersionRule(hw_match).image_name(dev_data['os_version'])
+
+
+class VersionRule(object):
+    """ The compiled regex_match or exact_match of an os-selector.cfg group;
+    see match_os_version().
+
+    Attributes:
+        image (str): Image the devices not running a matching version install
+        regex (re.RegexObject): Compiled regex_match, or None
+        exact (frozenset): Lower-cased exact_match values, or None
+        error (str): Why the group has no valid rule, or None
+    """
+    def __init__(self, group_data):
+        self.image = None
+        self.regex = None
+        self.exact = None
+        self.error = None
+
+        # reported when the group is matched, the other groups still work
+        if not any(k in group_data for k in ('exact_match', 'regex_match')):
+            self.error = 'Expecting one of: {}'.format(['exact_match', 'regex_match'])
+            return
+
+        self.image = group_data.get('image')
+        if not self.image:
+            self.error = "Expecting 'image'"
+            return
+
+        match = group_data.get('regex_match')
+        if match:
+            try:
+                self.regex = re.compile(match, re.IGNORECASE)
+            except re.error as exc:
+                self.error = 'Invalid regex_match {}: {}'.format(match, exc)
+            return
+
+        exact = group_data.get('exact_match')
+        exact = exact if isinstance(exact, list) else [exact]
+        self.exact = frozenset(str(this).lower() for this in exact)
+
+    def image_name(self, os_version):
+        """ Returns:
+            str: the image to install, or False if os_version matches
+
+        Raises:
+            CfgError: the group has no valid regex_match or exact_match
+        """
+        if self.error:
+            raise CfgError(self.error)
+        os_ver = os_version.lower()
+        if self.regex is not None:
+            found = self.regex.match(os_ver)
+        else:
+            found = os_ver in self.exact
+        return False if found else self.image
+
+
+class Selector(object):
+    """ A compiled os-selector.cfg: an index of the fact values of its device
+    groups, and the version rule of each group, so that a selection does no
+    parsing and looks up each device fact once, however many groups and
+    values there are.
+
+    Attributes:
+        cfg_data (dict): Content of the os-selector.cfg file
+        groups (list): Names of the groups other than 'default', in the
+                       cfg_data order
+        sizes (list): Number of facts each of the groups matches on
+        index (dict): (fact key, value): positions in groups of the groups
+                      listing the value
+        keys (list): Fact keys the groups match on
+        rules (dict): group name: VersionRule
+    """
+    def __init__(self, cfg_data):
+        self.cfg_data = cfg_data or {}
+        self.groups = []
+        self.sizes = []
+        self.rules = {}
+
+        index = defaultdict(set)
+        for name, data in self.cfg_data.iteritems():
+            self.rules[name] = VersionRule(data)
+            if name == 'default':
+                continue
+            matches = group_matches(name, data)
+
+            pos = len(self.groups)
+            self.groups.append(name)
+            self.sizes.append(len(matches))
+            for key, values in matches.iteritems():
+                for value in as_list(values):
+                    index[(key, str(value))].add(pos)
+
+        self.index = dict((key, tuple(groups)) for key, groups in index.iteritems())
+        self.keys = sorted(set(key for key, _value in self.index))
+        # groups without any matches accept every device
+        self.match_all = [idx for idx, size in enumerate(self.sizes) if not size]
+
+    def match_hw_model(self, dev_data):
+        """ See match_hw_model().
+        """
+        # a group matches when each of its facts has one of its values
+        hits = defaultdict(int)
+        for key in self.keys:
+            if key in dev_data:
+                for pos in self.index.get((key, str(dev_data[key])), ()):
+                    hits[pos] += 1
+        found = [pos for pos, count in hits.iteritems() if count == self.sizes[pos]] + self.match_all
+        return matched_group(self.cfg_data, [self.groups[pos] for pos in sorted(found)])
+
+    def select(self, dev_data):
+        """ Selects the OS image and finally script of a device.
+
+        Args:
+            dev_data (dict): Device facts, eg: hw_model and os_version
+
+        Returns:
+            dict: ok True, image_name (False if the device already runs the
+            intended OS version) and finally (script name, or None); or ok
+            False, error_type and error_message
+        """
+        try:
+            hw_match = self.match_hw_model(dev_data)
+            sw_match = self.rules[hw_match.hw_match].image_name(dev_data['os_version'])
+        except SelectorError as exc:
+            return exc.results()
+
+        return {'ok': True, 'image_name': sw_match, 'finally': hw_match.data.get('finally')}
+
+
+class SelectorCache(object):
+    """ Selector of each os-selector.cfg file, compiled when the file is
+    first used and again once it has been modified.
+    """
+    def __init__(self):
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, filepath):
+        """ Returns:
+            Selector: of the current content of the filepath file
+
+        Raises:
+            CfgLoadError: the file cannot be read, or is not valid YAML
+        """
+        try:
+            st = os.stat(filepath)
+        except OSError:
+            raise CfgLoadError('Unable to load file: %s' % filepath)
+        version = (st.st_mtime, st.st_size, st.st_ino)
+
+        with self._lock:
+            entry = self._entries.get(filepath)
+        if entry is not None and entry[0] == version:
+            return entry[1]
+
+        selector = Selector(load_cfg(filepath))
+        with self._lock:
+            self._entries[filepath] = (version, selector)
+        return selector
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+selectors = SelectorCache()
+
+
+def select(dev_data, cfg_data):
+    """ Selects the OS image and finally script of a device, per the content
+    of an os-selector.cfg file; see Selector.select() for the results.  Like
+    match_hw_model(), this is a single pass for one-off selections.
+    """
+    try:
+        hw_match = match_hw_model(dev_data, cfg_data)
+        sw_match = match_os_version(dev_data, hw_match.data)
+    except SelectorError as exc:
+        return exc.results()
+
+    return {'ok': True, 'image_name': sw_match, 'finally': hw_match.data.get('finally')}
+
+
+def select_os(dev_data, config_file):
+    """ Selects the OS image and finally script of a device, per the
+    os-selector.cfg config_file; see Selector.select() for the results.  The
+    compiled file is reused until the file is modified.
+
+    Examples:
+        >>> select_os(dev.facts, '/opt/aeonztps/etc/profiles/eos/os-selector.cfg')
+        {'ok': True, 'image_name': 'EOS-4.16.6M.swi', 'finally': 'finally'}
+    """
+    try:
+        selector = selectors.get(config_file)
+    except SelectorError as exc:
+        return exc.results()
+    return selector.select(dev_data)
+
+
+# ##### -----------------------------------------------------------------------
+# #####
+# #####                           Fleet planning
+# #####
+# ##### -----------------------------------------------------------------------
+
+
+def profile_cfg(os_name, topdir=None):
+    """ Returns:
+        str: path of the os-selector.cfg of the os_name profile
+    """
+    return os.path.join(topdir or _AEON_TOPDIR, 'etc', 'profiles', os_name, 'os-selector.cfg')
+
+
+def device_facts(item):
+    """ Returns:
+        dict: the columns of a devices table item, eg: from GET /api/devices,
+        with the facts JSON column merged in
+    """
+    facts = dict(item)
+    column = facts.pop('facts', None)
+    if column:
+        facts.update(json.loads(column) if isinstance(column, basestring) else column)
+    return facts
+
+
+def plan_device(item, config_file=None, topdir=None):
+    """ Selects the OS of a device, as its bootstrap would, without changing anything.
+
+    Args:
+        item (dict): Devices table item; its os_name is the profile used
+        config_file (str): os-selector.cfg used instead of the one of the profile
+        topdir (str): Aeon-ZTP directory of the profiles, AEON_TOPDIR by default
+
+    Returns:
+        dict: ip_addr, os_name, hw_model and os_version of the device, and
+        the results of select_os()
+    """
+    os_name = item.get('os_name')
+    decision = dict(ip_addr=item.get('ip_addr'), os_name=os_name)
+    try:
+        facts = device_facts(item)
+        decision.update(hw_model=facts.get('hw_model'), os_version=facts.get('os_version'))
+        if not facts.get('os_version'):
+            raise ValueError('no device facts')
+        decision.update(select_os(facts, config_file or profile_cfg(os_name, topdir)))
+    except Exception as exc:
+        decision.update(ok=False, error_type='facts', error_message=str(exc))
+    return decision
+
+
+def plan_os(devices, config_file=None, topdir=None):
+    """ Yields plan_device() of each of the devices, in one pass; each
+    os-selector.cfg is compiled once.
+    """
+    for item in devices:
+        yield plan_device(item, config_file=config_file, topdir=topdir)
+
+
+class PlanSummary(object):
+    """ Aggregate counts of plan_device() decisions.
+
+    Attributes:
+        total (int): Devices planned
+        current (int): Devices already running the intended OS version
+        images (Counter): (os_name, image_name): devices installing the image
+        errors (Counter): (os_name, error_type): devices that cannot be planned
+    """
+    def __init__(self):
+        self.total = 0
+        self.current = 0
+        self.images = Counter()
+        self.errors = Counter()
+
+    def add(self, decision):
+        """ Counts a decision, and returns it.
+        """
+        self.total += 1
+        if not decision.get('ok'):
+            self.errors[(decision.get('os_name'), decision.get('error_type'))] += 1
+        elif decision.get('image_name'):
+            self.images[(decision.get('os_name'), decision['image_name'])] += 1
+        else:
+            self.current += 1
+        return decision
+
+    def report(self):
+        """ Returns:
+            dict: total, upgrade, current and error device counts, the images
+            list of os_name, image_name and count, and the errors list of
+            os_name, error_type and count
+        """
+        return dict(
+            total=self.total,
+            upgrade=sum(self.images.values()),
+            current=self.current,
+            error=sum(self.errors.values()),
+            images=[dict(os_name=os_name, image_name=image_name, count=count)
+                    for (os_name, image_name), count in sorted(self.images.items())],
+            errors=[dict(os_name=os_name, error_type=error_type, count=count)
+                    for (os_name, error_type), count in sorted(self.errors.items())])
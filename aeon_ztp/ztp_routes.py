@@ -0,0 +1,78 @@
+# Copyright 2014-present, Apstra, Inc. All rights reserved.
+#
+# This source code is licensed under End User License Agreement found in the
+# LICENSE file at http://www.apstra.com/community/eula
+#
+# Local address lookups: the address of this server as seen from a device,
+# which is the source address of the route the kernel picks towards it.
+# Devices of the same subnet are reached through the same route, so the
+# lookups are cached per subnet for a while.
+
+import os
+import socket
+import struct
+import threading
+import time
+
+_AEON_ROUTE_CACHE_TTL = int(os.getenv('AEON_ROUTE_CACHE_TTL', 300))
+_AEON_ROUTE_CACHE_PREFIX = int(os.getenv('AEON_ROUTE_CACHE_PREFIX', 24))
+
+
+def source_address(dst):
+    """ Returns:
+        str: the local address of the route towards dst
+    """
+    # connecting a UDP socket only selects the route, nothing is sent
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        sock.connect((dst, 0))
+        return sock.getsockname()[0]
+    finally:
+        sock.close()
+
+
+def subnet(dst, prefix):
+    """ Returns:
+        str: the network address of the dst/prefix subnet, eg: '10.1.2.0'
+    """
+    mask = (0xffffffff << (32 - prefix)) & 0xffffffff
+    addr = struct.unpack('!I', socket.inet_aton(dst))[0]
+    return socket.inet_ntoa(struct.pack('!I', addr & mask))
+
+
+class SourceAddressCache(object):
+    """ source_address() results, cached per destination subnet.
+
+    Attributes:
+        ttl (int): Seconds a lookup is kept, 0 to always look up
+        prefix (int): Prefix length of the subnets sharing a lookup
+    """
+    def __init__(self, ttl=_AEON_ROUTE_CACHE_TTL, prefix=_AEON_ROUTE_CACHE_PREFIX):
+        self.ttl = ttl
+        self.prefix = prefix
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, dst):
+        """ Returns:
+            str: the local address of the route towards dst
+        """
+        key = subnet(dst, self.prefix)
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry is not None and entry[1] > now:
+            return entry[0]
+
+        addr = source_address(dst)
+        if self.ttl:
+            with self._lock:
+                self._entries[key] = (addr, now + self.ttl)
+        return addr
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+server_addresses = SourceAddressCache()
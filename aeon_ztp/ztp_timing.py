@@ -0,0 +1,97 @@
+# Copyright 2014-present, Apstra, Inc. All rights reserved.
+#
+# This source code is licensed under End User License Agreement found in the
+# LICENSE file at http://www.apstra.com/community/eula
+#
+# Phase timing used by the bootstrappers.  The recorded phases are sent to
+# the Aeon-ZTP server along with the final device status.
+
+import functools
+import inspect
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+
+class PhaseTimer(object):
+    """ Records how long each bootstrap phase takes.
+
+    Phases may be nested, eg: the 'reboot' phase includes a 'wait-for-device'
+    phase, and each one is reported separately.
+
+    Attributes:
+        phases (list): Completed phases, in the order they ended
+    """
+    def __init__(self):
+        self.phases = []
+        self._open = []
+
+    @contextmanager
+    def phase(self, name):
+        """ Times the enclosed block as the named phase.  A phase that raises,
+        including sys.exit() from exit_results(), is recorded as not ok.
+        """
+        span = self.start(name)
+        try:
+            yield span
+        except BaseException:
+            self.stop(span, ok=False)
+            raise
+        self.stop(span)
+
+    def start(self, name):
+        span = dict(phase=name, started_at=datetime.utcnow().isoformat(), _started=time.time())
+        self._open.append(span)
+        return span
+
+    def stop(self, span, ok=True):
+        open_ids = [id(item) for item in self._open]
+        if id(span) not in open_ids:
+            return
+        del self._open[open_ids.index(id(span))]
+        span['duration'] = round(time.time() - span.pop('_started'), 3)
+        span['ok'] = ok
+        self.phases.append(span)
+
+    def current(self):
+        """ Returns:
+            str: name of the innermost phase in progress, or None
+        """
+        return self._open[-1]['phase'] if self._open else None
+
+    def close(self, ok=True):
+        """ Stops all of the open phases, innermost first.  Called before the
+        final status is sent, since exit_results() ends the process from
+        within the phase that failed.
+        """
+        for span in reversed(self._open[:]):
+            self.stop(span, ok=ok)
+
+    def report(self):
+        """ Returns:
+            list: dicts of phase, started_at (UTC ISO-8601), duration (seconds) and ok
+        """
+        return list(self.phases)
+
+
+def timed(name):
+    """ Decorator that times a bootstrapper method as the named phase, using
+    the PhaseTimer in the 'timer' attribute of the bootstrapper.  The phase of
+    a generator method lasts until the generator is exhausted, including the
+    waits it yields.
+    """
+    def decorator(method):
+        if inspect.isgeneratorfunction(method):
+            @functools.wraps(method)
+            def steps(self, *args, **kwargs):
+                with self.timer.phase(name):
+                    for delay in method(self, *args, **kwargs):
+                        yield delay
+            return steps
+
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            with self.timer.phase(name):
+                return method(self, *args, **kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,285 @@
+#!/usr/bin/env python
+# Copyright 2014-present, Apstra, Inc. All rights reserved.
+#
+# This source code is licensed under End User License Agreement found in the
+# LICENSE file at http://www.apstra.com/community/eula
+#
+# Benchmarks of the OS selector, on synthetic os-selector.cfg files of a
+# growing number of groups and match values, and synthetic device facts.
+#
+# Each scenario measures the time to load and compile the file, and the
+# number of match_hw_model, match_os_version and select_os calls per second.
+# The results can be written as JSON, and compared against a previous run to
+# fail the build when a scenario gets slower than allowed.
+#
+# Each run also times a fixed calibration workload, and the comparison scales
+# the measures by the ratio of the calibration times, so that a baseline
+# recorded on one machine can be checked on another, eg: by CI against
+# benchmarks/baseline-os-selector.json:
+#
+#   python benchmarks/bench_os_selector.py --output bench.json
+#   python benchmarks/bench_os_selector.py --baseline bench.json
+
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import timeit
+
+import yaml
+
+from aeon_ztp import ztp_os_selector
+
+_PROGNAME = 'bench_os_selector'
+
+# measures reported per scenario, and whether more is better
+_MEASURES = (
+    ('load_seconds', False),
+    ('match_hw_model_per_sec', True),
+    ('match_os_version_per_sec', True),
+    ('select_os_per_sec', True),
+)
+
+
+def make_cfg(groups, entries, rule='exact'):
+    """ Returns:
+        dict: os-selector.cfg content of a default group, and of groups
+        matching on one of entries hw_model values and on their vendor
+
+    Args:
+        groups (int): Groups other than 'default'
+        entries (int): hw_model values listed by each group
+        rule (str): 'exact' for exact_match groups, 'regex' for regex_match
+    """
+    cfg_data = {'default': {'exact_match': '1.0.0', 'image': 'default.bin', 'finally': 'finally'}}
+    for grp in range(groups):
+        group_data = {
+            'matches': {
+                'hw_model': ['model-%d-%d' % (grp, idx) for idx in range(entries)],
+                'vendor': ['vendor-%d' % grp],
+            },
+            'image': 'image-%d.bin' % grp,
+        }
+        if rule == 'regex':
+            group_data['regex_match'] = r'3\.%d\.[0-9]+' % grp
+        else:
+            group_data['exact_match'] = '3.%d.0' % grp
+        cfg_data['group-%d' % grp] = group_data
+    return cfg_data
+
+
+def make_devices(groups, entries, count):
+    """ Returns:
+        list: (facts, group name) of count devices, spread over the groups of
+        make_cfg() and the 'default' group; half of them run the intended
+        OS version of their group
+    """
+    devices = []
+    for num in range(count):
+        grp = num % (groups + 1)
+        if grp == groups:
+            name, hw_model, vendor = 'default', 'unlisted', 'vendor-%d' % (num % max(groups, 1))
+            version = '1.0.0'
+        else:
+            name, hw_model, vendor = 'group-%d' % grp, 'model-%d-%d' % (grp, num % entries), 'vendor-%d' % grp
+            version = '3.%d.0' % grp
+        facts = {
+            'os_name': 'synthetic',
+            'hw_model': hw_model,
+            'vendor': vendor,
+            'os_version': version if num % 2 else '2.0.0',
+            'serial_number': 'SN%08d' % num,
+            'mac_address': '%012x' % num,
+            'virtual': False,
+        }
+        devices.append((facts, name))
+    return devices
+
+
+def calibrate(repeat=5):
+    """ Returns:
+        float: best time in seconds of a fixed workload of the same kind as
+        the selection: YAML loading, string formatting and dict lookups
+    """
+    text = yaml.safe_dump(make_cfg(20, 5), default_flow_style=False)
+
+    def workload():
+        yaml.safe_load(text)
+        index = dict((('hw_model', str(idx)), (idx,)) for idx in range(20000))
+        return sum(len(index.get(('hw_model', str(idx)), ())) for idx in range(40000))
+
+    return min(timeit.repeat(workload, number=1, repeat=repeat))
+
+
+def rate(func, items, repeat, min_seconds=0.05):
+    """ Returns:
+        float: calls of func per second over the items, best of repeat runs;
+        a run goes over the items as many times as it takes min_seconds, so
+        that short runs are not dominated by the timer noise
+    """
+    def run_items():
+        for item in items:
+            func(item)
+
+    loops = max(1, int(min_seconds / max(timeit.timeit(run_items, number=1), 1e-6)))
+    best = min(timeit.repeat(run_items, number=loops, repeat=repeat))
+    return len(items) * loops / best if best else float('inf')
+
+
+def run_scenario(groups, entries, rule, devices=500, repeat=5, workdir=None):
+    """ Measures the selection of the devices on a make_cfg() file.
+
+    Returns:
+        dict: groups, entries, rule and devices of the scenario, and its
+        load_seconds, match_hw_model_per_sec, match_os_version_per_sec and
+        select_os_per_sec, and the calibration_seconds measured along
+
+    Raises:
+        AssertionError: a device is not matched to its group
+    """
+    cfg_data = make_cfg(groups, entries, rule)
+    items = make_devices(groups, entries, devices)
+    tmpdir = tempfile.mkdtemp(dir=workdir)
+    try:
+        cfg_file = os.path.join(tmpdir, 'os-selector.cfg')
+        with open(cfg_file, 'w') as f:
+            yaml.safe_dump(cfg_data, f, default_flow_style=False)
+
+        # loading is what a bootstrap pays once the file is modified
+        load_seconds = min(timeit.repeat(
+            lambda: ztp_os_selector.Selector(ztp_os_selector.load_cfg(cfg_file)), number=1, repeat=repeat))
+
+        selector = ztp_os_selector.selectors.get(cfg_file)
+        facts = [item[0] for item in items]
+        for dev_data, name in items:
+            found = selector.match_hw_model(dev_data).hw_match
+            assert found == name, 'device {} matched {} instead of {}'.format(dev_data, found, name)
+
+        # the selection of each device compared to the intended OS version of its group
+        versions = [(selector.rules[name], dev_data['os_version']) for dev_data, name in items]
+
+        return dict(
+            groups=groups, entries=entries, rule=rule, devices=devices,
+            # the speed of the machine at the time of this scenario
+            calibration_seconds=round(calibrate(repeat), 6),
+            load_seconds=round(load_seconds, 6),
+            match_hw_model_per_sec=round(rate(selector.match_hw_model, facts, repeat), 1),
+            match_os_version_per_sec=round(rate(lambda item: item[0].image_name(item[1]), versions, repeat), 1),
+            select_os_per_sec=round(rate(lambda dev_data: ztp_os_selector.select_os(dev_data, cfg_file),
+                                         facts, repeat), 1))
+    finally:
+        ztp_os_selector.selectors.clear()
+        shutil.rmtree(tmpdir)
+
+
+def run(groups, entries, rules, devices=500, repeat=5):
+    """ Returns:
+        list: run_scenario() results of each combination of groups, entries and rules
+    """
+    return [run_scenario(num_groups, num_entries, rule, devices=devices, repeat=repeat)
+            for rule in rules for num_groups in groups for num_entries in entries]
+
+
+def scenario_key(result):
+    return (result['groups'], result['entries'], result['rule'])
+
+
+def compare(results, baseline, tolerance):
+    """ Returns:
+        list: messages of the measures of the results that are more than
+        tolerance percent worse than those of the same scenario in the
+        baseline, once scaled by the ratio of their calibration_seconds
+    """
+    previous = dict((scenario_key(item), item) for item in baseline)
+    regressions = []
+    for result in results:
+        base = previous.get(scenario_key(result))
+        if base is None:
+            continue
+        # how much slower the machine was than the one of the baseline
+        scale = 1.0
+        if result.get('calibration_seconds') and base.get('calibration_seconds'):
+            scale = result['calibration_seconds'] / base['calibration_seconds']
+        for measure, higher_is_better in _MEASURES:
+            new, old = result[measure], base.get(measure)
+            if not old:
+                continue
+            new = new * scale if higher_is_better else new / scale
+            # percent of time more per call: twice as slow is 100% worse
+            if higher_is_better:
+                slowdown = old / new if new else float('inf')
+            else:
+                slowdown = new / old
+            change = (slowdown - 1) * 100.0
+            if change > tolerance:
+                regressions.append('groups={} entries={} rule={}: {} {} -> {} ({:.0f}% worse)'.format(
+                    result['groups'], result['entries'], result['rule'], measure, old, round(new, 6), change))
+    return regressions
+
+
+def format_table(results):
+    lines = ['{:>7} {:>7} {:>5} {:>12} {:>16} {:>18} {:>12} {:>9}'.format(
+        'groups', 'entries', 'rule', 'load_ms', 'match_hw/s', 'match_os/s', 'select/s', 'calib_ms')]
+    for item in results:
+        lines.append('{:>7} {:>7} {:>5} {:>12.2f} {:>16.0f} {:>18.0f} {:>12.0f} {:>9.2f}'.format(
+            item['groups'], item['entries'], item['rule'], item['load_seconds'] * 1000,
+            item['match_hw_model_per_sec'], item['match_os_version_per_sec'], item['select_os_per_sec'],
+            item['calibration_seconds'] * 1000))
+    return '\n'.join(lines)
+
+
+def int_list(value):
+    return [int(item) for item in value.split(',') if item.strip()]
+
+
+def cli_parse(cmdargs=None):
+    psr = argparse.ArgumentParser(
+        prog=_PROGNAME,
+        description="Aeon ZTP OS selector benchmarks")
+
+    psr.add_argument('--groups', type=int_list, default=[10, 300],
+                     help='comma separated numbers of os-selector.cfg groups (default: 10,300)')
+    psr.add_argument('--entries', type=int_list, default=[1, 10],
+                     help='comma separated numbers of hw_model values per group (default: 1,10)')
+    psr.add_argument('--rules', default='exact,regex',
+                     help='comma separated version rules: exact, regex (default: both)')
+    psr.add_argument('--devices', type=int, default=500,
+                     help='synthetic devices selected per scenario (default: 500)')
+    psr.add_argument('--repeat', type=int, default=5,
+                     help='runs of each measure, the best one is kept (default: 5)')
+    psr.add_argument('-o', '--output',
+                     help='file the results are written to as JSON')
+    psr.add_argument('--baseline',
+                     help='JSON results of a previous run to compare with')
+    psr.add_argument('--tolerance', type=float, default=100.0,
+                     help='percent a measure may be worse than the baseline, once scaled by the '
+                          'calibration times (default: 100)')
+
+    return psr.parse_args(cmdargs)
+
+
+def main(cmdargs=None):
+    cli_args = cli_parse(cmdargs)
+    rules = [rule.strip() for rule in cli_args.rules.split(',') if rule.strip()]
+    results = run(cli_args.groups, cli_args.entries, rules, devices=cli_args.devices, repeat=cli_args.repeat)
+
+    print(format_table(results))
+    if cli_args.output:
+        with open(cli_args.output, 'w') as f:
+            json.dump(dict(python=sys.version.split()[0], results=results), f, indent=2, sort_keys=True,
+                      separators=(',', ': '))
+
+    if cli_args.baseline:
+        with open(cli_args.baseline) as f:
+            regressions = compare(results, json.load(f)['results'], cli_args.tolerance)
+        for message in regressions:
+            print('REGRESSION: ' + message)
+        if regressions:
+            return 1
+    return 0
+
+
+if '__main__' == __name__:
+    sys.exit(main())
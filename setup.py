@@ -39,7 +39,7 @@ setup(
     scripts=['aeon_ztp/bin/aztp-db-flush'],
     license="Apache 2.0",
     keywords="networking automation vendor-agnostic",
-    packages=find_packages(exclude=["tests", ".*"]),
+    packages=find_packages(exclude=["tests", "benchmarks", ".*"]),
     include_package_data=True,
     install_requires=install_reqs,
     zip_safe=False,
@@ -8,6 +8,7 @@ import aeon_ztp
 import aeon_ztp.api.models as models
 import pytest
 from aeon_ztp import create_app
+from aeon_ztp.api.cache import device_cache
 from datetime import datetime
 from sqlalchemy.orm.exc import ObjectDeletedError
 
@@ -28,6 +29,7 @@ def app():
     yield _app
     # Teardown code
     aeon_ztp.db.drop_all()
+    device_cache.clear()
     app_ctx.pop()
 
 
@@ -59,7 +61,7 @@ def session(app):
 
 @pytest.fixture(scope="function")
 def device(session, device_data=None):
-    now = datetime.now().isoformat()
+    now = datetime.utcnow()
     device_data = {'ip_addr': '1.2.3.4',
                    'os_name': 'NXOS',
                    'created_at': now,
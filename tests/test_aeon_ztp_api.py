@@ -10,9 +10,15 @@ import pkg_resources
 import pytest
 from mock import patch
 from tempfile import NamedTemporaryFile
+from sqlalchemy import event
+from sqlalchemy.exc import IntegrityError
 
 import json
+import threading
+from datetime import datetime, timedelta
 from aeon_ztp import create_app
+from aeon_ztp import ztp_celery, ztp_logging
+from aeon_ztp.api import changes, migrate
 
 
 @patch('aeon_ztp.Flask')
@@ -34,9 +40,14 @@ def test_aeon_ztp_app(mock_create):
 
 
 def test_create_device_in_db(device):
-    db_device = models.Device.query.get('1.2.3.4')
+    db_device = models.Device.query.filter_by(ip_addr='1.2.3.4').one()
     rcvd_device_data = models.device_schema.dump(db_device).data
-    assert rcvd_device_data == device
+    assert rcvd_device_data['id'] == db_device.id
+    for key, value in device.items():
+        if isinstance(value, datetime):
+            assert rcvd_device_data[key].startswith(value.isoformat())
+        else:
+            assert rcvd_device_data[key] == value
 
 
 def test_download_file(client):
@@ -84,21 +95,48 @@ def test_nxos_bootconf(client):
 def test_nxos_register_get(client):
     from aeon_ztp.ztp_celery import ztp_bootstrapper  # NOQA
     with patch('aeon_ztp.ztp_celery.ztp_bootstrapper.delay') as mock_task:
-        rv = client.get('api/register/nxos')
+        rv = client.get('api/register/nxos?ipaddr=1.2.3.4')
         args, kwargs = mock_task.call_args
         assert not args
-        assert kwargs == {'os_name': 'nxos', 'target': None}
+        assert kwargs == {'os_name': 'nxos', 'target': '1.2.3.4', 'lock': kwargs['lock']}
+        assert kwargs['lock']
         assert rv.status_code == 200
         assert not rv.data
 
 
+def test_nxos_register_once(client):
+    with patch('aeon_ztp.ztp_celery.ztp_bootstrapper.delay') as mock_task:
+        for _ in range(3):
+            assert client.get('api/register/nxos?ipaddr=1.2.3.4').status_code == 200
+        assert mock_task.call_count == 1
+        client.get('api/register/nxos?ipaddr=1.2.3.5')
+        assert mock_task.call_count == 2
+
+    # the next register call after the bootstrap ends enqueues a new one
+    ztp_celery.DeviceLock('1.2.3.4', mock_task.call_args_list[0][1]['lock']).release()
+    with patch('aeon_ztp.ztp_celery.ztp_bootstrapper.delay') as mock_task:
+        client.get('api/register/nxos?ipaddr=1.2.3.4')
+        assert mock_task.call_count == 1
+
+
+def test_nxos_register_enqueue_error(client):
+    with patch('aeon_ztp.ztp_celery.ztp_bootstrapper.delay', side_effect=IOError('broker down')):
+        with pytest.raises(IOError):
+            client.get('api/register/nxos?ipaddr=1.2.3.4')
+    # the lock is not left behind
+    with patch('aeon_ztp.ztp_celery.ztp_bootstrapper.delay') as mock_task:
+        client.get('api/register/nxos?ipaddr=1.2.3.4')
+        assert mock_task.called
+
+
 def test_nxos_register_post(client):
     from aeon_ztp.ztp_celery import ztp_bootstrapper  # NOQA
     with patch('aeon_ztp.ztp_celery.ztp_bootstrapper.delay') as mock_task:
-        rv = client.post('api/register/nxos')
+        rv = client.post('api/register/nxos?ipaddr=1.2.3.4')
         args, kwargs = mock_task.call_args
         assert not args
-        assert kwargs == {'os_name': 'nxos', 'target': None}
+        assert kwargs == {'os_name': 'nxos', 'target': '1.2.3.4', 'lock': kwargs['lock']}
+        assert kwargs['lock']
         assert rv.status_code == 200
         assert not rv.data
 
@@ -143,6 +181,8 @@ def test_create_device(client):
     assert rv.status_code == 200
     rvd = json.loads(rv.data)
     assert rvd['message'] == 'device added'
+    assert rvd['created']
+    assert rvd['state'] == 'REGISTERED'
     assert rvd['data'] == device_info
 
 
@@ -159,8 +199,48 @@ def test_create_device_with_existing_device(client, device):
     rvd = json.loads(rv.data)
     assert rvd['message'] == 'device already exists'
     assert rvd['ok']
+    assert not rvd['created']
+    assert rvd['state'] == 'excellent'
     assert rvd['data'] == device_info
 
+    rec = models.Device.query.filter_by(ip_addr='1.2.3.4').one()
+    assert rec.state == 'excellent'
+    assert rec.message == 'device with os_name, ip_addr already exists'
+    assert rec.updated_at > device['updated_at']
+
+
+def test_create_device_registers_once(client, statements):
+    device_info = {"ip_addr": "10.0.0.11",
+                   "os_name": "NXOS",
+                   "state": "REGISTERED",
+                   "message": "device registered, waiting for bootstrap start"
+                   }
+    results = []
+    for _ in range(3):
+        del statements[:]
+        rv = client.post('/api/devices',
+                         data=json.dumps(device_info),
+                         content_type='application/json')
+        results.append(json.loads(rv.data)['created'])
+
+    # the existing device is not looked up before the insert is tried
+    assert statements[0] == 'INSERT'
+    assert results == [True, False, False]
+    assert models.Device.query.count() == 1
+    assert [evt.state for evt in models.DeviceEvent.query] == ['REGISTERED']
+
+
+def test_create_device_after_delete(client, device):
+    client.delete('/api/devices?ip_addr=1.2.3.4')
+    rv = client.post('/api/devices',
+                     data=json.dumps({"ip_addr": "1.2.3.4", "os_name": "NXOS", "state": "REGISTERED"}),
+                     content_type='application/json')
+    rvd = json.loads(rv.data)
+    assert rvd['created']
+
+    rv = client.get('/api/devices?os_name=NXOS&ip_addr=1.2.3.4')
+    assert json.loads(rv.data)['items'][0]['state'] == 'REGISTERED'
+
 
 def test_create_device_with_bad_data(client):
     device_info = {"ip_addr": "10.0.0.11",
@@ -228,6 +308,59 @@ def test_get_devices_without_args(client, device):
     assert device['os_name'] == 'NXOS'
 
 
+def add_devices(session, count):
+    now = datetime.utcnow()
+    for idx in range(count):
+        session.add(models.Device(ip_addr='10.0.0.%d' % idx, os_name='eos', state='DONE',
+                                  message='x' * 100, created_at=now, updated_at=now))
+    session.commit()
+
+
+def test_get_devices_paginated(client, session):
+    add_devices(session, 5)
+    seen = []
+    cursor = None
+    while True:
+        url = '/api/devices?limit=2'
+        if cursor:
+            url += '&cursor=' + cursor
+        rvd = json.loads(client.get(url).data)
+        seen.extend(item['ip_addr'] for item in rvd['items'])
+        cursor = rvd['next_cursor']
+        if not cursor:
+            break
+        assert rvd['count'] == 2
+    assert sorted(seen) == sorted('10.0.0.%d' % idx for idx in range(5))
+
+
+def test_get_devices_fields(client, session):
+    add_devices(session, 2)
+    rv = client.get('/api/devices?fields=ip_addr,state&os_name=eos')
+    rvd = json.loads(rv.data)
+    assert rv.status_code == 200
+    assert rvd['count'] == 2
+    for item in rvd['items']:
+        assert set(item.keys()) == set(['ip_addr', 'state'])
+
+
+def test_get_devices_updated_since(client, session, device):
+    rvd = json.loads(client.get('/api/devices?updated_since=2000-01-01T00:00:00Z').data)
+    assert rvd['count'] == 1
+    rv = client.get('/api/devices?updated_since=2999-01-01T00:00:00')
+    rvd = json.loads(rv.data)
+    assert rv.status_code == 200
+    assert rvd['count'] == 0
+
+
+@pytest.mark.parametrize('args', ['fields=ip_addr,bad_field', 'limit=0', 'limit=abc',
+                                  'cursor=bad_cursor', 'updated_since=yesterday'])
+def test_get_devices_bad_paging_args(client, args):
+    rv = client.get('/api/devices?' + args)
+    rvd = json.loads(rv.data)
+    assert rv.status_code == 400
+    assert not rvd['ok']
+
+
 def test_put_device_status(client, device):
     device_info = {"ip_addr": "1.2.3.4",
                    "os_name": "NXOS",
@@ -240,7 +373,7 @@ def test_put_device_status(client, device):
     rvd = json.loads(rv.data)
     assert rv.status_code == 200
     assert rvd['ok']
-    db_device = models.Device.query.get('1.2.3.4')
+    db_device = models.Device.query.filter_by(ip_addr='1.2.3.4').one()
     rcvd_device_data = models.device_schema.dump(db_device).data
     assert rcvd_device_data['message'] == device_info['message']
 
@@ -268,7 +401,7 @@ def test_put_device_facts(client, device):
                     data=json.dumps(device_info),
                     content_type='application/json')
     assert rv.status_code == 200
-    db_device = models.Device.query.get('1.2.3.4')
+    db_device = models.Device.query.filter_by(ip_addr='1.2.3.4').one()
     rcvd_device_data = models.device_schema.dump(db_device).data
     assert device_info['hw_model'] == rcvd_device_data['hw_model']
     assert device_info['os_version'] == rcvd_device_data['os_version']
@@ -343,3 +476,400 @@ def test_delete_devices_no_device_given(client):
     assert not rvd['ok']
     assert rvd['message'] == 'all or filter required'
     assert rv.status_code == 400
+
+
+def test_device_indexes(app):
+    indexes = models.Device.__table__.indexes
+    indexed = set(col.name for idx in indexes for col in idx.columns)
+    assert set(['ip_addr', 'state', 'hw_model', 'serial_number', 'updated_at']) <= indexed
+
+
+def test_device_duplicate_os_name_ip_addr(session, device):
+    session.add(models.Device(ip_addr=device['ip_addr'], os_name=device['os_name']))
+    with pytest.raises(IntegrityError):
+        session.commit()
+    session.rollback()
+
+
+def test_parse_legacy_time():
+    parsed = migrate.parse_legacy_time('2017-05-01T10:11:12.123456')
+    assert isinstance(parsed, datetime)
+    assert parsed.microsecond == 123456
+    assert isinstance(migrate.parse_legacy_time('not-a-time'), datetime)
+
+
+def test_upgrade_devices_table(app):
+    engine = aeon_ztp.db.engine
+    aeon_ztp.db.drop_all()
+    engine.execute("CREATE TABLE devices ("
+                   "ip_addr VARCHAR(16) NOT NULL PRIMARY KEY, os_name VARCHAR(16) NOT NULL, "
+                   "state VARCHAR(64), created_at VARCHAR(64) NOT NULL, updated_at VARCHAR(64) NOT NULL)")
+    engine.execute("INSERT INTO devices (ip_addr, os_name, state, created_at, updated_at) "
+                   "VALUES ('1.2.3.4', 'eos', 'DONE', '2017-05-01T10:11:12.123456', '2017-05-01T10:11:13')")
+    assert migrate.needs_upgrade(engine)
+
+    assert migrate.upgrade_devices_table(engine) == 1
+    assert not migrate.needs_upgrade(engine)
+    assert migrate.upgrade_devices_table(engine) is None
+
+    db_device = models.Device.query.filter_by(ip_addr='1.2.3.4').one()
+    assert db_device.id
+    assert db_device.state == 'DONE'
+    assert isinstance(db_device.updated_at, datetime)
+
+
+def test_add_missing_columns(app):
+    engine = aeon_ztp.db.engine
+    aeon_ztp.db.drop_all()
+    engine.execute("CREATE TABLE devices ("
+                   "id INTEGER NOT NULL PRIMARY KEY, ip_addr VARCHAR(16) NOT NULL, os_name VARCHAR(16) NOT NULL, "
+                   "state VARCHAR(64), created_at DATETIME NOT NULL, updated_at DATETIME NOT NULL)")
+    engine.execute("INSERT INTO devices (ip_addr, os_name, state, created_at, updated_at) "
+                   "VALUES ('1.2.3.4', 'eos', 'DONE', '2017-05-01 10:11:12', '2017-05-01 10:11:13')")
+
+    added = migrate.add_missing_columns(engine)
+    assert 'devices.checkpoints' in added
+    assert 'device_events.id' not in added
+    assert migrate.add_missing_columns(engine) == []
+    assert models.Device.query.filter_by(ip_addr='1.2.3.4').one().checkpoints is None
+
+
+def test_get_devices_ndjson(client, session):
+    add_devices(session, 3)
+    rv = client.get('/api/devices?fields=ip_addr', headers={'Accept': 'application/x-ndjson'})
+    assert rv.status_code == 200
+    assert rv.mimetype == 'application/x-ndjson'
+    lines = rv.data.splitlines()
+    assert len(lines) == 3
+    assert sorted(json.loads(line)['ip_addr'] for line in lines) == ['10.0.0.0', '10.0.0.1', '10.0.0.2']
+
+
+@pytest.mark.parametrize('accept', [None, '*/*', 'application/json', 'text/html,*/*;q=0.8'])
+def test_get_devices_default_json(client, device, accept):
+    headers = {'Accept': accept} if accept else {}
+    rv = client.get('/api/devices', headers=headers)
+    assert rv.mimetype == 'application/json'
+    assert json.loads(rv.data)['count'] == 1
+
+
+def test_put_device_batch(client, device, session):
+    add_devices(session, 1)
+    batch = {
+        'facts': [{'ip_addr': '1.2.3.4', 'os_name': 'NXOS', 'hw_model': 'Semicool9000',
+                   'os_version': '3.0.0a', 'serial_number': '0987654321'}],
+        'status': [{'ip_addr': '1.2.3.4', 'os_name': 'NXOS', 'state': 'AWAIT-ONLINE', 'message': 'countdown 20'},
+                   {'ip_addr': '1.2.3.4', 'os_name': 'NXOS', 'state': None, 'message': 'countdown 10'},
+                   {'ip_addr': '10.0.0.0', 'os_name': 'eos', 'state': 'CONFIG', 'message': 'configuring'},
+                   {'ip_addr': '9.9.9.9', 'os_name': 'NXOS', 'state': 'CONFIG', 'message': 'configuring'}]
+    }
+    rv = client.put('/api/devices/batch', data=json.dumps(batch), content_type='application/json')
+    rvd = json.loads(rv.data)
+    assert rv.status_code == 200
+    assert rvd['ok']
+    assert rvd['count'] == 4
+    assert rvd['not_found'] == [{'ip_addr': '9.9.9.9', 'os_name': 'NXOS'}]
+
+    db_device = models.Device.query.filter_by(ip_addr='1.2.3.4').one()
+    assert db_device.hw_model == 'Semicool9000'
+    assert db_device.state == 'AWAIT-ONLINE'
+    assert db_device.message == 'countdown 10'
+    assert models.Device.query.filter_by(ip_addr='10.0.0.0').one().state == 'CONFIG'
+
+
+def test_put_device_batch_checkpoints(client, device):
+    def put_checkpoint(checkpoint, data=None):
+        batch = {'checkpoints': [{'ip_addr': '1.2.3.4', 'os_name': 'NXOS', 'checkpoint': checkpoint, 'data': data}]}
+        rv = client.put('/api/devices/batch', data=json.dumps(batch), content_type='application/json')
+        assert json.loads(rv.data)['count'] == 1
+        return json.loads(client.get('/api/devices?ip_addr=1.2.3.4&fields=checkpoints').data)['items'][0]
+
+    put_checkpoint('image-selected', {'image_name': 'nxos.bin'})
+    item = put_checkpoint('rebooted', {})
+    assert json.loads(item['checkpoints']) == {'image-selected': {'image_name': 'nxos.bin'}, 'rebooted': {}}
+    assert put_checkpoint(None)['checkpoints'] is None
+
+
+@pytest.mark.parametrize('body', [[], {'status': [{'ip_addr': '1.2.3.4'}]}])
+def test_put_device_batch_bad_data(client, body):
+    rv = client.put('/api/devices/batch', data=json.dumps(body), content_type='application/json')
+    assert rv.status_code == 400
+    assert not json.loads(rv.data)['ok']
+
+
+@patch('aeon_ztp.db.session.commit')
+def test_put_device_batch_db_exception(commit, client, device):
+    commit.side_effect = Exception
+    batch = {'status': [{'ip_addr': '1.2.3.4', 'os_name': 'NXOS', 'state': 'DONE', 'message': 'done'}]}
+    rv = client.put('/api/devices/batch', data=json.dumps(batch), content_type='application/json')
+    assert rv.status_code == 500
+
+
+def test_get_device_changes_head(client, device):
+    rvd = json.loads(client.get('/api/devices/changes').data)
+    assert rvd['count'] == 0
+    assert rvd['total'] == 1
+    rvd = json.loads(client.get('/api/devices/changes?timeout=0&since=' + rvd['cursor']).data)
+    assert rvd['count'] == 0
+
+
+def test_get_device_changes(client, device):
+    cursor = json.loads(client.get('/api/devices/changes').data)['cursor']
+    status = {'ip_addr': '1.2.3.4', 'os_name': 'NXOS', 'state': 'CONFIG', 'message': 'configuring'}
+    client.put('/api/devices/status', data=json.dumps(status), content_type='application/json')
+
+    rvd = json.loads(client.get('/api/devices/changes?fields=ip_addr,state&since=' + cursor).data)
+    assert rvd['count'] == 1
+    assert rvd['items'] == [{'ip_addr': '1.2.3.4', 'state': 'CONFIG'}]
+    assert rvd['cursor'] != cursor
+
+    rvd = json.loads(client.get('/api/devices/changes?timeout=0&since=' + rvd['cursor']).data)
+    assert rvd['count'] == 0
+
+
+def test_get_device_changes_late_commit(client, device, session):
+    cursor = json.loads(client.get('/api/devices/changes').data)['cursor']
+    updated_at = session.query(models.Device).one().updated_at
+    # stamped before the cursor, committed after it was returned
+    session.add(models.Device(os_name='eos', ip_addr='1.1.1.1', updated_at=updated_at - timedelta(seconds=1)))
+    session.commit()
+    rvd = json.loads(client.get('/api/devices/changes?timeout=0&fields=ip_addr&since=' + cursor).data)
+    assert rvd['items'] == [{'ip_addr': '1.1.1.1'}]
+    assert rvd['cursor'] == cursor
+
+    # not once it is older than the overlap
+    with patch('aeon_ztp.api.views._CHANGES_OVERLAP', 0):
+        rvd = json.loads(client.get('/api/devices/changes?timeout=0&since=' + cursor).data)
+    assert rvd['count'] == 0
+
+
+def test_get_device_changes_filtered(client, device, session):
+    rvd = json.loads(client.get('/api/devices/changes?os_name=eos').data)
+    assert rvd['total'] == 0
+    add_devices(session, 2)
+    rvd = json.loads(client.get('/api/devices/changes?os_name=eos&since=' + rvd['cursor']).data)
+    assert rvd['count'] == 2
+    assert rvd['total'] == 2
+
+
+@pytest.mark.parametrize('args', ['since=bad_cursor', 'timeout=abc', 'fields=bad_field'])
+def test_get_device_changes_bad_args(client, args):
+    rv = client.get('/api/devices/changes?' + args)
+    assert rv.status_code == 400
+
+
+def test_change_notifier_wait():
+    notifier = changes.ChangeNotifier()
+    assert notifier.wait(notifier.version, 0) == 0
+    timer = threading.Timer(0.1, notifier.notify)
+    timer.start()
+    assert notifier.wait(0, 5) == 1
+    timer.join()
+    # a notify since the version was read returns at once
+    assert notifier.wait(0, 5) == 1
+
+
+def put_status(client, state, ip_addr='1.2.3.4', os_name='NXOS'):
+    status = {'ip_addr': ip_addr, 'os_name': os_name, 'state': state, 'message': state.lower()}
+    return client.put('/api/devices/status', data=json.dumps(status), content_type='application/json')
+
+
+def test_device_events_recorded(client):
+    device = {'ip_addr': '1.2.3.4', 'os_name': 'NXOS', 'state': 'REGISTERED', 'message': 'registered'}
+    client.post('/api/devices', data=json.dumps(device), content_type='application/json')
+    for state in ['START', 'START', 'DONE']:
+        put_status(client, state)
+    batch = {'status': [{'ip_addr': '1.2.3.4', 'os_name': 'NXOS', 'state': 'FINALLY', 'message': 'finally'},
+                        {'ip_addr': '1.2.3.4', 'os_name': 'NXOS', 'state': None, 'message': 'still finally'}]}
+    client.put('/api/devices/batch', data=json.dumps(batch), content_type='application/json')
+
+    rvd = json.loads(client.get('/api/devices/events?ip_addr=1.2.3.4').data)
+    assert [item['state'] for item in rvd['items']] == ['REGISTERED', 'START', 'DONE', 'FINALLY']
+
+    rvd = json.loads(client.get('/api/devices/events?state=DONE&limit=1').data)
+    assert rvd['count'] == 1
+
+
+def test_device_events_kept_after_delete(client, device):
+    put_status(client, 'START')
+    client.delete('/api/devices?ip_addr=1.2.3.4')
+    assert models.DeviceEvent.query.count() == 1
+
+
+@pytest.mark.parametrize('args', ['limit=0', 'since=yesterday'])
+def test_get_device_events_bad_args(client, args):
+    assert client.get('/api/devices/events?' + args).status_code == 400
+
+
+def test_get_device_os_plan(client, device, session, tmpdir):
+    add_devices(session, 2)
+    profile_dir = tmpdir.mkdir('etc').mkdir('profiles').mkdir('NXOS')
+    profile_dir.join('os-selector.cfg').write('default:\n  exact_match: 1.0.1b\n  image: 1.0.1b.bin\n')
+
+    with patch('aeon_ztp.api.views._AEON_TOPDIR', str(tmpdir)):
+        rvd = json.loads(client.get('/api/devices/os-plan').data)
+        assert rvd['count'] == 3
+        assert rvd['items'][0] == {'ip_addr': '1.2.3.4', 'os_name': 'NXOS', 'hw_model': 'Supercool9000',
+                                   'os_version': '1.0.0a', 'ok': True, 'image_name': '1.0.1b.bin',
+                                   'finally': None}
+        assert rvd['summary']['images'] == [{'os_name': 'NXOS', 'image_name': '1.0.1b.bin', 'count': 1}]
+        assert rvd['summary']['errors'] == [{'os_name': 'eos', 'error_type': 'facts', 'count': 2}]
+
+        rv = client.get('/api/devices/os-plan?os_name=NXOS', headers={'Accept': 'application/x-ndjson'})
+        assert rv.mimetype == 'application/x-ndjson'
+        lines = [json.loads(line) for line in rv.data.splitlines()]
+        assert lines[0]['image_name'] == '1.0.1b.bin'
+        assert lines[1]['summary']['total'] == 1
+
+    assert client.get('/api/devices/os-plan?bogus=1').status_code == 400
+
+
+def test_get_device_log(client, tmpdir):
+    tmpdir.join('1.2.3.4.log').write('{"message": "config completed OK."}\n')
+    with patch.object(ztp_logging.pipeline, 'device_log_dir', str(tmpdir)):
+        rv = client.get('/api/devices/log?ip_addr=1.2.3.4')
+        assert rv.status_code == 200
+        assert rv.mimetype == 'application/x-ndjson'
+        assert json.loads(rv.data) == {'message': 'config completed OK.'}
+
+        assert client.get('/api/devices/log?ip_addr=1.2.3.5').status_code == 404
+        assert client.get('/api/devices/log?ip_addr=../1.2.3.4').status_code == 400
+        assert client.get('/api/devices/log').status_code == 400
+
+    with patch.object(ztp_logging.pipeline, 'device_log_dir', None):
+        assert client.get('/api/devices/log?ip_addr=1.2.3.4').status_code == 404
+
+
+def test_get_device_event_durations(client, device, session):
+    add_devices(session, 1)
+    for state in ['START', 'CONFIG', 'DONE']:
+        put_status(client, state)
+        put_status(client, state, ip_addr='10.0.0.0', os_name='eos')
+
+    rvd = json.loads(client.get('/api/devices/events/durations?os_name=NXOS&hw_model=Supercool9000').data)
+    assert [item['state'] for item in rvd['items']] == ['CONFIG', 'START']
+    for item in rvd['items']:
+        assert item['count'] == 1
+        assert item['p50'] >= 0 and item['p50'] == item['p99']
+
+    rvd = json.loads(client.get('/api/devices/events/durations').data)
+    assert rvd['count'] == 4
+    assert json.loads(client.get('/api/devices/events/durations?hw_model=none').data)['count'] == 0
+    assert client.get('/api/devices/events/durations?since=bad').status_code == 400
+
+
+def test_get_device_event_durations_phases(client, device):
+    put_status(client, 'START')
+    phases = [{'phase': 'wait-for-device', 'duration': 12.5, 'ok': True}]
+    status = {'ip_addr': '1.2.3.4', 'os_name': 'NXOS', 'state': 'DONE', 'message': 'done', 'phases': phases}
+    client.put('/api/devices/status', data=json.dumps(status), content_type='application/json')
+
+    rvd = json.loads(client.get('/api/devices/events/durations').data)
+    assert rvd['phases'] == [{'os_name': 'NXOS', 'hw_model': 'Supercool9000', 'phase': 'wait-for-device',
+                              'count': 1, 'max': 12.5, 'p50': 12.5, 'p90': 12.5, 'p99': 12.5}]
+
+
+@patch('aeon_ztp.api.views.ztp_celery.queue_depths', return_value=[('celery', 3)])
+def test_api_metrics(mock_depths, client, device):
+    client.get('/api/devices')
+    client.put('/api/devices/status', data=json.dumps({'ip_addr': '1.2.3.4', 'os_name': 'NXOS', 'state': 'DONE'}),
+               content_type='application/json')
+    rv = client.get('/api/metrics')
+    assert rv.status_code == 200
+    assert rv.mimetype == 'text/plain'
+    lines = rv.data.splitlines()
+    assert 'aeon_ztp_celery_queue_depth{queue="celery"} 3' in lines
+    assert 'aeon_ztp_bootstraps_in_flight{os_name="NXOS"} 1' not in lines
+    assert any(line.startswith('aeon_ztp_http_requests_total{endpoint="/api/devices",method="GET",status="200"}')
+               for line in lines)
+    assert any(line.startswith('aeon_ztp_db_commit_duration_seconds_count') for line in lines)
+
+
+@patch('aeon_ztp.api.views.ztp_celery.queue_depths', return_value=[])
+def test_api_metrics_in_flight(mock_depths, client, device):
+    rv = client.get('/api/metrics')
+    assert 'aeon_ztp_bootstraps_in_flight{os_name="NXOS"} 1' in rv.data.splitlines()
+
+
+def test_image_bytes_metric(client, tmpdir):
+    with patch('aeon_ztp.api.views._AEON_TOPDIR', str(tmpdir)):
+        tmpdir.mkdir('vendor_images').mkdir('eos').join('image.swi').write('x' * 100)
+        with patch('aeon_ztp.api.views.metrics') as mock_metrics:
+            rv = client.get('/images/eos/image.swi')
+    assert rv.status_code == 200
+    mock_metrics.inc.assert_called_with('aeon_ztp_image_bytes_served_total',
+                                        {'endpoint': '/images/<path:filename>'}, value=100)
+
+
+def test_image_download_throttled(client, tmpdir):
+    with patch('aeon_ztp.api.views._AEON_TOPDIR', str(tmpdir)):
+        tmpdir.mkdir('vendor_images').mkdir('eos').join('image.swi').write('x' * 100)
+        with patch('aeon_ztp.api.views.image_limiter.rate', 10 ** 9):
+            with patch('aeon_ztp.api.views.metrics') as mock_metrics:
+                rv = client.get('/images/eos/image.swi')
+            assert rv.status_code == 200
+            assert rv.data == 'x' * 100
+            assert rv.content_length == 100
+            assert client.get('/images/eos/missing.swi').status_code == 404
+            assert client.get('/images/../vendor_images/eos/image.swi').status_code == 404
+    mock_metrics.inc.assert_called_with('aeon_ztp_image_bytes_served_total',
+                                        {'endpoint': '/images/<path:filename>'}, value=100)
+
+
+@pytest.fixture()
+def statements(app):
+    executed = []
+
+    def before_execute(conn, cursor, statement, *args):
+        executed.append(statement.split()[0].upper())
+
+    engine = aeon_ztp.db.engine
+    event.listen(engine, 'before_cursor_execute', before_execute)
+    yield executed
+    event.remove(engine, 'before_cursor_execute', before_execute)
+
+
+def test_cached_status_update_skips_select(client, device, statements):
+    put_status(client, 'START')
+    del statements[:]
+    put_status(client, 'CONFIG')
+    assert 'SELECT' not in statements
+    assert models.Device.query.filter_by(ip_addr='1.2.3.4').one().state == 'CONFIG'
+    assert [evt.state for evt in models.DeviceEvent.query] == ['START', 'CONFIG']
+
+
+def test_cached_status_update_changed_elsewhere(client, device, session):
+    put_status(client, 'START')
+
+    # another server process updates the device
+    rec = models.Device.query.filter_by(ip_addr='1.2.3.4').one()
+    rec.state = 'CONFIG'
+    rec.updated_at = datetime.utcnow()
+    session.commit()
+
+    rv = put_status(client, 'CONFIG')
+    assert rv.status_code == 200
+    assert [evt.state for evt in models.DeviceEvent.query] == ['START']
+    put_status(client, 'DONE')
+    assert models.Device.query.filter_by(ip_addr='1.2.3.4').one().state == 'DONE'
+
+
+def test_cached_status_update_deleted_elsewhere(client, device, session):
+    put_status(client, 'START')
+    session.query(models.Device).delete()
+    session.commit()
+    assert put_status(client, 'CONFIG').status_code == 400
+
+
+def test_get_device_from_cache(client, device, statements):
+    url = '/api/devices?os_name=NXOS&ip_addr=1.2.3.4'
+    first = json.loads(client.get(url).data)
+    del statements[:]
+    assert json.loads(client.get(url).data) == first
+    assert statements == []
+
+    # a write makes the next read go to the database
+    put_status(client, 'CONFIG')
+    del statements[:]
+    rvd = json.loads(client.get(url).data)
+    assert rvd['items'][0]['state'] == 'CONFIG'
+    assert 'SELECT' in statements
@@ -0,0 +1,66 @@
+from aeon_ztp.api import cache
+
+
+def values(**kwargs):
+    rec = dict(id=1, os_name='eos', ip_addr='1.1.1.1', state='START')
+    rec.update(kwargs)
+    return rec
+
+
+def test_version_table_file(tmpdir):
+    fpath = str(tmpdir.join('device-cache'))
+    one = cache.VersionTable(fpath, slots=16)
+    other = cache.VersionTable(fpath, slots=16)
+    key = ('eos', '1.1.1.1')
+    assert one.get(key) == (0, 0)
+    one.bump(key)
+    assert other.get(key) == (0, 1)
+    other.bump()
+    assert one.get(key) == (1, 1)
+
+
+def test_read_requires_current_version():
+    dcache = cache.DeviceCache()
+    version = dcache.version('eos', '1.1.1.1')
+    dcache.put(values(), version)
+    assert dcache.get('eos', '1.1.1.1').state == 'START'
+
+    # a write, in this or another process, makes the copy unusable for reads
+    dcache.versions.bump(('eos', '1.1.1.1'))
+    assert dcache.get('eos', '1.1.1.1') is None
+    assert dcache.get('eos', '1.1.1.1', for_update=True).state == 'START'
+    assert (dcache.hits, dcache.misses) == (2, 1)
+
+
+def test_written_is_for_update_only():
+    dcache = cache.DeviceCache()
+    dcache.written(values(state='DONE'))
+    assert dcache.get('eos', '1.1.1.1') is None
+    assert dcache.get('eos', '1.1.1.1', for_update=True).state == 'DONE'
+
+
+def test_cached_copies_are_detached():
+    dcache = cache.DeviceCache()
+    dcache.put(values())
+    dcache.get('eos', '1.1.1.1', for_update=True).state = 'CHANGED'
+    assert dcache.get('eos', '1.1.1.1', for_update=True).state == 'START'
+
+
+def test_invalidate_and_clear():
+    dcache = cache.DeviceCache()
+    dcache.put(values())
+    dcache.put(values(id=2, ip_addr='2.2.2.2'))
+    dcache.invalidate('eos', '1.1.1.1')
+    assert dcache.get('eos', '1.1.1.1', for_update=True) is None
+    version = dcache.version('eos', '2.2.2.2')
+    dcache.clear()
+    assert dcache.get('eos', '2.2.2.2', for_update=True) is None
+    assert dcache.version('eos', '2.2.2.2') != version
+
+
+def test_max_size():
+    dcache = cache.DeviceCache(max_size=2)
+    for idx in range(3):
+        dcache.put(values(id=idx, ip_addr='10.0.0.%d' % idx))
+    assert dcache.get('eos', '10.0.0.0', for_update=True) is None
+    assert dcache.get('eos', '10.0.0.2', for_update=True) is not None
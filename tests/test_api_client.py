@@ -0,0 +1,193 @@
+import json
+
+import pytest
+import requests
+from mock import patch
+
+from aeon_ztp.api import client
+
+server = '2.2.2.2:8080'
+
+
+@pytest.fixture()
+def batch():
+    batch = client.DeviceUpdateBatch(server, max_items=5, max_age=60)
+    yield batch
+    if batch._timer is not None:
+        batch._timer.cancel()
+
+
+@patch('aeon_ztp.api.client.api_session')
+def test_state_change_flushes(mock_session, batch):
+    batch.add_status('eos', '1.1.1.1', state='START', message='started')
+    mock_session.return_value.put.assert_called_once_with(
+        url='http://%s/api/devices/batch' % server,
+        json={'facts': [], 'status': [{'os_name': 'eos', 'ip_addr': '1.1.1.1',
+                                       'state': 'START', 'message': 'started'}]})
+    assert not len(batch)
+
+
+@patch('aeon_ztp.api.client.api_session')
+def test_same_state_is_batched(mock_session, batch):
+    batch.add_status('eos', '1.1.1.1', state='AWAIT-ONLINE', message='countdown 30')
+    mock_session.return_value.reset_mock()
+    batch.add_status('eos', '1.1.1.1', state='AWAIT-ONLINE', message='countdown 20')
+    batch.add_status('eos', '1.1.1.1', message='countdown 10')
+    batch.add_facts({'os_name': 'eos', 'ip_addr': '1.1.1.1', 'hw_model': 'vEOS'})
+    assert not mock_session.return_value.put.called
+    assert len(batch) == 3
+
+    batch.add_status('eos', '1.1.1.1', state='CONFIG', message='configuring')
+    body = mock_session.return_value.put.call_args[1]['json']
+    assert len(body['facts']) == 1
+    assert [item['message'] for item in body['status']] == ['countdown 20', 'countdown 10', 'configuring']
+
+
+@patch('aeon_ztp.api.client.api_session')
+def test_max_items_flushes(mock_session, batch):
+    for idx in range(batch.max_items):
+        batch.add_facts({'os_name': 'eos', 'ip_addr': '1.1.1.1', 'hw_model': str(idx)})
+    assert mock_session.return_value.put.call_count == 1
+    assert len(mock_session.return_value.put.call_args[1]['json']['facts']) == batch.max_items
+
+
+@patch('aeon_ztp.api.client.time')
+@patch('aeon_ztp.api.client.api_session')
+def test_max_age_flushes(mock_session, mock_time, batch):
+    mock_time.time.return_value = 100
+    batch.add_facts({'os_name': 'eos', 'ip_addr': '1.1.1.1'})
+    assert not mock_session.return_value.put.called
+    mock_time.time.return_value = 100 + batch.max_age
+    batch.add_facts({'os_name': 'eos', 'ip_addr': '1.1.1.1'})
+    assert mock_session.return_value.put.called
+
+
+@patch('aeon_ztp.api.client.api_session')
+def test_max_age_timer_flushes(mock_session):
+    # nothing else is queued while the bootstrapper waits for the device
+    batch = client.DeviceUpdateBatch(server, max_age=0.05)
+    batch.add_status('eos', '1.1.1.1', message='rebooting')
+    timer = batch._timer
+    assert not mock_session.return_value.put.called
+    timer.join(5)
+    assert mock_session.return_value.put.call_count == 1
+    assert not len(batch)
+
+    # a flush cancels the timer
+    batch.add_status('eos', '1.1.1.1', message='countdown 10')
+    timer = batch._timer
+    batch.flush()
+    timer.join(5)
+    assert mock_session.return_value.put.call_count == 2
+
+
+@patch('aeon_ztp.api.client.api_session')
+def test_failed_flush_keeps_updates(mock_session, batch):
+    mock_session.return_value.put.return_value.ok = False
+    batch.add_status('eos', '1.1.1.1', state='START', message='started')
+    assert len(batch) == 1
+    # tried again later on
+    assert batch._timer is not None
+
+    mock_session.return_value.put.side_effect = requests.ConnectionError
+    with pytest.raises(requests.ConnectionError):
+        batch.add_status('eos', '1.1.1.1', state='CONFIG', message='configuring')
+    assert len(batch) == 2
+
+    mock_session.return_value.put.side_effect = None
+    mock_session.return_value.put.return_value.ok = True
+    batch.flush()
+    body = mock_session.return_value.put.call_args[1]['json']
+    assert [item['message'] for item in body['status']] == ['started', 'configuring']
+    assert not len(batch)
+
+
+@patch('aeon_ztp.api.client.api_session')
+def test_failed_checkpoint_raises(mock_session, batch):
+    checkpoints = client.Checkpoints(batch, 'eos', '1.1.1.1', ('image-selected', 'rebooted'))
+    mock_session.return_value.put.return_value.raise_for_status.side_effect = requests.HTTPError
+    mock_session.return_value.put.return_value.ok = False
+    with pytest.raises(requests.HTTPError):
+        checkpoints.save('image-selected', image_name='EOS.swi')
+    assert not checkpoints.done('image-selected')
+    assert len(batch) == 1
+
+
+@patch('aeon_ztp.api.client.api_session')
+def test_flush_nothing_pending(mock_session, batch):
+    assert batch.flush() is None
+    assert not mock_session.return_value.put.called
+
+
+@patch('aeon_ztp.api.client.api_session')
+def test_status_with_phases(mock_session, batch):
+    phases = [{'phase': 'wait-for-device', 'duration': 1.5, 'ok': True}]
+    batch.add_status('eos', '1.1.1.1', state='DONE', message='done', phases=phases)
+    assert mock_session.return_value.put.call_args[1]['json']['status'][0]['phases'] == phases
+
+
+@patch('aeon_ztp.api.client.api_session')
+def test_checkpoint_flushes(mock_session, batch):
+    batch.add_facts({'os_name': 'eos', 'ip_addr': '1.1.1.1', 'hw_model': 'vEOS'})
+    batch.add_checkpoint('eos', '1.1.1.1', 'image-selected', {'image_name': 'EOS.swi'})
+    body = mock_session.return_value.put.call_args[1]['json']
+    assert len(body['facts']) == 1
+    assert body['checkpoints'] == [{'os_name': 'eos', 'ip_addr': '1.1.1.1', 'checkpoint': 'image-selected',
+                                    'data': {'image_name': 'EOS.swi'}}]
+    assert not len(batch)
+
+
+@patch('aeon_ztp.api.client.api_session')
+def test_checkpoints(mock_session, batch):
+    checkpoints = client.Checkpoints(batch, 'eos', '1.1.1.1', ('config-pushed', 'image-selected', 'rebooted'))
+    assert checkpoints.last is None
+    assert not checkpoints.done('config-pushed')
+
+    checkpoints.save('image-selected', image_name='EOS.swi')
+    assert checkpoints.last == 'image-selected'
+    assert checkpoints.done('config-pushed')
+    assert checkpoints.done('image-selected')
+    assert not checkpoints.done('rebooted')
+    assert checkpoints.get('image-selected', 'image_name') == 'EOS.swi'
+    assert checkpoints.get('rebooted', 'image_name') is None
+
+    checkpoints.reset()
+    assert checkpoints.last is None
+    assert mock_session.return_value.put.call_args[1]['json']['checkpoints'][0]['checkpoint'] is None
+
+
+@patch('aeon_ztp.api.client.api_session')
+def test_checkpoints_load(mock_session, batch):
+    checkpoints = client.Checkpoints(batch, 'eos', '1.1.1.1', ('image-selected', 'rebooted'))
+    mock_session.return_value.get.return_value.json.return_value = {
+        'items': [{'checkpoints': json.dumps({'rebooted': {}})}]}
+    assert checkpoints.load(server) == {'rebooted': {}}
+    assert checkpoints.done('image-selected')
+    mock_session.return_value.get.assert_called_with(
+        url='http://%s/api/devices' % server,
+        params=dict(os_name='eos', ip_addr='1.1.1.1', fields='checkpoints'))
+
+    mock_session.return_value.get.return_value.json.return_value = {'items': [{'checkpoints': None}]}
+    assert checkpoints.load(server) == {}
+
+
+def test_api_session_shared_per_process():
+    session = client.api_session()
+    assert client.api_session() is session
+    adapter = session.get_adapter('http://127.0.0.1:8080/api/devices')
+    assert isinstance(adapter, client.ApiAdapter)
+    assert adapter.max_retries.total == client._RETRIES
+    assert 503 in adapter.max_retries.status_forcelist
+
+    # a forked process does not share the connections of its parent
+    with patch('aeon_ztp.api.client.os.getpid', return_value=-1):
+        assert client.api_session() is not session
+
+
+@patch('requests.adapters.HTTPAdapter.send')
+def test_api_adapter_default_timeout(mock_send):
+    adapter = client.ApiAdapter(timeout=(1, 2))
+    adapter.send('request', timeout=None)
+    mock_send.assert_called_with('request', timeout=(1, 2))
+    adapter.send('request', timeout=30)
+    mock_send.assert_called_with('request', timeout=30)
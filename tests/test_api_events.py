@@ -0,0 +1,69 @@
+import json
+from collections import namedtuple
+from datetime import datetime, timedelta
+
+from aeon_ztp.api import events
+
+Event = namedtuple('Event', 'device_id ip_addr os_name hw_model state created_at phases')
+
+start = datetime(2017, 1, 1)
+
+
+def timeline(device_id, hw_model, *states):
+    """ states are (state, seconds since start) pairs """
+    return [Event(device_id, '10.0.0.%d' % device_id, 'eos', hw_model if idx else None, state,
+                  start + timedelta(seconds=secs), None)
+            for idx, (state, secs) in enumerate(states)]
+
+
+def test_percentile():
+    values = range(1, 101)
+    assert events.percentile(values, 50) == 50
+    assert events.percentile(values, 99) == 99
+    assert events.percentile(values, 0) == 1
+    assert events.percentile([7], 90) == 7
+    assert events.percentile([], 50) is None
+
+
+def test_phase_durations():
+    evts = timeline(1, 'vEOS', ('REGISTERED', 0), ('START', 5), ('OS-INSTALL', 65), ('DONE', 365), ('START', 400))
+    evts += timeline(2, 'DCS-7050', ('REGISTERED', 0), ('START', 10))
+    durations, timings = events.phase_durations(evts)
+    assert timings == {}
+    assert durations == {
+        ('eos', 'vEOS', 'REGISTERED'): [5.0],
+        ('eos', 'vEOS', 'START'): [60.0],
+        ('eos', 'vEOS', 'OS-INSTALL'): [300.0],
+        ('eos', 'DCS-7050', 'REGISTERED'): [10.0]}
+
+
+def test_phase_durations_runs():
+    # device 1 is deleted mid-bootstrap, and its id is given to a new device
+    evts = timeline(1, 'vEOS', ('REGISTERED', 0), ('START', 5))
+    evts += [evt._replace(ip_addr='10.0.0.9') for evt in timeline(1, 'DCS-7050', ('REGISTERED', 500), ('START', 510))]
+    # device 2 is deleted and registers again with the same id
+    evts += timeline(2, 'vEOS', ('REGISTERED', 0), ('START', 20)) + timeline(2, 'vEOS', ('REGISTERED', 900),
+                                                                                ('START', 905))
+    assert [len(run) for run in events.device_runs(evts)] == [2, 2, 2, 2]
+
+    durations, _ = events.phase_durations(evts)
+    assert durations == {
+        ('eos', 'vEOS', 'REGISTERED'): [5.0, 20.0, 5.0],
+        ('eos', 'DCS-7050', 'REGISTERED'): [10.0]}
+
+
+def test_duration_stats():
+    durations = {('eos', 'vEOS', 'START'): [30.0, 10.0, 20.0]}
+    assert events.duration_stats(durations) == [
+        dict(os_name='eos', hw_model='vEOS', state='START', count=3, max=30.0, p50=20.0, p90=30.0, p99=30.0)]
+
+
+def test_phase_timings():
+    phases = [{'phase': 'wait-for-device', 'duration': 12.5, 'ok': True},
+              {'phase': 'push-config', 'duration': 3.0, 'ok': True}]
+    evts = timeline(1, 'vEOS', ('START', 0), ('DONE', 20))
+    evts[-1] = evts[-1]._replace(phases=json.dumps(phases))
+    _, timings = events.phase_durations(evts)
+    assert timings == {('eos', 'vEOS', 'wait-for-device'): [12.5], ('eos', 'vEOS', 'push-config'): [3.0]}
+    stats = events.duration_stats(timings, key=('os_name', 'hw_model', 'phase'))
+    assert [item['phase'] for item in stats] == ['push-config', 'wait-for-device']
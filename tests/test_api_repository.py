@@ -0,0 +1,91 @@
+from datetime import datetime
+
+from aeon_ztp.api import repository
+from aeon_ztp.api.cache import device_cache
+from aeon_ztp.api.models import Device, DeviceEvent
+
+
+def test_register_device(session):
+    state, created = repository.register_device(session, dict(os_name='eos', ip_addr='1.1.1.1', state='REGISTERED',
+                                                              message='registered'))
+    assert (state, created) == ('REGISTERED', True)
+    assert [event.state for event in session.query(DeviceEvent)] == ['REGISTERED']
+
+    state, created = repository.register_device(session, dict(os_name='eos', ip_addr='1.1.1.1', state='REGISTERED'))
+    assert (state, created) == ('REGISTERED', False)
+    assert repository.get_device_item(session, 'eos', '1.1.1.1')['message'] == repository._EXISTS_MESSAGE
+    assert session.query(DeviceEvent).count() == 1
+
+
+def test_get_device_item(device, session):
+    item = repository.get_device_item(session, 'NXOS', '1.2.3.4')
+    assert item['state'] == 'excellent'
+    assert item['serial_number'] == '1234567890'
+    # the next read is answered from the cache
+    assert device_cache.get('NXOS', '1.2.3.4') is not None
+    assert repository.get_device_item(session, 'NXOS', '1.2.3.4') == item
+    assert repository.get_device_item(session, 'NXOS', '1.2.3.5') is None
+
+
+def test_set_device_status(device, session):
+    assert repository.set_device_status(session, 'NXOS', '1.2.3.4', state='DONE', message='done')
+    item = repository.get_device_item(session, 'NXOS', '1.2.3.4')
+    assert (item['state'], item['message']) == ('DONE', 'done')
+    assert not repository.set_device_status(session, 'NXOS', '1.2.3.5', state='DONE')
+
+
+def test_device_states(device, session):
+    assert repository.device_states(session) == [('NXOS', '1.2.3.4', 'excellent')]
+
+
+def test_acquire_bootstrap_lock(session):
+    token = repository.acquire_bootstrap_lock(session, '1.1.1.1', 'eos', ttl=60)
+    assert token
+    assert repository.acquire_bootstrap_lock(session, '1.1.1.1', 'eos', ttl=60) is None
+    assert repository.acquire_bootstrap_lock(session, '1.1.1.2', 'eos', ttl=60)
+
+    repository.release_bootstrap_lock(session, '1.1.1.1', token)
+    assert repository.acquire_bootstrap_lock(session, '1.1.1.1', 'eos', ttl=60)
+
+
+def test_take_over_bootstrap_lock(session):
+    # no lock, no bootstrap to resume
+    assert repository.take_over_bootstrap_lock(session, '1.1.1.1', 'eos', 60, 'celery@a') is None
+    assert repository.acquire_bootstrap_lock(session, '1.1.1.1', 'eos', ttl=60)
+
+    # a node only takes over the locks it holds
+    token = repository.acquire_bootstrap_lock(session, '1.1.1.2', 'eos', ttl=60)
+    assert repository.take_over_bootstrap_lock(session, '1.1.1.2', 'eos', 60, 'celery@a') is None
+    repository.claim_bootstrap_lock(session, '1.1.1.2', token, 'celery@a')
+    assert repository.take_over_bootstrap_lock(session, '1.1.1.2', 'eos', 60, 'celery@b') is None
+    assert repository.take_over_bootstrap_lock(session, '1.1.1.2', 'cumulus', 60, 'celery@a') is None
+    resumed = repository.take_over_bootstrap_lock(session, '1.1.1.2', 'eos', 60, 'celery@a')
+    assert resumed not in (None, token)
+
+    # the superseded token no longer releases the lock
+    repository.release_bootstrap_lock(session, '1.1.1.2', token)
+    assert repository.acquire_bootstrap_lock(session, '1.1.1.2', 'eos', ttl=60) is None
+    repository.release_bootstrap_lock(session, '1.1.1.2', resumed)
+    assert repository.acquire_bootstrap_lock(session, '1.1.1.2', 'eos', ttl=60)
+
+    # lapsed
+    assert repository.acquire_bootstrap_lock(session, '1.1.1.3', 'eos', ttl=-1)
+    assert repository.take_over_bootstrap_lock(session, '1.1.1.3', 'eos', 60, None)
+
+
+def test_locked_device_states(session):
+    for ip_addr, updated_at in (('1.1.1.1', datetime(2017, 1, 1)), ('1.1.1.2', datetime.utcnow()),
+                                ('1.1.1.3', datetime.utcnow())):
+        session.add(Device(os_name='eos', ip_addr=ip_addr, state='OS-INSTALL', updated_at=updated_at))
+    session.commit()
+    for ip_addr in ('1.1.1.1', '1.1.1.2'):
+        repository.acquire_bootstrap_lock(session, ip_addr, 'eos', ttl=60)
+    assert sorted(repository.locked_device_states(session)) == [
+        ('eos', '1.1.1.1', 'OS-INSTALL'), ('eos', '1.1.1.2', 'OS-INSTALL')]
+    assert repository.locked_device_states(session, updated_since=datetime(2018, 1, 1)) == [
+        ('eos', '1.1.1.2', 'OS-INSTALL')]
+
+
+def test_acquire_bootstrap_lock_expired(session):
+    assert repository.acquire_bootstrap_lock(session, '1.1.1.1', 'eos', ttl=-1)
+    assert repository.acquire_bootstrap_lock(session, '1.1.1.1', 'eos', ttl=60)
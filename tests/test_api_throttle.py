@@ -0,0 +1,53 @@
+import pytest
+from mock import patch
+
+from aeon_ztp.api import throttle
+
+
+@patch('aeon_ztp.api.throttle.time')
+def test_reserve_paces_to_rate(mock_time):
+    mock_time.time.return_value = 1000.0
+    limiter = throttle.RateLimiter(1000)
+    # the idle budget covers a short burst, then each chunk waits its turn
+    assert limiter.reserve(250) == 0
+    assert limiter.reserve(250) == 0
+    assert limiter.reserve(500) == pytest.approx(0.25)
+    assert limiter.reserve(500) == pytest.approx(0.75)
+
+
+@patch('aeon_ztp.api.throttle.time')
+def test_reserve_idle_budget_is_capped(mock_time):
+    mock_time.time.return_value = 1000.0
+    limiter = throttle.RateLimiter(1000)
+    limiter.reserve(100)
+    mock_time.time.return_value = 2000.0
+    assert limiter.reserve(250) == 0
+    assert limiter.reserve(250) == 0
+    assert limiter.reserve(250) == pytest.approx(0.25)
+
+
+def test_reserve_no_limit():
+    limiter = throttle.RateLimiter(0)
+    assert limiter.reserve(10 ** 9) == 0
+
+
+@patch('aeon_ztp.api.throttle.time')
+def test_reserve_shared_by_file(mock_time, tmpdir):
+    mock_time.time.return_value = 1000.0
+    fpath = str(tmpdir.join('transfers'))
+    one = throttle.RateLimiter(1000, fpath)
+    other = throttle.RateLimiter(1000, fpath)
+    assert one.reserve(500) == 0
+    assert other.reserve(500) == pytest.approx(0.25)
+    assert one.reserve(500) == pytest.approx(0.75)
+
+
+@patch('aeon_ztp.api.throttle.time')
+def test_stream(mock_time, tmpdir):
+    mock_time.time.return_value = 1000.0
+    fpath = tmpdir.join('image.bin')
+    fpath.write('x' * 1000)
+    limiter = throttle.RateLimiter(1000)
+    chunks = list(limiter.stream(str(fpath), chunk_size=400))
+    assert ''.join(chunks) == 'x' * 1000
+    assert [args[0] for args, _ in mock_time.sleep.call_args_list] == pytest.approx([0.15, 0.55])
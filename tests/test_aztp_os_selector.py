@@ -3,11 +3,13 @@ import yaml
 import tempfile
 import json
 import sys
-import copy
 from collections import namedtuple
 import pytest
+from argparse import Namespace
 from mock import patch
+from StringIO import StringIO
 
+from aeon_ztp import ztp_os_selector
 from aeon_ztp.bin import aztp_os_selector
 
 
@@ -139,92 +141,6 @@ def test_load_cfg_bad_syntax():
     assert str(e) == '1'
 
 
-def test_match_hw_model():
-    match = aztp_os_selector.match_hw_model(dev_data, cfg_data)
-    assert match[0] == 'group_a'
-    assert match[1] == cfg_data['group_a']
-
-
-def test_match_hw_model_no_match():
-    new_dev_data = copy.deepcopy(dev_data)
-    new_dev_data['hw_model'] = 'cvx2000'
-    match = aztp_os_selector.match_hw_model(new_dev_data, cfg_data)
-    assert match[0] == 'default'
-    assert match[1] == cfg_data['default']
-
-
-def test_match_hw_model_no_default():
-    new_dev_data = copy.deepcopy(dev_data)
-    new_dev_data['hw_model'] = 'cvx2000'
-    new_cfg_data = copy.deepcopy(cfg_data)
-    new_cfg_data.pop('default')
-    try:
-        aztp_os_selector.match_hw_model(new_dev_data, new_cfg_data)
-    except aztp_os_selector.HwNoMatchError as e:
-        pass
-    assert isinstance(e, aztp_os_selector.HwNoMatchError)
-
-
-def test_match_hw_model_multi_match():
-    new_cfg_data = copy.deepcopy(cfg_data)
-    new_cfg_data['group_b'] = {
-        'regex_match': '3\.1\.[12]',
-        'image': 'CumulusLinux-3.1.2-amd64.bin',
-        'matches': {
-            'hw_model': ['cvx1000'],
-            'mac_address': ['0123456789012', '2109876543210']
-        }
-    }
-    try:
-        aztp_os_selector.match_hw_model(dev_data, new_cfg_data)
-    except aztp_os_selector.HwMultiMatchError as e:
-        pass
-    assert isinstance(e, aztp_os_selector.HwMultiMatchError)
-
-
-def test_match_os_version_regex_no_upgrade():
-    item_match = namedtuple('item_match', ['hw_match', 'data'])
-    hw_match = item_match('group_a', cfg_data['group_a'])
-    upgrade = aztp_os_selector.match_os_version(dev_data, hw_match.data)
-    assert not upgrade
-
-
-def test_match_os_version_exact_match_no_upgrade():
-    new_cfg_data = copy.deepcopy(cfg_data)
-    new_cfg_data['group_a'].pop('regex_match')
-    new_cfg_data['group_a']['exact_match'] = '3.1.1'
-    item_match = namedtuple('item_match', ['hw_match', 'data'])
-    hw_match = item_match('group_a', new_cfg_data['group_a'])
-    upgrade = aztp_os_selector.match_os_version(dev_data, hw_match.data)
-    assert not upgrade
-
-
-def test_match_os_version_regex_upgrade():
-    new_cfg_data = copy.deepcopy(cfg_data)
-    new_cfg_data['group_a']['regex_match'] = '3\.1\.[23]'
-    item_match = namedtuple('item_match', ['hw_match', 'data'])
-    hw_match = item_match('group_a', new_cfg_data['group_a'])
-    upgrade = aztp_os_selector.match_os_version(dev_data, hw_match.data)
-    assert upgrade == new_cfg_data['group_a']['image']
-
-
-def test_match_os_version_exact_match_upgrade():
-    new_cfg_data = copy.deepcopy(cfg_data)
-    new_cfg_data['group_a'].pop('regex_match')
-    new_cfg_data['group_a']['exact_match'] = '3.1.0'
-    item_match = namedtuple('item_match', ['hw_match', 'data'])
-    hw_match = item_match('group_a', new_cfg_data['group_a'])
-    upgrade = aztp_os_selector.match_os_version(dev_data, hw_match.data)
-    assert upgrade == new_cfg_data['group_a']['image']
-
-
-def test_match_os_version_cfgerror():
-    with pytest.raises(aztp_os_selector.CfgError):
-        dev_data = {'os_version': '1.A'}
-        hw_match = []
-        aztp_os_selector.match_os_version(dev_data, hw_match)
-
-
 @patch('aeon_ztp.bin.aztp_os_selector.exit_results', side_effect=SystemExit)
 @patch('aeon_ztp.bin.aztp_os_selector.json.loads')
 @patch('aeon_ztp.bin.aztp_os_selector.load_cfg', return_value=cfg_data)
@@ -251,7 +167,7 @@ def test_main_argparse_error(mock_cli_parse, mock_exit_results, cli_args):
                                           'error_message': errmsg})
 
 
-@patch('aeon_ztp.bin.aztp_os_selector.match_hw_model', side_effect=aztp_os_selector.HwNoMatchError)
+@patch('aeon_ztp.ztp_os_selector.match_hw_model', side_effect=ztp_os_selector.HwNoMatchError)
 @patch('aeon_ztp.bin.aztp_os_selector.exit_results', side_effect=SystemExit)
 @patch('aeon_ztp.bin.aztp_os_selector.json.loads')
 @patch('aeon_ztp.bin.aztp_os_selector.load_cfg', return_value=cfg_data)
@@ -266,14 +182,14 @@ def test_main_hwnomatch_error(mock_cli_parse, mock_load_cfg, mock_json_load, moc
                                           'error_message': errmsg})
 
 
-@patch('aeon_ztp.bin.aztp_os_selector.match_hw_model', side_effect=aztp_os_selector.HwMultiMatchError)
+@patch('aeon_ztp.ztp_os_selector.match_hw_model', side_effect=ztp_os_selector.HwMultiMatchError)
 @patch('aeon_ztp.bin.aztp_os_selector.exit_results', side_effect=SystemExit)
 @patch('aeon_ztp.bin.aztp_os_selector.json.loads')
 @patch('aeon_ztp.bin.aztp_os_selector.load_cfg', return_value=cfg_data)
 @patch('aeon_ztp.bin.aztp_os_selector.cli_parse')
 def test_main_hwmultimatch_error(mock_cli_parse, mock_load_cfg, mock_json_load, mock_exit_results, mock_hw_match, cli_args):
     errmsg = 'matches multiple os-selector groups'
-    mock_hw_match.side_effect = aztp_os_selector.HwMultiMatchError(errmsg)
+    mock_hw_match.side_effect = ztp_os_selector.HwMultiMatchError(errmsg)
     mock_cli_parse.return_value = cli_args
     with pytest.raises(SystemExit):
         aztp_os_selector.main()
@@ -282,8 +198,8 @@ def test_main_hwmultimatch_error(mock_cli_parse, mock_load_cfg, mock_json_load,
                                           'error_message': errmsg})
 
 
-@patch('aeon_ztp.bin.aztp_os_selector.match_os_version')
-@patch('aeon_ztp.bin.aztp_os_selector.match_hw_model')
+@patch('aeon_ztp.ztp_os_selector.match_os_version')
+@patch('aeon_ztp.ztp_os_selector.match_hw_model')
 @patch('aeon_ztp.bin.aztp_os_selector.exit_results', side_effect=SystemExit)
 @patch('aeon_ztp.bin.aztp_os_selector.json.loads')
 @patch('aeon_ztp.bin.aztp_os_selector.load_cfg', return_value=cfg_data)
@@ -291,7 +207,8 @@ def test_main_hwmultimatch_error(mock_cli_parse, mock_load_cfg, mock_json_load,
 def test_main_cfgerror(mock_cli_parse, mock_load_cfg, mock_json_load, mock_exit_results, mock_hw_match,
                        mock_os_match, cli_args):
     errmsg = 'Expecting one of'
-    mock_os_match.side_effect = aztp_os_selector.CfgError(errmsg)
+    mock_hw_match.return_value = ztp_os_selector.item_match('default', cfg_data['default'])
+    mock_os_match.side_effect = ztp_os_selector.CfgError(errmsg)
     mock_cli_parse.return_value = cli_args
     with pytest.raises(SystemExit):
         aztp_os_selector.main()
@@ -300,8 +217,8 @@ def test_main_cfgerror(mock_cli_parse, mock_load_cfg, mock_json_load, mock_exit_
                                           'error_message': errmsg})
 
 
-@patch('aeon_ztp.bin.aztp_os_selector.match_os_version')
-@patch('aeon_ztp.bin.aztp_os_selector.match_hw_model')
+@patch('aeon_ztp.ztp_os_selector.match_os_version')
+@patch('aeon_ztp.ztp_os_selector.match_hw_model')
 @patch('aeon_ztp.bin.aztp_os_selector.exit_results', side_effect=SystemExit)
 @patch('aeon_ztp.bin.aztp_os_selector.json.loads')
 @patch('aeon_ztp.bin.aztp_os_selector.load_cfg', return_value=cfg_data)
@@ -319,3 +236,35 @@ def test_main(mock_cli_parse, mock_load_cfg, mock_json_load, mock_exit_results,
     with pytest.raises(SystemExit):
         aztp_os_selector.main()
     mock_exit_results.assert_called_with({'ok': True, 'image_name': sw_match, 'finally': hw_match.data['finally']})
+
+
+def test_cli_parse_batch():
+    parse = aztp_os_selector.cli_parse(['-b', 'devices.ndjson', '-t', '/opt/aeonztps'])
+    assert (parse.batch, parse.topdir, parse.config_file) == ('devices.ndjson', '/opt/aeonztps', None)
+    with pytest.raises(aztp_os_selector.ArgumentParser.ParserError):
+        aztp_os_selector.cli_parse(['-b', 'devices.ndjson', '-j', '{}'])
+
+
+def test_run_batch():
+    osf = os_sel_file()
+    devices = StringIO('\n'.join([json.dumps(dev_data), '', 'not json',
+                                  json.dumps(dict(dev_data, os_version='3.0.0'))]))
+    out = StringIO()
+    aztp_os_selector.run_batch(devices, out, config_file=osf.name)
+    lines = [json.loads(line) for line in out.getvalue().splitlines()]
+    assert [line.get('image_name') for line in lines[:3]] == [False, None, 'CumulusLinux-3.1.2-amd64.bin']
+    assert lines[1] == {'line': 3, 'ok': False, 'error_type': 'args',
+                        'error_message': 'JSON line formatted incorrectly.'}
+    summary = lines[3]['summary']
+    assert (summary['total'], summary['upgrade'], summary['current'], summary['error']) == (3, 1, 1, 1)
+
+
+@patch('aeon_ztp.bin.aztp_os_selector.exit_results', side_effect=SystemExit)
+@patch('aeon_ztp.bin.aztp_os_selector.cli_parse')
+def test_main_batch_args_error(mock_cli_parse, mock_exit_results):
+    mock_cli_parse.return_value = Namespace(batch='-', config_file=None, topdir='', json=None)
+    with pytest.raises(SystemExit):
+        aztp_os_selector.main()
+    mock_exit_results.assert_called_with({'ok': False,
+                                          'error_type': 'args',
+                                          'error_message': 'Batch mode needs --config or --topdir.'})
@@ -0,0 +1,54 @@
+import json
+
+from aeon_ztp import ztp_os_selector
+from benchmarks import bench_os_selector
+
+
+def test_make_cfg_devices():
+    for rule in ('exact', 'regex'):
+        cfg_data = bench_os_selector.make_cfg(3, 2, rule)
+        assert len(cfg_data) == 4
+        selector = ztp_os_selector.Selector(cfg_data)
+        for dev_data, name in bench_os_selector.make_devices(3, 2, 16):
+            results = selector.select(dev_data)
+            assert results['ok'] is True
+            assert selector.match_hw_model(dev_data).hw_match == name
+            intended = dev_data['os_version'] != '2.0.0'
+            assert (results['image_name'] is False) == intended
+
+
+def test_run_scenario(tmpdir):
+    result = bench_os_selector.run_scenario(5, 3, 'regex', devices=20, repeat=1, workdir=str(tmpdir))
+    assert (result['groups'], result['entries'], result['rule'], result['devices']) == (5, 3, 'regex', 20)
+    for measure, _higher in bench_os_selector._MEASURES:
+        assert result[measure] > 0
+    # the scenario files are removed
+    assert tmpdir.listdir() == []
+
+
+def test_compare():
+    base = dict(groups=10, entries=1, rule='exact', load_seconds=0.01, match_hw_model_per_sec=1000.0,
+                match_os_version_per_sec=1000.0, select_os_per_sec=1000.0)
+    assert bench_os_selector.compare([dict(base, load_seconds=0.014)], [base], 50) == []
+    regressions = bench_os_selector.compare([dict(base, load_seconds=0.02, select_os_per_sec=400.0)], [base], 50)
+    assert len(regressions) == 2
+    assert regressions[1] == 'groups=10 entries=1 rule=exact: select_os_per_sec 1000.0 -> 400.0 (150% worse)'
+    # a machine twice as slow as the one of the baseline
+    slower = dict(base, calibration_seconds=0.2, load_seconds=0.02, select_os_per_sec=500.0)
+    assert bench_os_selector.compare([slower], [dict(base, calibration_seconds=0.1)], 50) == []
+    assert len(bench_os_selector.compare([slower], [base], 50)) == 2
+    # scenarios missing from the baseline are not compared
+    assert bench_os_selector.compare([dict(base, groups=100)], [base], 50) == []
+
+
+def test_main(tmpdir):
+    output = tmpdir.join('bench.json')
+    args = ['--groups', '2', '--entries', '1', '--rules', 'exact', '--devices', '10', '--repeat', '1']
+    assert bench_os_selector.main(args + ['-o', str(output)]) == 0
+    results = json.loads(output.read())['results']
+    assert [bench_os_selector.scenario_key(item) for item in results] == [(2, 1, 'exact')]
+
+    # a baseline far faster than any run fails the comparison
+    results[0]['match_hw_model_per_sec'] *= 1e9
+    output.write(json.dumps(dict(results=results)))
+    assert bench_os_selector.main(args + ['--baseline', str(output)]) == 1
@@ -99,11 +99,12 @@ def test_centos_bootstrap(cli_args, ub_obj):
     assert cli_args == ub_obj.cli_args
 
 
-@mock.patch('aeon_ztp.bin.centos_bootstrap.requests')
-def test_post_device_facts(mock_requests, device, ub_obj):
+@mock.patch('aeon_ztp.api.client.api_session')
+def test_post_device_facts(mock_session, device, ub_obj):
     ub_obj.dev = device
     ub_obj.post_device_facts()
-    mock_requests.put.assert_called_with(json={
+    ub_obj.updates.flush()
+    mock_session.return_value.put.assert_called_with(json={'facts': [{
         'os_version': device.facts['os_version'],
         'os_name': ub_obj.os_name,
         'ip_addr': device.target,
@@ -112,25 +113,25 @@ def test_post_device_facts(mock_requests, device, ub_obj):
         'facts': json.dumps(device.facts),
         'image_name': None,
         'finally_script': None
-    },
-        url='http://{}/api/devices/facts'.format(args['server']))
+    }], 'status': []},
+        url='http://{}/api/devices/batch'.format(args['server']))
 
 
-@mock.patch('aeon_ztp.bin.centos_bootstrap.requests')
-def test_post_device_status(mock_requests, device, ub_obj):
+@mock.patch('aeon_ztp.api.client.api_session')
+def test_post_device_status(mock_session, device, ub_obj):
     kw = {
         'message': 'Test message',
         'state': 'DONE'
     }
     ub_obj.dev = device
     ub_obj.post_device_status(**kw)
-    mock_requests.put.assert_called_with(json={
+    mock_session.return_value.put.assert_called_with(json={'facts': [], 'status': [{
         'message': kw['message'],
         'os_name': ub_obj.os_name,
         'ip_addr': device.target,
         'state': kw['state']
-    },
-        url='http://{}/api/devices/status'.format(args['server']))
+    }]},
+        url='http://{}/api/devices/batch'.format(args['server']))
 
 
 @mock.patch('aeon_ztp.bin.centos_bootstrap.CentOSBootstrap.post_device_status')
@@ -144,7 +145,8 @@ def test_exit_results(mock_post, ub_obj, device):
         ub_obj.exit_results(**kw)
     mock_post.assert_called_with(
         state='DONE',
-        message='bootstrap completed OK'
+        message='bootstrap completed OK',
+        phases=[]
     )
     assert e.value.code == 0
 
@@ -158,7 +160,8 @@ def test_exit_results(mock_post, ub_obj, device):
         ub_obj.exit_results(**kw)
     mock_post.assert_called_with(
         state='ERROR',
-        message=kw['results']['message']
+        message=kw['results']['message'],
+        phases=[]
     )
     assert e.value.code == 1
 
@@ -193,8 +196,8 @@ def test_wait_for_device_missing_passwd(mock_exit, cli_args, device):
 @mock.patch('aeon_ztp.bin.centos_bootstrap.CentOSBootstrap.exit_results', side_effect=SystemExit)
 @mock.patch('aeon_ztp.bin.centos_bootstrap.Device', side_effect=AuthenticationException)
 @mock.patch('aeon_ztp.bin.centos_bootstrap.CentOSBootstrap.post_device_status')
-@mock.patch('aeon_ztp.bin.centos_bootstrap.requests.put')
-def test_wait_for_device_auth_exception(mock_requests, mock_post_dev, mock_dev, mock_exit, ub_obj):
+@mock.patch('aeon_ztp.api.client.api_session')
+def test_wait_for_device_auth_exception(mock_session, mock_post_dev, mock_dev, mock_exit, ub_obj):
     with pytest.raises(SystemExit):
         ub_obj.wait_for_device(1, 2)
     mock_exit.assert_called_with(
@@ -234,15 +237,10 @@ def test_wait_for_device(mock_dev, mock_post_facts, ub_obj, device):
 
 
 @mock.patch('aeon_ztp.bin.centos_bootstrap.CentOSBootstrap.exit_results', side_effect=SystemExit)
-@mock.patch('aeon_ztp.bin.centos_bootstrap.json.loads')
-@mock.patch('aeon_ztp.bin.centos_bootstrap.subprocess.Popen')
-def test_check_os_install_json_exception(mock_subprocess, mock_json, mock_exit, ub_obj, device):
+@mock.patch('aeon_ztp.bin.centos_bootstrap.select_os', side_effect=KeyError('hw_model'))
+def test_check_os_install_select_exception(mock_select, mock_exit, ub_obj, device):
     ub_obj.dev = device
-    test_stdout = 'test stdout'
-    exception_msg = 'test exception message'
-    errmsg = 'Unable to load os-select output as JSON: {}\n {}'.format(test_stdout, exception_msg)
-    mock_json.side_effect = Exception(exception_msg)
-    mock_subprocess.return_value.communicate.return_value = (test_stdout, 'test stderr')
+    errmsg = 'Unable to select the OS: {}'.format(str(KeyError('hw_model')))
     with pytest.raises(SystemExit):
         ub_obj.check_os_install_and_finally()
     mock_exit.assert_called_with(
@@ -255,6 +253,17 @@ def test_check_os_install_json_exception(mock_subprocess, mock_json, mock_exit,
     )
 
 
+@mock.patch('aeon_ztp.bin.centos_bootstrap.select_os')
+def test_check_os_install(mock_select, ub_obj, device):
+    ub_obj.dev = device
+    conf_fpath = '{}/etc/profiles/centos/os-selector.cfg'.format(ub_obj.cli_args.topdir)
+    mock_select.return_value = {'ok': True, 'image': 'test_image', 'finally': 'finally'}
+    results = ub_obj.check_os_install_and_finally()
+    mock_select.assert_called_with(device.facts, conf_fpath)
+    assert results == mock_select.return_value
+    assert (ub_obj.image_name, ub_obj.finally_script) == ('test_image', 'finally')
+
+
 @mock.patch('aeon_ztp.bin.centos_bootstrap.CentOSBootstrap.exit_results', side_effect=SystemExit)
 @mock.patch('aeon_ztp.bin.centos_bootstrap.os.path.isdir', return_value=False)
 @mock.patch('aeon_ztp.bin.centos_bootstrap.time')
@@ -271,14 +280,14 @@ def test_main_invalid_topdir(mock_cli_parse, mock_time, mock_isdir, mock_exit, c
 
 @mock.patch('aeon_ztp.bin.centos_bootstrap.CentOSBootstrap')
 @mock.patch('aeon_ztp.bin.centos_bootstrap.CentOSBootstrap.check_os_install_and_finally')
-@mock.patch('aeon_ztp.bin.centos_bootstrap.CentOSBootstrap.wait_for_device')
+@mock.patch('aeon_ztp.bin.centos_bootstrap.CentOSBootstrap.wait_for_device_steps')
 @mock.patch('aeon_ztp.bin.centos_bootstrap.CentOSBootstrap.exit_results', side_effect=SystemExit)
 @mock.patch('aeon_ztp.bin.centos_bootstrap.os.path.isdir', return_value=True)
 @mock.patch('aeon_ztp.bin.centos_bootstrap.time')
 @mock.patch('aeon_ztp.bin.centos_bootstrap.cli_parse')
 def test_main(mock_cli_parse, mock_time, mock_isdir, mock_exit, mock_wait, mock_check_os_and_finally, mock_ub, ub_obj, cli_args, device):
     mock_cli_parse.return_value = cli_args
-    mock_wait.return_value = device
+    mock_wait.return_value = iter([])
     ub_obj.dev = device
     mock_ub.return_value = ub_obj
     with pytest.raises(SystemExit):
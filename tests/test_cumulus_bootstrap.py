@@ -20,7 +20,8 @@ args = {
     'init_delay': '90',
     'user': 'admin',
     'env_user': 'ENV_USER',
-    'env_passwd': 'ENV_PASS'
+    'env_passwd': 'ENV_PASS',
+    'resume': 'False'
 }
 
 facts = {
@@ -103,11 +104,12 @@ def test_cumulus_bootstrap(cli_args, cb_obj):
     assert cli_args == cb_obj.cli_args
 
 
-@mock.patch('aeon_ztp.bin.cumulus_bootstrap.requests')
-def test_post_device_facts(mock_requests, device, cb_obj):
+@mock.patch('aeon_ztp.api.client.api_session')
+def test_post_device_facts(mock_session, device, cb_obj):
     cb_obj.dev = device
     cb_obj.post_device_facts()
-    mock_requests.put.assert_called_with(json={
+    cb_obj.updates.flush()
+    mock_session.return_value.put.assert_called_with(json={'facts': [{
         'os_version': device.facts['os_version'],
         'os_name': device.facts['os_name'],
         'ip_addr': device.target,
@@ -116,25 +118,25 @@ def test_post_device_facts(mock_requests, device, cb_obj):
         'facts': json.dumps(device.facts),
         'image_name': None,
         'finally_script': None
-    },
-        url='http://{}/api/devices/facts'.format(args['server']))
+    }], 'status': []},
+        url='http://{}/api/devices/batch'.format(args['server']))
 
 
-@mock.patch('aeon_ztp.bin.cumulus_bootstrap.requests')
-def test_post_device_status(mock_requests, device, cb_obj):
+@mock.patch('aeon_ztp.api.client.api_session')
+def test_post_device_status(mock_session, device, cb_obj):
     kw = {
         'message': 'Test message',
         'state': 'DONE'
     }
     cb_obj.dev = device
     cb_obj.post_device_status(**kw)
-    mock_requests.put.assert_called_with(json={
+    mock_session.return_value.put.assert_called_with(json={'facts': [], 'status': [{
         'message': kw['message'],
         'os_name': device.facts['os_name'],
         'ip_addr': device.target,
         'state': kw['state']
-    },
-        url='http://{}/api/devices/status'.format(args['server']))
+    }]},
+        url='http://{}/api/devices/batch'.format(args['server']))
 
 
 @mock.patch('aeon_ztp.bin.cumulus_bootstrap.CumulusBootstrap.post_device_status')
@@ -147,7 +149,8 @@ def test_exit_results(mock_post, cb_obj, device):
         cb_obj.exit_results(**kw)
     mock_post.assert_called_with(
         state='DONE',
-        message='bootstrap completed OK'
+        message='bootstrap completed OK',
+        phases=[]
     )
     assert e.value.code == 0
 
@@ -161,7 +164,8 @@ def test_exit_results(mock_post, cb_obj, device):
         cb_obj.exit_results(**kw)
     mock_post.assert_called_with(
         state='FAILED',
-        message=kw['results']['message']
+        message=kw['results']['message'],
+        phases=[]
     )
     assert e.value.code == 1
 
@@ -196,8 +200,8 @@ def test_wait_for_device_missing_passwd(mock_exit, cli_args, device):
 @mock.patch('aeon_ztp.bin.cumulus_bootstrap.CumulusBootstrap.exit_results', side_effect=SystemExit)
 @mock.patch('aeon_ztp.bin.cumulus_bootstrap.Device', side_effect=AuthenticationException)
 @mock.patch('aeon_ztp.bin.cumulus_bootstrap.CumulusBootstrap.post_device_status')
-@mock.patch('aeon_ztp.bin.cumulus_bootstrap.requests.put')
-def test_wait_for_device_auth_exception(mock_requests, mock_post_dev, mock_dev, mock_exit, cb_obj):
+@mock.patch('aeon_ztp.api.client.api_session')
+def test_wait_for_device_auth_exception(mock_session, mock_post_dev, mock_dev, mock_exit, cb_obj):
     with pytest.raises(SystemExit):
         cb_obj.wait_for_device(1, 2)
     mock_exit.assert_called_with(
@@ -300,15 +304,10 @@ def test_wait_for_onie_rescue_exception(mock_pxssh, mock_post_dev, mock_exit_res
 
 
 @mock.patch('aeon_ztp.bin.cumulus_bootstrap.CumulusBootstrap.exit_results', side_effect=SystemExit)
-@mock.patch('aeon_ztp.bin.cumulus_bootstrap.json.loads')
-@mock.patch('aeon_ztp.bin.cumulus_bootstrap.subprocess.Popen')
-def test_check_os_install_json_exception(mock_subprocess, mock_json, mock_exit, cb_obj, device):
+@mock.patch('aeon_ztp.bin.cumulus_bootstrap.select_os', side_effect=KeyError('hw_model'))
+def test_check_os_install_select_exception(mock_select, mock_exit, cb_obj, device):
     cb_obj.dev = device
-    test_stdout = 'test stdout'
-    exception_msg = 'test exception message'
-    errmsg = 'Unable to load os-select output as JSON: {}\n {}'.format(test_stdout, exception_msg)
-    mock_json.side_effect = Exception(exception_msg)
-    mock_subprocess.return_value.communicate.return_value = (test_stdout, 'test stderr')
+    errmsg = 'Unable to select the OS: {}'.format(str(KeyError('hw_model')))
     with pytest.raises(SystemExit):
         cb_obj.check_os_install_and_finally()
     mock_exit.assert_called_with(
@@ -321,19 +320,15 @@ def test_check_os_install_json_exception(mock_subprocess, mock_json, mock_exit,
     )
 
 
-@mock.patch('aeon_ztp.bin.cumulus_bootstrap.subprocess.Popen')
-def test_get_required_os(mock_subprocess, device):
-    expected_os_sel_output = '{"output": "os-select test output"}'
-    mock_subprocess.return_value.communicate.return_value = (expected_os_sel_output, 'stderr')
-    local_cb = cumulus_bootstrap.CumulusBootstrap(args['server'], cli_args())
-    local_cb.dev = device
-    conf_fpath = '{topdir}/etc/profiles/cumulus/os-selector.cfg'.format(topdir=cli_args().topdir)
-    cmd = "{topdir}/bin/aztp_os_selector.py -j '{dev_json}' -c {config}".format(topdir=cli_args().topdir,
-                                                                                dev_json=json.dumps(device.facts),
-                                                                                config=conf_fpath)
-    os_sel_output = local_cb.check_os_install_and_finally()
-    assert os_sel_output == json.loads(expected_os_sel_output)
-    mock_subprocess.assert_called_with(cmd, shell=True, stdout=-1)
+@mock.patch('aeon_ztp.bin.cumulus_bootstrap.select_os')
+def test_check_os_install(mock_select, cb_obj, device):
+    cb_obj.dev = device
+    conf_fpath = '{}/etc/profiles/cumulus/os-selector.cfg'.format(cb_obj.cli_args.topdir)
+    mock_select.return_value = {'ok': True, 'image_name': 'test_image', 'finally': 'finally'}
+    results = cb_obj.check_os_install_and_finally()
+    mock_select.assert_called_with(device.facts, conf_fpath)
+    assert results == mock_select.return_value
+    assert (cb_obj.image_name, cb_obj.finally_script) == ('test_image', 'finally')
 
 
 @mock.patch('aeon_ztp.bin.cumulus_bootstrap.CumulusBootstrap.exit_results', side_effect=SystemExit)
@@ -415,9 +410,9 @@ def test_install_os_image_not_all_good(mock_exit_results, mock_os, mock_con, dev
                                                              'Error message: {errmsg}'.format(cmd=cmd, errmsg=errmsg)})
 
 
-@mock.patch('aeon_ztp.bin.cumulus_bootstrap.CumulusBootstrap.wait_for_onie_rescue')
+@mock.patch('aeon_ztp.bin.cumulus_bootstrap.CumulusBootstrap.wait_for_onie_rescue_steps')
 @mock.patch('aeon_ztp.bin.cumulus_bootstrap.CumulusBootstrap.onie_install')
-@mock.patch('aeon_ztp.bin.cumulus_bootstrap.CumulusBootstrap.wait_for_device')
+@mock.patch('aeon_ztp.bin.cumulus_bootstrap.CumulusBootstrap.wait_for_device_steps')
 @mock.patch('aeon_ztp.bin.cumulus_bootstrap.time')
 @mock.patch('aeon.cumulus.device.Connector')
 @mock.patch('aeon_ztp.bin.cumulus_bootstrap.os.path.exists', return_value=True)
@@ -445,10 +440,39 @@ def test_install_os_image(mock_os, mock_con, mock_time, mock_wait_device,
     assert device.api.method_calls == method_calls
 
 
+@mock.patch('aeon_ztp.ztp_admission.image_transfers')
+@mock.patch('aeon_ztp.bin.cumulus_bootstrap.CumulusBootstrap.wait_for_onie_rescue_steps', return_value=iter([]))
+@mock.patch('aeon_ztp.bin.cumulus_bootstrap.CumulusBootstrap.onie_install')
+@mock.patch('aeon_ztp.bin.cumulus_bootstrap.CumulusBootstrap.wait_for_device_steps', return_value=iter([]))
+@mock.patch('aeon_ztp.bin.cumulus_bootstrap.time')
+@mock.patch('aeon.cumulus.device.Connector')
+@mock.patch('aeon_ztp.bin.cumulus_bootstrap.os.path.exists', return_value=True)
+def test_install_os_waits_for_transfer_slot(mock_os, mock_con, mock_time, mock_wait_device,
+                                            mock_onie_install, mock_wait_for_onie, mock_transfers, device, cli_args):
+    ticket = mock.MagicMock()
+    mock_transfers.acquire.side_effect = [None, ticket]
+    device.api.execute.return_value = (True, 'test result message')
+    local_cb = cumulus_bootstrap.CumulusBootstrap(args['server'], cli_args)
+    local_cb.dev = device
+    local_cb.image_name = 'test_image'
+    local_cb.post_device_status = mock.Mock()
+    downloads = []
+    mock_onie_install.side_effect = lambda: downloads.append(ticket.release.called)
+    device.api.execute.side_effect = lambda cmds: downloads.append(ticket.release.called) or (True, '')
+
+    local_cb.install_os()
+
+    mock_transfers.acquire.assert_called_with(_OS_NAME)
+    local_cb.post_device_status.assert_any_call(message='waiting for an image transfer slot', state='AWAIT-TRANSFER')
+    # the slot is held while the image is downloaded, and released after
+    assert False in downloads
+    ticket.release.assert_called_once_with()
+
+
 @mock.patch('aeon_ztp.bin.cumulus_bootstrap.time')
-@mock.patch('aeon_ztp.bin.cumulus_bootstrap.CumulusBootstrap.install_os')
+@mock.patch('aeon_ztp.bin.cumulus_bootstrap.CumulusBootstrap.install_os_steps')
 @mock.patch('aeon_ztp.bin.cumulus_bootstrap.CumulusBootstrap.check_os_install_and_finally')
-@mock.patch('aeon_ztp.bin.cumulus_bootstrap.CumulusBootstrap.wait_for_device')
+@mock.patch('aeon_ztp.bin.cumulus_bootstrap.CumulusBootstrap.wait_for_device_steps')
 def test_ensure_os_version(mock_wait_for_device, mock_get_os, mock_install_os, mock_time, device, cli_args):
     results = 'test result message'
     device.api.execute.return_value = (True, results)
@@ -500,15 +524,15 @@ def test_main_invalid_topdir(mock_cli_parse, mock_time, mock_isdir, mock_exit, c
 
 @mock.patch('aeon_ztp.bin.cumulus_bootstrap.CumulusBootstrap')
 @mock.patch('aeon_ztp.bin.cumulus_bootstrap.CumulusBootstrap.check_os_install_and_finally')
-@mock.patch('aeon_ztp.bin.cumulus_bootstrap.CumulusBootstrap.ensure_os_version')
-@mock.patch('aeon_ztp.bin.cumulus_bootstrap.CumulusBootstrap.wait_for_device')
+@mock.patch('aeon_ztp.bin.cumulus_bootstrap.CumulusBootstrap.ensure_os_version_steps')
+@mock.patch('aeon_ztp.bin.cumulus_bootstrap.CumulusBootstrap.wait_for_device_steps')
 @mock.patch('aeon_ztp.bin.cumulus_bootstrap.CumulusBootstrap.exit_results', side_effect=SystemExit)
 @mock.patch('aeon_ztp.bin.cumulus_bootstrap.os.path.isdir', return_value=True)
 @mock.patch('aeon_ztp.bin.cumulus_bootstrap.time')
 @mock.patch('aeon_ztp.bin.cumulus_bootstrap.cli_parse')
 def test_main(mock_cli_parse, mock_time, mock_isdir, mock_exit, mock_wait, mock_ensure_os, mock_check_os_and_finally, mock_cb, cli_args, device, cb_obj):
     mock_cli_parse.return_value = cli_args
-    mock_wait.return_value = device
+    mock_wait.return_value = iter([])
     cb_obj.dev = device
     mock_cb.return_value = cb_obj
 
@@ -520,3 +544,21 @@ def test_main(mock_cli_parse, mock_time, mock_isdir, mock_exit, mock_wait, mock_
         assert not mock_ensure_os.called
     else:
         mock_ensure_os.assert_called
+
+
+@mock.patch('aeon_ztp.bin.cumulus_bootstrap.time')
+def test_ensure_os_version_resumed_after_copy(mock_time, device, cb_obj):
+    # a Cumulus 2.x install interrupted before the reboot only reboots
+    cb_obj.dev = device
+    cb_obj.checkpoints.saved = {'image-selected': {'image_name': 'image_file_name', 'finally_script': None},
+                                'image-copied': {}}
+    cb_obj.install_os_steps = mock.Mock()
+    cb_obj.post_device_facts = mock.Mock()
+    cb_obj.wait_for_device_steps = mock.Mock(return_value=iter([]))
+    cb_obj.ensure_os_version()
+    assert not cb_obj.install_os_steps.called
+    if semver.parse_version_info(device.facts['os_version']).major < 3:
+        device.api.execute.assert_called_with(['sudo reboot'])
+        assert 'rebooted' in cb_obj.checkpoints.saved
+    else:
+        assert not device.api.execute.called
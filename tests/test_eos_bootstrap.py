@@ -20,7 +20,8 @@ args = {
     'init_delay': '90',
     'user': 'admin',
     'env_user': 'ENV_USER',
-    'env_passwd': 'ENV_PASS'
+    'env_passwd': 'ENV_PASS',
+    'resume': 'False'
 }
 
 # Facts for device that will not be upgraded
@@ -98,11 +99,12 @@ def test_eos_bootstrap(cli_args, eb_obj):
     assert cli_args == eb_obj.cli_args
 
 
-@patch('aeon_ztp.bin.eos_bootstrap.requests')
-def test_post_device_facts(mock_requests, device, eb_obj):
+@patch('aeon_ztp.api.client.api_session')
+def test_post_device_facts(mock_session, device, eb_obj):
     eb_obj.dev = device
     eb_obj.post_device_facts()
-    mock_requests.put.assert_called_with(json={
+    eb_obj.updates.flush()
+    mock_session.return_value.put.assert_called_with(json={'facts': [{
         'os_version': device.facts['os_version'],
         'os_name': device.facts['os'],
         'ip_addr': device.target,
@@ -111,25 +113,25 @@ def test_post_device_facts(mock_requests, device, eb_obj):
         'facts': json.dumps(device.facts),
         'image_name': None,
         'finally_script': None
-    },
-        url='http://{}/api/devices/facts'.format(args['server']))
+    }], 'status': []},
+        url='http://{}/api/devices/batch'.format(args['server']))
 
 
-@patch('aeon_ztp.bin.eos_bootstrap.requests')
-def test_post_device_status(mock_requests, device, eb_obj):
+@patch('aeon_ztp.api.client.api_session')
+def test_post_device_status(mock_session, device, eb_obj):
     kw = {
         'message': 'Test message',
         'state': 'DONE'
     }
     eb_obj.dev = device
     eb_obj.post_device_status(**kw)
-    mock_requests.put.assert_called_with(json={
+    mock_session.return_value.put.assert_called_with(json={'facts': [], 'status': [{
         'message': kw['message'],
         'os_name': device.facts['os'],
         'ip_addr': device.target,
         'state': kw['state']
-    },
-        url='http://{}/api/devices/status'.format(args['server']))
+    }]},
+        url='http://{}/api/devices/batch'.format(args['server']))
 
 
 def test_post_device_status_no_dev(eb_obj):
@@ -150,7 +152,8 @@ def test_exit_results(mock_post, eb_obj, device):
         eb_obj.exit_results(**kw)
     mock_post.assert_called_with(
         state='DONE',
-        message='bootstrap completed OK'
+        message='bootstrap completed OK',
+        phases=[]
     )
     assert e.value.code == 0
 
@@ -164,7 +167,8 @@ def test_exit_results(mock_post, eb_obj, device):
         eb_obj.exit_results(**kw)
     mock_post.assert_called_with(
         state='FAILED',
-        message=kw['results']['message']
+        message=kw['results']['message'],
+        phases=[]
     )
     assert e.value.code == 1
 
@@ -220,6 +224,7 @@ def test_wait_for_device_command_error(mock_post_dev, mock_dev, mock_exit, mock_
 def test_wait_for_device_probe_error(mock_post_dev, mock_dev, mock_exit, eb_obj):
     with pytest.raises(SystemExit):
         eb_obj.wait_for_device(1, 2)
+    assert [(phase['phase'], phase['ok']) for phase in eb_obj.timer.report()] == [('wait-for-device', False)]
     errmsg = 'Failed to probe target %s within reload countdown' % eb_obj.cli_args.target
     mock_exit.assert_called_with(
         exit_error=errmsg,
@@ -318,15 +323,10 @@ def test_ensure_md5sum_md5_doesnt_exist(eb_obj):
 
 
 @patch('aeon_ztp.bin.eos_bootstrap.EosBootstrap.exit_results', side_effect=SystemExit)
-@patch('aeon_ztp.bin.eos_bootstrap.json.loads')
-@patch('aeon_ztp.bin.eos_bootstrap.subprocess.Popen')
-def test_check_os_install_json_exception(mock_subprocess, mock_json, mock_exit, eb_obj, device):
+@patch('aeon_ztp.bin.eos_bootstrap.select_os', side_effect=KeyError('hw_model'))
+def test_check_os_install_select_exception(mock_select, mock_exit, eb_obj, device):
     eb_obj.dev = device
-    test_stdout = 'test stdout'
-    exception_msg = 'test exception message'
-    errmsg = 'Unable to load os-select output as JSON: {}\n {}'.format(test_stdout, exception_msg)
-    mock_json.side_effect = Exception(exception_msg)
-    mock_subprocess.return_value.communicate.return_value = (test_stdout, 'test stderr')
+    errmsg = 'Unable to select the OS: {}'.format(str(KeyError('hw_model')))
     with pytest.raises(SystemExit):
         eb_obj.check_os_install_and_finally()
     mock_exit.assert_called_with(
@@ -339,21 +339,15 @@ def test_check_os_install_json_exception(mock_subprocess, mock_json, mock_exit,
     )
 
 
-@patch('aeon_ztp.bin.eos_bootstrap.EosBootstrap.exit_results', side_effect=SystemExit)
-@patch('aeon_ztp.bin.eos_bootstrap.subprocess.Popen')
-def test_check_os_install(mock_subprocess, mock_exit, eb_obj, device):
+@patch('aeon_ztp.bin.eos_bootstrap.select_os')
+def test_check_os_install(mock_select, eb_obj, device):
     eb_obj.dev = device
-    aztp_file = '{}/bin/aztp_os_selector.py'.format(eb_obj.cli_args.topdir)
     conf_fpath = '{}/etc/profiles/eos/os-selector.cfg'.format(eb_obj.cli_args.topdir)
-    facts = json.dumps(device.facts)
-    json_string = '{"test_key": "test_value", "image_name": "test_image", "finally": "finally"}'
-    mock_subprocess.return_value.communicate.return_value = (json_string, 'test stderr')
+    mock_select.return_value = {'ok': True, 'image_name': 'test_image', 'finally': 'finally'}
     results = eb_obj.check_os_install_and_finally()
-    mock_subprocess.assert_called_with('{aztp_file} -j \'{facts}\' -c {conf_fpath}'.format(aztp_file=aztp_file,
-                                                                                           facts=facts,
-                                                                                           conf_fpath=conf_fpath),
-                                       shell=True, stdout=-1)
-    assert results == json.loads(json_string)
+    mock_select.assert_called_with(device.facts, conf_fpath)
+    assert results == mock_select.return_value
+    assert (eb_obj.image_name, eb_obj.finally_script) == ('test_image', 'finally')
 
 
 @patch('retrying.time')
@@ -465,25 +459,62 @@ def test_do_ensure_os_version(mock_time, eb_obj, device):
     eb_obj.finally_script = finally_script
     eb_obj.check_os_install_and_finally = Mock(return_value={'image': image_name, 'finally': finally_script})
     eb_obj.do_os_install = MagicMock()
-    eb_obj.wait_for_device = Mock(return_value=device)
+    eb_obj.wait_for_device_steps = Mock(return_value=iter([10]))
     retval = eb_obj.do_ensure_os_version()
 
     eb_obj.do_os_install.assert_called()
     device.api.execute.assert_called_with('reload now')
+    eb_obj.wait_for_device_steps.assert_called_with(countdown=eb_obj.cli_args.reload_delay, poll_delay=10)
+    assert mock_time.sleep.call_args_list == [call(eb_obj.cli_args.init_delay), call(10)]
     assert retval == device
+    assert [phase['phase'] for phase in eb_obj.timer.report()] == ['reboot']
+
+
+@patch('aeon_ztp.ztp_admission.image_transfers')
+@patch('aeon_ztp.bin.eos_bootstrap.time')
+def test_do_ensure_os_version_waits_for_transfer_slot(mock_time, mock_transfers, eb_obj, device):
+    ticket = MagicMock()
+    mock_transfers.acquire.side_effect = [None, None, ticket]
+    eb_obj.dev = device
+    eb_obj.image_name = 'EOS-4.16.6M.swi'
+    eb_obj.check_os_install_and_finally = Mock(return_value={'image': 'EOS-4.16.6M.swi', 'finally': 'finally'})
+    eb_obj.do_os_install = Mock(side_effect=lambda: ticket.release.assert_not_called())
+    eb_obj.post_device_status = Mock()
+    eb_obj.wait_for_device_steps = Mock(return_value=iter([]))
+    eb_obj.do_ensure_os_version()
+
+    mock_transfers.acquire.assert_called_with('eos')
+    eb_obj.post_device_status.assert_any_call(message='waiting for an image transfer slot', state='AWAIT-TRANSFER')
+    assert mock_time.sleep.call_args_list[:2] == [call(10), call(10)]
+    eb_obj.do_os_install.assert_called()
+    ticket.release.assert_called_once_with()
+    assert 'await-transfer' in [phase['phase'] for phase in eb_obj.timer.report()]
+
+
+@patch('aeon_ztp.ztp_admission.image_transfers')
+@patch('aeon_ztp.bin.eos_bootstrap.time')
+def test_do_ensure_os_version_releases_transfer_slot_on_error(mock_time, mock_transfers, eb_obj, device):
+    eb_obj.dev = device
+    eb_obj.image_name = 'EOS-4.16.6M.swi'
+    eb_obj.check_os_install_and_finally = Mock(return_value={'image': 'EOS-4.16.6M.swi', 'finally': 'finally'})
+    eb_obj.do_os_install = Mock(side_effect=SystemExit(1))
+    with pytest.raises(SystemExit):
+        eb_obj.do_ensure_os_version()
+    mock_transfers.acquire.return_value.release.assert_called_once_with()
 
 
 @patch('aeon_ztp.bin.eos_bootstrap.EosBootstrap')
 @patch('aeon_ztp.bin.eos_bootstrap.EosBootstrap.check_os_install_and_finally')
-@patch('aeon_ztp.bin.eos_bootstrap.EosBootstrap.do_ensure_os_version')
-@patch('aeon_ztp.bin.eos_bootstrap.EosBootstrap.wait_for_device')
+@patch('aeon_ztp.bin.eos_bootstrap.EosBootstrap.do_ensure_os_version_steps')
+@patch('aeon_ztp.bin.eos_bootstrap.EosBootstrap.wait_for_device_steps')
 @patch('aeon_ztp.bin.eos_bootstrap.EosBootstrap.exit_results', side_effect=SystemExit)
 @patch('aeon_ztp.bin.eos_bootstrap.os.path.isdir', return_value=True)
 @patch('aeon_ztp.bin.eos_bootstrap.time')
 @patch('aeon_ztp.bin.eos_bootstrap.cli_parse')
 def test_main(mock_cli_parse, mock_time, mock_isdir, mock_exit, mock_wait, mock_ensure_os, mock_check_os_and_finally, mock_eb, cli_args, device, eb_obj):
     mock_cli_parse.return_value = cli_args
-    mock_wait.return_value = device
+    mock_wait.return_value = iter([])
+    mock_ensure_os.return_value = iter([])
     eb_obj.dev = device
     mock_eb.return_value = eb_obj
     with pytest.raises(SystemExit):
@@ -507,3 +538,52 @@ def test_main_no_topdir(mock_cli_parse, mock_is_dir, mock_exit, cli_args):
     mock_exit.assert_called_with({'ok': False,
                                   'error_type': 'args',
                                   'message': exc})
+
+
+@patch('aeon_ztp.bin.eos_bootstrap.time')
+def test_do_ensure_os_version_resumed_after_reboot(mock_time, eb_obj, device):
+    eb_obj.dev = device
+    eb_obj.checkpoints.saved = {'image-selected': {'image_name': 'EOS-4.16.6M.swi', 'finally_script': 'finally'},
+                                'rebooted': {}}
+    eb_obj.check_os_install_and_finally = Mock()
+    eb_obj.do_os_install = Mock()
+    eb_obj.post_device_facts = Mock()
+    assert eb_obj.do_ensure_os_version() == device
+    assert eb_obj.image_name == 'EOS-4.16.6M.swi'
+    assert eb_obj.finally_script == 'finally'
+    eb_obj.post_device_facts.assert_called()
+    assert not eb_obj.check_os_install_and_finally.called
+    assert not eb_obj.do_os_install.called
+    assert not mock_time.sleep.called
+
+
+@patch('aeon_ztp.bin.eos_bootstrap.os.path.isfile', return_value=True)
+def test_do_os_install_resumed_after_md5(mock_isfile, eb_obj, device):
+    eb_obj.dev = device
+    eb_obj.image_name = 'EOS-4.16.6M.swi'
+    eb_obj.checkpoints.saved = {'md5-verified': {}}
+    eb_obj.check_md5 = Mock()
+    eb_obj.do_os_install()
+    assert not eb_obj.check_md5.called
+    assert device.api.execute.call_args_list == [call('copy running-config startup-config')]
+    device.api.configure.assert_called_with(['boot system flash:EOS-4.16.6M.swi'])
+
+
+@patch('aeon_ztp.bin.eos_bootstrap.EosBootstrap.do_push_config')
+@patch('aeon_ztp.bin.eos_bootstrap.EosBootstrap.do_ensure_os_version_steps')
+@patch('aeon_ztp.bin.eos_bootstrap.EosBootstrap.wait_for_device_steps')
+@patch('aeon_ztp.bin.eos_bootstrap.EosBootstrap.exit_results', side_effect=SystemExit)
+@patch('aeon_ztp.api.client.get_device_checkpoints')
+def test_bootstrap_steps_resume(mock_get_checkpoints, mock_exit, mock_wait, mock_ensure_os, mock_push_config,
+                                eb_obj, device):
+    mock_get_checkpoints.return_value = {'config-pushed': {}}
+    mock_wait.return_value = iter([])
+    mock_ensure_os.return_value = iter([])
+    eb_obj.cli_args.resume = True
+    eb_obj.dev = device
+    steps = eb_obj.bootstrap_steps()
+    with pytest.raises(SystemExit):
+        # no init-delay when resuming
+        next(steps)
+    mock_get_checkpoints.assert_called_with(args['server'], 'eos', args['target'])
+    assert not mock_push_config.called
@@ -22,7 +22,8 @@ args = {
     'init_delay': '90',
     'user': 'admin',
     'env_user': 'ENV_USER',
-    'env_passwd': 'ENV_PASS'
+    'env_passwd': 'ENV_PASS',
+    'resume': 'False'
 }
 
 factsv703 = {
@@ -98,11 +99,12 @@ def test_nxos_bootstrap(cli_args, nb_obj):
     assert cli_args == nb_obj.cli_args
 
 
-@patch('aeon_ztp.bin.nxos_bootstrap.requests')
-def test_post_device_facts(mock_requests, device, nb_obj):
+@patch('aeon_ztp.api.client.api_session')
+def test_post_device_facts(mock_session, device, nb_obj):
     nb_obj.dev = device
     nb_obj.post_device_facts()
-    mock_requests.put.assert_called_with(json={
+    nb_obj.updates.flush()
+    mock_session.return_value.put.assert_called_with(json={'facts': [{
         'os_version': device.facts['os_version'],
         'os_name': nb_obj.os_name,
         'ip_addr': device.target,
@@ -111,25 +113,25 @@ def test_post_device_facts(mock_requests, device, nb_obj):
         'facts': json.dumps(device.facts),
         'image_name': None,
         'finally_script': None
-    },
-        url='http://{}/api/devices/facts'.format(args['server']))
+    }], 'status': []},
+        url='http://{}/api/devices/batch'.format(args['server']))
 
 
-@patch('aeon_ztp.bin.nxos_bootstrap.requests')
-def test_post_device_status(mock_requests, device, nb_obj):
+@patch('aeon_ztp.api.client.api_session')
+def test_post_device_status(mock_session, device, nb_obj):
     kw = {
         'message': 'Test message',
         'state': 'DONE'
     }
     nb_obj.dev = device
     nb_obj.post_device_status(**kw)
-    mock_requests.put.assert_called_with(json={
+    mock_session.return_value.put.assert_called_with(json={'facts': [], 'status': [{
         'message': kw['message'],
         'os_name': device.facts['os'],
         'ip_addr': device.target,
         'state': kw['state']
-    },
-        url='http://{}/api/devices/status'.format(args['server']))
+    }]},
+        url='http://{}/api/devices/batch'.format(args['server']))
 
 
 def test_post_device_status_no_dev(nb_obj):
@@ -150,7 +152,8 @@ def test_exit_results(mock_post, nb_obj, device):
         nb_obj.exit_results(**kw)
     mock_post.assert_called_with(
         state='DONE',
-        message='bootstrap completed OK'
+        message='bootstrap completed OK',
+        phases=[]
     )
     assert e.value.code == 0
 
@@ -164,7 +167,8 @@ def test_exit_results(mock_post, nb_obj, device):
         nb_obj.exit_results(**kw)
     mock_post.assert_called_with(
         state='FAILED',
-        message=kw['results']['message']
+        message=kw['results']['message'],
+        phases=[]
     )
     assert e.value.code == 1
 
@@ -313,15 +317,10 @@ def test_do_push_config1_no_config(mock_isfile, mock_time, mock_open, mock_retry
 
 
 @patch('aeon_ztp.bin.nxos_bootstrap.NxosBootstrap.exit_results', side_effect=SystemExit)
-@patch('aeon_ztp.bin.nxos_bootstrap.json.loads')
-@patch('aeon_ztp.bin.nxos_bootstrap.subprocess.Popen')
-def test_check_os_install_json_exception(mock_subprocess, mock_json, mock_exit, nb_obj, device):
+@patch('aeon_ztp.bin.nxos_bootstrap.select_os', side_effect=KeyError('hw_model'))
+def test_check_os_install_select_exception(mock_select, mock_exit, nb_obj, device):
     nb_obj.dev = device
-    test_stdout = 'test stdout'
-    exception_msg = 'test exception message'
-    errmsg = 'Unable to load os-select output as JSON: {}\n {}'.format(test_stdout, exception_msg)
-    mock_json.side_effect = Exception(exception_msg)
-    mock_subprocess.return_value.communicate.return_value = (test_stdout, 'test stderr')
+    errmsg = 'Unable to select the OS: {}'.format(str(KeyError('hw_model')))
     with pytest.raises(SystemExit):
         nb_obj.check_os_install_and_finally()
     mock_exit.assert_called_with(
@@ -334,21 +333,15 @@ def test_check_os_install_json_exception(mock_subprocess, mock_json, mock_exit,
     )
 
 
-@patch('aeon_ztp.bin.nxos_bootstrap.NxosBootstrap.exit_results', side_effect=SystemExit)
-@patch('aeon_ztp.bin.nxos_bootstrap.subprocess.Popen')
-def test_check_os_install(mock_subprocess, mock_exit, nb_obj, device):
+@patch('aeon_ztp.bin.nxos_bootstrap.select_os')
+def test_check_os_install(mock_select, nb_obj, device):
     nb_obj.dev = device
-    aztp_file = '{}/bin/aztp_os_selector.py'.format(nb_obj.cli_args.topdir)
     conf_fpath = '{}/etc/profiles/nxos/os-selector.cfg'.format(nb_obj.cli_args.topdir)
-    facts = json.dumps(device.facts)
-    json_string = '{"test_key": "test_value"}'
-    mock_subprocess.return_value.communicate.return_value = (json_string, 'test stderr')
+    mock_select.return_value = {'ok': True, 'image_name': 'test_image', 'finally': 'finally'}
     results = nb_obj.check_os_install_and_finally()
-    mock_subprocess.assert_called_with('{aztp_file} -j \'{facts}\' -c {conf_fpath}'.format(aztp_file=aztp_file,
-                                                                                           facts=facts,
-                                                                                           conf_fpath=conf_fpath),
-                                       shell=True, stdout=-1)
-    assert results == json.loads(json_string)
+    mock_select.assert_called_with(device.facts, conf_fpath)
+    assert results == mock_select.return_value
+    assert (nb_obj.image_name, nb_obj.finally_script) == ('test_image', 'finally')
 
 
 def test_ensure_md5sum_md5_exists(nb_obj):
@@ -431,7 +424,7 @@ def test_do_ensure_os_version_not_ok(mock_time, mock_exit, nb_obj, device):
         nb.image_name = image_name
     nb_obj.check_os_install_and_finally = Mock(side_effect=set_image_name(nb_obj, image_name))
     nb_obj.do_os_install = Mock(return_value={'ok': False})
-    nb_obj.wait_for_device = Mock(return_value=device)
+    nb_obj.wait_for_device_steps = Mock(return_value=iter([]))
     errmsg = 'software install [{ver}] FAILED: {reason}'.format(
         ver=image_name, reason=json.dumps(os_inst_ret))
     with pytest.raises(SystemExit):
@@ -444,6 +437,27 @@ def test_do_ensure_os_version_not_ok(mock_time, mock_exit, nb_obj, device):
     })
 
 
+@patch('aeon_ztp.bin.nxos_bootstrap.NxosBootstrap.exit_results', side_effect=SystemExit)
+@patch('aeon_ztp.ztp_admission.image_transfers')
+@patch('aeon_ztp.bin.nxos_bootstrap.time')
+def test_do_ensure_os_version_transfer_slot(mock_time, mock_transfers, mock_exit, nb_obj, device):
+    ticket = MagicMock()
+    mock_transfers.acquire.side_effect = [None, ticket]
+    nb_obj.dev = device
+    nb_obj.image_name = 'nxos-1.1.1.1'
+    nb_obj.check_os_install_and_finally = Mock()
+    nb_obj.post_device_status = Mock()
+    nb_obj.do_os_install = Mock(return_value={'ok': False})
+    with pytest.raises(SystemExit):
+        nb_obj.do_ensure_os_version()
+
+    nb_obj.post_device_status.assert_any_call(message='waiting for an image transfer slot', state='AWAIT-TRANSFER')
+    assert mock_time.sleep.call_args_list == [call(10)]
+    nb_obj.do_os_install.assert_called()
+    ticket.release.assert_called_once_with()
+    assert [phase['phase'] for phase in nb_obj.timer.report()] == ['await-transfer']
+
+
 @patch('aeon_ztp.bin.nxos_bootstrap.time')
 def test_do_ensure_os_version(mock_time, nb_obj, device):
     image_name = 'nxos-1.1.1.1'
@@ -453,10 +467,12 @@ def test_do_ensure_os_version(mock_time, nb_obj, device):
         nb.image_name = image_name
     nb_obj.check_os_install_and_finally = Mock(side_effect=set_image_name(nb_obj, image_name))
     nb_obj.do_os_install = Mock(return_value={'ok': True})
-    nb_obj.wait_for_device = Mock(return_value=device)
+    nb_obj.wait_for_device_steps = Mock(return_value=iter([10]))
     retval = nb_obj.do_ensure_os_version()
 
     nb_obj.do_os_install.assert_called()
+    nb_obj.wait_for_device_steps.assert_called_with(countdown=nb_obj.cli_args.reload_delay, poll_delay=10)
+    assert mock_time.sleep.call_args_list == [call(nb_obj.cli_args.init_delay), call(10)]
     assert retval == device
 
 
@@ -475,15 +491,16 @@ def test_main_no_topdir(mock_cli_parse, mock_is_dir, mock_exit, cli_args):
 
 @patch('aeon_ztp.bin.nxos_bootstrap.NxosBootstrap')
 @patch('aeon_ztp.bin.nxos_bootstrap.NxosBootstrap.check_os_install_and_finally')
-@patch('aeon_ztp.bin.nxos_bootstrap.NxosBootstrap.do_ensure_os_version')
-@patch('aeon_ztp.bin.nxos_bootstrap.NxosBootstrap.wait_for_device')
+@patch('aeon_ztp.bin.nxos_bootstrap.NxosBootstrap.do_ensure_os_version_steps')
+@patch('aeon_ztp.bin.nxos_bootstrap.NxosBootstrap.wait_for_device_steps')
 @patch('aeon_ztp.bin.nxos_bootstrap.NxosBootstrap.exit_results', side_effect=SystemExit)
 @patch('aeon_ztp.bin.nxos_bootstrap.os.path.isdir', return_value=True)
 @patch('aeon_ztp.bin.nxos_bootstrap.time')
 @patch('aeon_ztp.bin.nxos_bootstrap.cli_parse')
 def test_main(mock_cli_parse, mock_time, mock_isdir, mock_exit, mock_wait, mock_ensure_os, mock_check_os_and_finally, mock_nb, cli_args, device, nb_obj):
     mock_cli_parse.return_value = cli_args
-    mock_wait.return_value = device
+    mock_wait.return_value = iter([])
+    mock_ensure_os.return_value = iter([])
     nb_obj.dev = device
     mock_nb.return_value = nb_obj
     with pytest.raises(SystemExit):
@@ -494,3 +511,33 @@ def test_main(mock_cli_parse, mock_time, mock_isdir, mock_exit, mock_wait, mock_
         assert not mock_ensure_os.called
     else:
         mock_ensure_os.assert_called()
+
+
+@patch('aeon_ztp.bin.nxos_bootstrap.time')
+def test_do_ensure_os_version_resumed_after_reboot(mock_time, nb_obj, device):
+    nb_obj.dev = device
+    nb_obj.checkpoints.saved = {'image-selected': {'image_name': 'nxos-1.1.1.1', 'finally_script': None},
+                                'rebooted': {}}
+    nb_obj.check_os_install_and_finally = Mock()
+    nb_obj.do_os_install = Mock()
+    nb_obj.post_device_facts = Mock()
+    assert nb_obj.do_ensure_os_version() == device
+    assert nb_obj.image_name == 'nxos-1.1.1.1'
+    nb_obj.post_device_facts.assert_called()
+    assert not nb_obj.check_os_install_and_finally.called
+    assert not nb_obj.do_os_install.called
+    assert not mock_time.sleep.called
+
+
+@patch('aeon_ztp.bin.nxos_bootstrap.time')
+def test_do_ensure_os_version_checkpoints(mock_time, nb_obj, device):
+    nb_obj.dev = device
+
+    def select():
+        nb_obj.image_name = 'nxos-1.1.1.1'
+    nb_obj.check_os_install_and_finally = Mock(side_effect=select)
+    nb_obj.do_os_install = Mock(return_value={'ok': True})
+    nb_obj.wait_for_device_steps = Mock(return_value=iter([]))
+    nb_obj.do_ensure_os_version()
+    assert nb_obj.checkpoints.saved == {'image-selected': {'image_name': 'nxos-1.1.1.1', 'finally_script': None},
+                                        'rebooted': {}}
@@ -0,0 +1,69 @@
+import pytest
+from mock import MagicMock, patch
+
+from aeon_ztp.ztp_admission import Admission, parse_os_values, wait_for_transfer_slot_steps
+from aeon_ztp.ztp_timing import PhaseTimer
+
+
+@pytest.fixture()
+def admission(tmpdir):
+    return Admission(directory=str(tmpdir.join('slots')), limit=3, os_limits={'cumulus': 2})
+
+
+def test_parse_os_values():
+    assert parse_os_values('cumulus=4, eos=8') == {'cumulus': 4, 'eos': 8}
+    assert parse_os_values('') == {}
+    assert parse_os_values(None) == {}
+
+
+def test_os_limit(admission):
+    tickets = [admission.acquire('cumulus') for _ in range(2)]
+    assert all(tickets)
+    assert admission.acquire('cumulus') is None
+    # the failed attempt does not keep a global slot
+    assert admission.acquire('eos') is not None
+
+    tickets[0].release()
+    assert admission.acquire('cumulus') is not None
+
+
+def test_global_limit(admission):
+    tickets = [admission.acquire('eos') for _ in range(3)]
+    assert all(tickets)
+    assert admission.acquire('nxos') is None
+    assert admission.acquire('cumulus') is None
+    tickets.pop().release()
+    assert admission.acquire('nxos') is not None
+
+
+def test_no_limit(tmpdir):
+    admission = Admission(directory=str(tmpdir))
+    tickets = [admission.acquire('eos') for _ in range(100)]
+    assert all(tickets)
+    assert tmpdir.listdir() == []
+
+
+def test_transfer(admission):
+    ticket = admission.acquire('cumulus')
+    admission.acquire('cumulus')
+    moved = ticket.transfer()
+    ticket.release()
+    assert admission.acquire('cumulus') is None
+    moved.release()
+    moved.release()
+    assert admission.acquire('cumulus') is not None
+
+
+def test_wait_for_transfer_slot_steps(tmpdir):
+    boot = MagicMock(os_name='eos', timer=PhaseTimer())
+    slots = Admission(directory=str(tmpdir), limit=1)
+    held = slots.acquire('eos')
+    with patch('aeon_ztp.ztp_admission.image_transfers', slots):
+        steps = wait_for_transfer_slot_steps(boot, poll_delay=5)
+        assert next(steps) == 5
+        boot.post_device_status.assert_called_with(message='waiting for an image transfer slot', state='AWAIT-TRANSFER')
+        held.release()
+        assert list(steps) == []
+    assert boot.transfer is not None
+    boot.transfer.release()
+    assert [phase['phase'] for phase in boot.timer.report()] == ['await-transfer']
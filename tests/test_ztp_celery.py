@@ -0,0 +1,359 @@
+import logging
+from datetime import datetime
+
+import pytest
+from celery.exceptions import Retry
+from mock import MagicMock, call, patch
+
+from aeon_ztp import ztp_celery
+from aeon_ztp.api import models, repository
+
+
+def fake_bootstrapper(exit_code=None, error=None, delays=()):
+    module = MagicMock()
+
+    def create_bootstrapper(cmdargs):
+        boot = MagicMock()
+        boot.log = logging.getLogger('eos-bootstrap.1.2.3.4')
+        boot.log.addHandler(logging.NullHandler())
+
+        def bootstrap_steps():
+            for delay in delays:
+                yield delay
+            if error:
+                raise error
+            if exit_code is not None:
+                raise SystemExit(exit_code)
+
+        boot.bootstrap_steps.side_effect = bootstrap_steps
+        return boot
+
+    module.create_bootstrapper.side_effect = create_bootstrapper
+    return module
+
+
+@patch('aeon_ztp.ztp_celery.import_module')
+def test_run_bootstrapper_exit_code(mock_import):
+    mock_import.return_value = fake_bootstrapper(exit_code=3)
+    assert ztp_celery.run_bootstrapper('eos', ['--target', '1.2.3.4']) == (3, '')
+    mock_import.assert_called_with('aeon_ztp.bin.eos_bootstrap')
+    mock_import.return_value.create_bootstrapper.assert_called_with(['--target', '1.2.3.4'])
+
+
+@patch('aeon_ztp.ztp_celery.time')
+@patch('aeon_ztp.ztp_celery.import_module')
+def test_run_bootstrapper_sleeps_between_steps(mock_import, mock_time):
+    mock_import.return_value = fake_bootstrapper(exit_code=0, delays=(5, 10))
+    assert ztp_celery.run_bootstrapper('eos', []) == (0, '')
+    assert mock_time.sleep.call_args_list == [call(5), call(10)]
+
+
+@patch('aeon_ztp.ztp_celery.import_module')
+def test_run_bootstrapper_ok(mock_import):
+    mock_import.return_value = fake_bootstrapper(exit_code=0)
+    assert ztp_celery.run_bootstrapper('eos', []) == (0, '')
+    mock_import.return_value = fake_bootstrapper()
+    assert ztp_celery.run_bootstrapper('eos', []) == (0, '')
+
+
+@patch('aeon_ztp.ztp_celery.import_module')
+def test_run_bootstrapper_exception(mock_import):
+    mock_import.return_value = fake_bootstrapper(error=ValueError('boom'))
+    rc, _stderr = ztp_celery.run_bootstrapper('eos', [])
+    assert rc == 1
+    assert 'ValueError: boom' in _stderr
+
+
+@patch('aeon_ztp.ztp_celery.import_module')
+def test_run_bootstrapper_removes_log_handlers(mock_import):
+    mock_import.return_value = fake_bootstrapper(exit_code=0)
+    logger = logging.getLogger('eos-bootstrap.1.2.3.4')
+    handlers = list(logger.handlers)
+    ztp_celery.run_bootstrapper('eos', [])
+    ztp_celery.run_bootstrapper('eos', [])
+    assert logger.handlers == handlers
+
+
+def test_run_bootstrapper_bad_args():
+    # argparse exits with 2 on a missing required argument
+    rc, _stderr = ztp_celery.run_bootstrapper('eos', ['--target', '1.2.3.4'])
+    assert rc == 2
+
+
+@patch('aeon_ztp.ztp_celery._AEON_BOOTSTRAP_MODE', 'inprocess')
+@patch('aeon_ztp.ztp_celery.subprocess')
+@patch('aeon_ztp.ztp_celery.run_bootstrapper', return_value=(0, ''))
+def test_do_bootstrapper_inprocess(mock_run, mock_subprocess):
+    log = MagicMock()
+    assert ztp_celery.do_bootstrapper('1.1.1.1:8080', 'eos', '1.2.3.4', log) == (0, '')
+    os_name, cmd_args = mock_run.call_args[0]
+    assert os_name == 'eos'
+    assert cmd_args[:4] == ['--target', '1.2.3.4', '--server', '1.1.1.1:8080']
+    assert not mock_subprocess.Popen.called
+
+
+@patch('aeon_ztp.ztp_celery._AEON_BOOTSTRAP_MODE', 'inprocess')
+@patch('aeon_ztp.ztp_celery._AEON_DIR', '/opt/aeonztps')
+@patch('aeon_ztp.ztp_celery.subprocess')
+@patch('aeon_ztp.ztp_celery.run_bootstrapper')
+def test_do_bootstrapper_unknown_os_name_runs_subprocess(mock_run, mock_subprocess):
+    mock_subprocess.Popen.return_value.communicate.return_value = ('', '')
+    mock_subprocess.Popen.return_value.returncode = 0
+    log = MagicMock()
+    assert ztp_celery.do_bootstrapper('1.1.1.1:8080', 'custom', '1.2.3.4', log) == (0, '')
+    assert mock_subprocess.Popen.call_args[0][0].startswith('/opt/aeonztps/bin/custom_bootstrap* --target 1.2.3.4')
+    assert not mock_run.called
+
+
+@patch('aeon_ztp.ztp_celery._AEON_BOOTSTRAP_MODE', 'engine')
+@patch('aeon_ztp.ztp_celery.do_bootstrapper')
+@patch('aeon_ztp.ztp_celery.bootstrap_engine')
+@patch('aeon_ztp.ztp_celery.get_server_ipaddr', return_value='1.1.1.1')
+@patch('aeon_ztp.ztp_celery._AEON_PORT', 8080)
+def test_ztp_bootstrapper_engine(mock_ipaddr, mock_engine, mock_do_bootstrapper, app):
+    assert ztp_celery.ztp_bootstrapper('eos', '1.2.3.4') == 0
+    os_name, target, cmd_args = mock_engine.return_value.submit.call_args[0]
+    assert (os_name, target) == ('eos', '1.2.3.4')
+    assert cmd_args[:4] == ['--target', '1.2.3.4', '--server', '1.1.1.1:8080']
+    assert not mock_do_bootstrapper.called
+    # registered directly in the database
+    assert ztp_celery.get_device_state('1.2.3.4', 'eos') == 'REGISTERED'
+
+
+@patch('aeon_ztp.ztp_celery.run_bootstrap')
+@patch('aeon_ztp.ztp_celery.get_server_ipaddr', return_value='1.1.1.1')
+def test_ztp_bootstrapper_duplicate(mock_ipaddr, mock_run, app):
+    ztp_celery.ztp_bootstrapper('eos', '1.2.3.4')
+    ztp_celery.post_device_status('1.2.3.4', 'eos', state='OS-INSTALL', message='installing')
+    mock_run.reset_mock()
+    assert ztp_celery.ztp_bootstrapper('eos', '1.2.3.4') is None
+    assert not mock_run.called
+
+
+def test_device_status_and_facts(device):
+    ztp_celery.post_device_status('1.2.3.4', 'NXOS', state='OS-INSTALL', message='installing')
+    assert ztp_celery.get_device_state('1.2.3.4', 'NXOS') == 'OS-INSTALL'
+    facts = ztp_celery.get_device_facts('1.2.3.4', 'NXOS')
+    assert facts['mac_address'] == '00112233445566'
+    assert facts['finally_script'] == 'finally'
+    assert facts['message'] == 'installing'
+    assert ztp_celery.get_device_state('1.2.3.5', 'NXOS') is None
+    assert ztp_celery.get_device_facts('1.2.3.5', 'NXOS') == {}
+
+
+@patch('aeon_ztp.ztp_celery._app', None)
+@patch('aeon_ztp.initialize_database')
+@patch('aeon_ztp.create_app')
+def test_device_db_worker_app(mock_create_app, mock_init_db):
+    with ztp_celery.device_db() as db:
+        assert db is ztp_celery.aeon_ztp.db.session
+    with ztp_celery.device_db():
+        pass
+    mock_create_app.assert_called_once_with('production')
+    # the worker creates the tables, the web app may not have run yet
+    mock_init_db.assert_called_once_with()
+    mock_create_app.return_value.app_context.return_value.__enter__.assert_called()
+    mock_create_app.return_value.app_context.return_value.__exit__.assert_called()
+
+
+@patch('aeon_ztp.ztp_celery.post_device_status')
+@patch('aeon_ztp.ztp_celery.get_device_facts')
+def test_finish_engine_bootstrap_error(mock_facts, mock_post):
+    assert ztp_celery.finish_engine_bootstrap('1.1.1.1:8080', 'eos', '1.2.3.4', 1, 'boom') == 1
+    assert mock_post.call_args[1]['state'] == 'ERROR'
+    assert not mock_facts.called
+
+
+@patch('aeon_ztp.ztp_celery.do_finalize', return_value=(0, ''))
+@patch('aeon_ztp.ztp_celery.post_device_status')
+@patch('aeon_ztp.ztp_celery.get_device_facts', return_value={})
+def test_finish_engine_bootstrap_done(mock_facts, mock_post, mock_finalize):
+    assert ztp_celery.finish_engine_bootstrap('1.1.1.1:8080', 'eos', '1.2.3.4', 0, '') == 0
+    assert mock_post.call_args[1]['state'] == 'DONE'
+    assert not logging.getLogger('aeon-bootstrapper.1.2.3.4').handlers
+
+
+@patch('aeon_ztp.ztp_celery._AEON_DIR', '/opt/aeonztps')
+@patch('aeon_ztp.ztp_celery._AEON_LOGFILE', None)
+def test_bootstrapper_args_resume():
+    assert ztp_celery.bootstrapper_args('1.1.1.1:8080', '1.2.3.4')[-1] == 'AEON_TPASSWD'
+    assert ztp_celery.bootstrapper_args('1.1.1.1:8080', '1.2.3.4', resume=True)[-1] == '--resume'
+
+
+def add_interrupted(session, devices, node='celery@a'):
+    """ Adds the devices, (os_name, ip_addr, state), with the bootstrap lock
+    of a bootstrap that ran on node.
+    """
+    for os_name, ip_addr, state in devices:
+        session.add(models.Device(os_name=os_name, ip_addr=ip_addr, state=state))
+    session.commit()
+    for os_name, ip_addr, state in devices:
+        token = repository.acquire_bootstrap_lock(session, ip_addr, os_name, ttl=60)
+        ztp_celery.DeviceLock(ip_addr, token).claim(node)
+
+
+@patch('aeon_ztp.ztp_celery.ztp_bootstrapper')
+def test_resume_bootstraps(mock_task, session):
+    add_interrupted(session, [('eos', '1.1.1.1', 'OS-INSTALL'), ('eos', '1.1.1.2', 'DONE'),
+                              ('centos', '1.1.1.3', 'AWAIT-ONLINE'), ('nxos', '1.1.1.4', 'ERROR')])
+    assert ztp_celery.resume_bootstraps(node='celery@a') == [('eos', '1.1.1.1'), ('centos', '1.1.1.3')]
+    lock = mock_task.delay.call_args[1]['lock']
+    mock_task.delay.assert_called_with(os_name='centos', target='1.1.1.3', resume=True, lock=lock)
+    # the resumed bootstraps hold the lock of their device
+    assert not ztp_celery.enqueue_bootstrap('centos', '1.1.1.3')
+
+
+@patch('aeon_ztp.ztp_celery.ztp_bootstrapper')
+def test_resume_bootstraps_other_nodes(mock_task, session):
+    for ip_addr in ('1.1.1.1', '1.1.1.2', '1.1.1.3'):
+        session.add(models.Device(os_name='eos', ip_addr=ip_addr, state='OS-INSTALL'))
+    session.commit()
+    # running on another node, held by this node, and queued
+    for ip_addr, node in (('1.1.1.1', 'celery@b'), ('1.1.1.2', 'celery@a'), ('1.1.1.3', None)):
+        token = repository.acquire_bootstrap_lock(session, ip_addr, 'eos', ttl=60)
+        ztp_celery.DeviceLock(ip_addr, token).claim(node)
+    assert ztp_celery.resume_bootstraps(node='celery@a') == [('eos', '1.1.1.2')]
+
+
+@patch('aeon_ztp.ztp_celery.ztp_bootstrapper')
+def test_resume_bootstraps_not_locked(mock_task, session):
+    # a stale state of a past run, or of a device since replaced, has no lock
+    session.add(models.Device(os_name='eos', ip_addr='1.1.1.1', state='OS-INSTALL'))
+    # a lock of a device not updated within the lock ttl
+    add_interrupted(session, [('eos', '1.1.1.2', 'OS-INSTALL')])
+    session.query(models.Device).update({'updated_at': datetime(2017, 1, 1)})
+    session.commit()
+    assert ztp_celery.resume_bootstraps(node='celery@a') == []
+    assert not mock_task.delay.called
+
+
+@patch('aeon_ztp.ztp_celery.ztp_bootstrapper')
+@patch('aeon_ztp.ztp_celery.repository.locked_device_states', side_effect=IOError('connection refused'))
+def test_resume_bootstraps_database_down(mock_states, mock_task, app):
+    assert ztp_celery.resume_bootstraps() == []
+    assert not mock_task.delay.called
+
+
+@patch('aeon_ztp.ztp_celery.ztp_bootstrapper')
+def test_resume_bootstraps_device_error(mock_task, session):
+    add_interrupted(session, [('eos', '1.1.1.1', 'OS-INSTALL'), ('eos', '1.1.1.2', 'OS-INSTALL')])
+    mock_task.delay.side_effect = [IOError('broker down'), None]
+    assert len(ztp_celery.resume_bootstraps(node='celery@a')) == 1
+    assert mock_task.delay.call_count == 2
+
+
+@patch('aeon_ztp.ztp_celery._AEON_BOOTSTRAP_MODE', 'inprocess')
+@patch('aeon_ztp.ztp_celery.finish_bootstrap', return_value=0)
+@patch('aeon_ztp.ztp_celery.run_bootstrapper', return_value=(0, ''))
+@patch('aeon_ztp.ztp_celery.get_device_state', return_value='OS-INSTALL')
+@patch('aeon_ztp.ztp_celery.repository.register_device')
+@patch('aeon_ztp.ztp_celery.get_server_ipaddr', return_value='1.1.1.1')
+def test_ztp_bootstrapper_resume(mock_ipaddr, mock_register, mock_state, mock_run, mock_finish):
+    assert ztp_celery.ztp_bootstrapper('eos', '1.2.3.4', resume=True) == 0
+    # the device is not registered again
+    assert not mock_register.called
+    assert mock_run.call_args[0][1][-1] == '--resume'
+
+    mock_state.return_value = 'DONE'
+    mock_run.reset_mock()
+    assert ztp_celery.ztp_bootstrapper('eos', '1.2.3.4', resume=True) is None
+    assert not mock_run.called
+
+
+@pytest.mark.parametrize('task, kwargs, queue, priority', [
+    ('aeon_ztp.ztp_celery.ztp_finalizer', {'os_name': 'eos', 'target': '1.2.3.4'}, 'aeon-finalize', 9),
+    ('aeon_ztp.ztp_celery.ztp_bootstrapper', {'os_name': 'eos', 'target': '1.2.3.4'}, 'aeon-bootstrap-eos', 5),
+    ('aeon_ztp.ztp_celery.ztp_bootstrapper', {'os_name': 'eos', 'target': '1.2.3.4', 'resume': True},
+     'aeon-bootstrap-eos', 7),
+    ('aeon_ztp.ztp_celery.ztp_bootstrapper', {'os_name': 'custom', 'target': '1.2.3.4'}, 'aeon-bootstrap', 5),
+])
+def test_task_routes(task, kwargs, queue, priority):
+    route = ztp_celery.celery.amqp.router.route({}, task, (), kwargs)
+    assert route['queue'].name == queue
+    assert route['priority'] == priority
+
+
+@patch('aeon_ztp.ztp_celery._AEON_BOOTSTRAP_PRIORITY', {'cumulus': 3})
+def test_task_routes_os_priority():
+    route = ztp_celery.celery.amqp.router.route({}, 'aeon_ztp.ztp_celery.ztp_bootstrapper', ('cumulus', '1.2.3.4'))
+    assert route['queue'].name == 'aeon-bootstrap-cumulus'
+    assert route['priority'] == 3
+
+
+@patch('aeon_ztp.ztp_celery.repository.register_device')
+@patch('aeon_ztp.ztp_celery.admission')
+@patch('aeon_ztp.ztp_celery.get_server_ipaddr', return_value='1.1.1.1')
+def test_ztp_bootstrapper_over_limit(mock_ipaddr, mock_admission, mock_register):
+    mock_admission.acquire.return_value = None
+    with patch.object(ztp_celery.ztp_bootstrapper, 'retry', side_effect=Retry) as mock_retry:
+        with pytest.raises(Retry):
+            ztp_celery.ztp_bootstrapper('cumulus', '1.2.3.4')
+    kwargs = mock_retry.call_args[1]
+    assert kwargs['max_retries'] == ztp_celery._AEON_ADMISSION_MAX_RETRIES
+    assert ztp_celery._AEON_ADMISSION_RETRY / 2.0 <= kwargs['countdown'] <= ztp_celery._AEON_ADMISSION_RETRY
+    # not registered until it runs
+    assert not mock_register.called
+
+
+@patch('aeon_ztp.ztp_celery._AEON_ADMISSION_RETRY', 30)
+@patch('aeon_ztp.ztp_celery._AEON_ADMISSION_RETRY_MAX', 600)
+def test_admission_countdown():
+    for retries, delay in ((0, 30), (1, 60), (3, 240), (5, 600), (100, 600)):
+        for _ in range(20):
+            assert delay / 2.0 <= ztp_celery.admission_countdown(retries) <= delay
+
+
+@patch('aeon_ztp.ztp_celery.ztp_bootstrapper.delay')
+@patch('aeon_ztp.ztp_celery.repository.register_device')
+@patch('aeon_ztp.ztp_celery.admission')
+@patch('aeon_ztp.ztp_celery.get_server_ipaddr', return_value='1.1.1.1')
+def test_ztp_bootstrapper_over_limit_dropped(mock_ipaddr, mock_admission, mock_register, mock_delay, app):
+    mock_admission.acquire.return_value = None
+    assert ztp_celery.enqueue_bootstrap('eos', '1.2.3.4')
+    ztp_celery.ztp_bootstrapper.push_request(retries=ztp_celery._AEON_ADMISSION_MAX_RETRIES)
+    try:
+        with patch.object(ztp_celery.ztp_bootstrapper, 'retry', side_effect=Retry) as mock_retry:
+            assert ztp_celery.ztp_bootstrapper.run(**mock_delay.call_args[1]) is None
+    finally:
+        ztp_celery.ztp_bootstrapper.pop_request()
+    assert not mock_retry.called
+    assert not mock_register.called
+    # the next registration of the device enqueues a new bootstrap
+    assert ztp_celery.enqueue_bootstrap('eos', '1.2.3.4')
+
+
+@patch('aeon_ztp.ztp_celery._AEON_BOOTSTRAP_MODE', 'engine')
+@patch('aeon_ztp.ztp_celery.bootstrap_engine')
+@patch('aeon_ztp.ztp_celery.admission')
+@patch('aeon_ztp.ztp_celery.get_server_ipaddr', return_value='1.1.1.1')
+def test_ztp_bootstrapper_engine_keeps_ticket(mock_ipaddr, mock_admission, mock_engine, app):
+    ticket = mock_admission.acquire.return_value
+    assert ztp_celery.ztp_bootstrapper('eos', '1.2.3.4') == 0
+    callback = mock_engine.return_value.submit.call_args[1]['callback']
+    assert callback.keywords['ticket'] is ticket.transfer.return_value
+
+
+@patch('aeon_ztp.ztp_celery.ztp_bootstrapper.delay')
+@patch('aeon_ztp.ztp_celery.run_bootstrap', return_value=0)
+@patch('aeon_ztp.ztp_celery.get_server_ipaddr', return_value='1.1.1.1')
+def test_ztp_bootstrapper_releases_lock(mock_ipaddr, mock_run, mock_delay, app):
+    assert ztp_celery.enqueue_bootstrap('eos', '1.2.3.4')
+    assert not ztp_celery.enqueue_bootstrap('eos', '1.2.3.4')
+    ztp_celery.ztp_bootstrapper(**mock_delay.call_args[1])
+    assert mock_run.call_args[1]['device_lock'].target == '1.2.3.4'
+    assert ztp_celery.enqueue_bootstrap('eos', '1.2.3.4')
+
+
+@patch('aeon_ztp.ztp_celery._AEON_BOOTSTRAP_MODE', 'engine')
+@patch('aeon_ztp.ztp_celery.ztp_bootstrapper.delay')
+@patch('aeon_ztp.ztp_celery.bootstrap_engine')
+@patch('aeon_ztp.ztp_celery.get_server_ipaddr', return_value='1.1.1.1')
+def test_ztp_bootstrapper_engine_keeps_lock(mock_ipaddr, mock_engine, mock_delay, app):
+    assert ztp_celery.enqueue_bootstrap('eos', '1.2.3.4')
+    assert ztp_celery.ztp_bootstrapper(**mock_delay.call_args[1]) == 0
+    # held until the engine finishes the bootstrap
+    assert not ztp_celery.enqueue_bootstrap('eos', '1.2.3.4')
+    callback = mock_engine.return_value.submit.call_args[1]['callback']
+    with patch('aeon_ztp.ztp_celery.finish_bootstrap', return_value=0):
+        callback(0, '')
+    assert ztp_celery.enqueue_bootstrap('eos', '1.2.3.4')
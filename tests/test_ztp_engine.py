@@ -0,0 +1,108 @@
+import logging
+import threading
+import time
+
+from mock import MagicMock, patch
+from tornado.ioloop import IOLoop
+
+from aeon_ztp.ztp_engine import BootstrapEngine, BootstrapExit, ThreadPool, exit_status
+
+
+def fake_bootstrapper(exit_code=None, error=None, delays=()):
+    module = MagicMock()
+
+    def create_bootstrapper(cmdargs):
+        boot = MagicMock()
+        boot.log = logging.getLogger('eos-bootstrap.{}'.format(cmdargs[1]))
+        boot.log.addHandler(logging.NullHandler())
+
+        def bootstrap_steps():
+            for delay in delays:
+                yield delay
+            if error:
+                raise error
+            if exit_code is not None:
+                raise SystemExit(exit_code)
+
+        boot.bootstrap_steps.side_effect = bootstrap_steps
+        return boot
+
+    module.create_bootstrapper.side_effect = create_bootstrapper
+    return module
+
+
+def run_bootstrap(engine, target='1.2.3.4'):
+    return engine.io_loop.run_sync(lambda: engine.bootstrap('eos', ['--target', target]))
+
+
+def test_exit_status():
+    assert exit_status(SystemExit()) == (0, '')
+    assert exit_status(SystemExit(0)) == (0, '')
+    assert exit_status(SystemExit(3)) == (3, '')
+    assert exit_status(SystemExit('failed')) == (1, 'failed')
+    assert exit_status(BootstrapExit(3)) == (3, '')
+
+
+@patch('aeon_ztp.ztp_engine.import_module')
+def test_bootstrap_exit_code(mock_import):
+    mock_import.return_value = fake_bootstrapper(exit_code=3, delays=(0.01,))
+    engine = BootstrapEngine(workers=2)
+    assert run_bootstrap(engine) == (3, '')
+    mock_import.assert_called_with('aeon_ztp.bin.eos_bootstrap')
+    engine.pool.shutdown()
+
+
+@patch('aeon_ztp.ztp_engine.import_module')
+def test_bootstrap_exception(mock_import):
+    mock_import.return_value = fake_bootstrapper(error=ValueError('boom'))
+    engine = BootstrapEngine(workers=2)
+    rc, _stderr = run_bootstrap(engine)
+    assert rc == 1
+    assert 'ValueError: boom' in _stderr
+    engine.pool.shutdown()
+
+
+@patch('aeon_ztp.ztp_engine.import_module')
+def test_bootstrap_releases_logging(mock_import):
+    mock_import.return_value = fake_bootstrapper(exit_code=0)
+    engine = BootstrapEngine(workers=2)
+    assert run_bootstrap(engine) == (0, '')
+    assert not logging.getLogger('eos-bootstrap.1.2.3.4').handlers
+    engine.pool.shutdown()
+
+
+@patch('aeon_ztp.ztp_engine.import_module')
+def test_bootstrap_waits_without_holding_threads(mock_import):
+    # 20 bootstraps waiting 0.2s each on 2 threads
+    mock_import.return_value = fake_bootstrapper(exit_code=0, delays=(0.1, 0.1))
+    engine = BootstrapEngine(workers=2)
+    done = []
+    start = time.time()
+    for idx in range(20):
+        engine.submit('eos', '10.0.0.%d' % idx, ['--target', '10.0.0.%d' % idx],
+                      callback=lambda rc, _stderr: done.append(rc))
+    assert engine.join(timeout=10)
+    assert time.time() - start < 2
+    assert done == [0] * 20
+    assert engine.running == {}
+
+
+@patch('aeon_ztp.ztp_engine.import_module')
+def test_submit_callback_error_is_logged(mock_import):
+    mock_import.return_value = fake_bootstrapper(exit_code=0)
+    engine = BootstrapEngine(workers=1)
+    callback = MagicMock(side_effect=RuntimeError('boom'))
+    with patch('aeon_ztp.ztp_engine.logging') as mock_logging:
+        engine.submit('eos', '1.2.3.4', ['--target', '1.2.3.4'], callback=callback)
+        assert engine.join(timeout=10)
+    callback.assert_called_with(0, '')
+    assert mock_logging.getLogger.return_value.exception.called
+
+
+def test_thread_pool():
+    io_loop = IOLoop()
+    pool = ThreadPool(2, io_loop)
+    names = io_loop.run_sync(lambda: pool.submit(lambda: threading.current_thread().name))
+    assert names.startswith('bootstrap-pool-')
+    pool.shutdown()
+    assert pool._threads == []
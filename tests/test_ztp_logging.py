@@ -0,0 +1,119 @@
+import json
+import logging
+import os
+
+import pytest
+from mock import MagicMock
+
+from aeon_ztp import ztp_logging
+from aeon_ztp.ztp_engine import release_logging
+from aeon_ztp.ztp_timing import PhaseTimer
+
+
+def read_log(tmpdir, target):
+    return [json.loads(line) for line in tmpdir.join('{}.log'.format(target)).readlines()]
+
+
+def make_pipeline(tmpdir, **kwargs):
+    return ztp_logging.LogPipeline(device_log_dir=str(tmpdir), syslog_address=None, **kwargs)
+
+
+def make_logger(pipeline, logname, target, timer=None):
+    log = logging.getLogger('{}.{}'.format(logname, target))
+    log.setLevel(logging.INFO)
+    handler = ztp_logging.PipelineHandler(pipeline)
+    handler.addFilter(ztp_logging.BootstrapContext(logname, target, timer))
+    log.addHandler(handler)
+    return log
+
+
+def test_json_formatter():
+    record = logging.LogRecord('eos-bootstrap.1.2.3.4', logging.INFO, __file__, 1, 'step %d', (1,), None)
+    record.program, record.target, record.phase = 'eos-bootstrap', '1.2.3.4', 'reboot'
+    item = json.loads(ztp_logging.JsonFormatter().format(record))
+    assert item['message'] == 'step 1'
+    assert (item['level'], item['program'], item['target'], item['phase']) == (
+        'INFO', 'eos-bootstrap', '1.2.3.4', 'reboot')
+    assert item['time'].endswith('Z')
+
+    line = ztp_logging.JsonFormatter(syslog=True).format(record)
+    assert line.startswith('eos-bootstrap: {')
+
+
+def test_device_log_files(tmpdir):
+    pipeline = make_pipeline(tmpdir)
+    timer = PhaseTimer()
+    log = make_logger(pipeline, 'eos-bootstrap', '1.2.3.4', timer)
+    other = make_logger(pipeline, 'aeon-finalizer', '1.2.3.5')
+    try:
+        log.info('waiting for %s', 'device')
+        with timer.phase('reboot'):
+            log.warning('rebooting')
+        other.info('finally')
+        try:
+            raise ValueError('boom')
+        except ValueError:
+            log.exception('failed')
+    finally:
+        release_logging(log)
+        release_logging(other)
+        pipeline.stop()
+
+    items = read_log(tmpdir, '1.2.3.4')
+    assert [(item['message'], item['phase']) for item in items] == [
+        ('waiting for device', None), ('rebooting', 'reboot'), ('failed', None)]
+    assert 'ValueError: boom' in items[2]['exc']
+    assert [item['program'] for item in read_log(tmpdir, '1.2.3.5')] == ['aeon-finalizer']
+
+
+def test_pipeline_drops_when_full(tmpdir):
+    pipeline = make_pipeline(tmpdir, maxsize=1)
+    # a listener that does not run, so the queue stays full
+    pipeline._pid = os.getpid()
+    pipeline._queue = ztp_logging.Queue(1)
+    assert pipeline.put(MagicMock())
+    assert not pipeline.put(MagicMock())
+    assert pipeline.dropped == 1
+
+
+def test_pipeline_restarts_after_fork(tmpdir):
+    pipeline = make_pipeline(tmpdir)
+    pipeline.start()
+    thread = pipeline._thread
+    pipeline._pid = -1
+    pipeline.start()
+    assert pipeline._thread is not thread
+    pipeline.stop()
+    assert pipeline.handlers == []
+
+
+def test_device_log_handler_max_open(tmpdir):
+    handler = ztp_logging.DeviceLogHandler(str(tmpdir), max_open=2)
+    for target in ('1.1.1.1', '1.1.1.2', '1.1.1.3', '1.1.1.1'):
+        record = logging.LogRecord('test', logging.INFO, __file__, 1, target, None, None)
+        record.target = target
+        handler.handle(record)
+    assert list(handler._streams) == ['1.1.1.3', '1.1.1.1']
+    handler.close()
+    assert tmpdir.join('1.1.1.1.log').read() == '1.1.1.1\n1.1.1.1\n'
+
+
+def test_device_log_path():
+    assert ztp_logging.device_log_path('/var/log', '1.2.3.4') == '/var/log/1.2.3.4.log'
+
+
+@pytest.mark.parametrize('target', ['', '..', '../1.2.3.4', '/1.2.3.4'])
+def test_device_log_path_invalid(target):
+    with pytest.raises(ValueError):
+        ztp_logging.device_log_path('/var/log', target)
+
+
+def test_device_logger():
+    log = ztp_logging.device_logger('eos-bootstrap', '1.2.3.6')
+    try:
+        handler, = log.handlers
+        assert handler.pipeline is ztp_logging.pipeline
+        assert handler.filters[0].target == '1.2.3.6'
+    finally:
+        release_logging(log)
+    assert not log.handlers
@@ -0,0 +1,105 @@
+import json
+import os
+
+import pytest
+from mock import MagicMock, patch
+
+from aeon_ztp import ztp_metrics
+
+
+@pytest.fixture()
+def registry():
+    return ztp_metrics.Metrics()
+
+
+def test_counter(registry):
+    registry.inc('aeon_ztp_http_requests_total', {'endpoint': '/api/devices'})
+    registry.inc('aeon_ztp_http_requests_total', {'endpoint': '/api/devices'}, value=2)
+    assert registry.snapshot() == [['aeon_ztp_http_requests_total', {'endpoint': '/api/devices'}, 3]]
+
+
+def test_histogram_exposition(registry):
+    for value in (0.001, 0.2, 0.3, 20):
+        registry.observe('aeon_ztp_db_commit_duration_seconds', value)
+    text = ztp_metrics.exposition(registry.snapshot())
+    lines = text.splitlines()
+    assert '# TYPE aeon_ztp_db_commit_duration_seconds histogram' in lines
+    assert 'aeon_ztp_db_commit_duration_seconds_bucket{le="0.005"} 1' in lines
+    assert 'aeon_ztp_db_commit_duration_seconds_bucket{le="0.25"} 2' in lines
+    assert 'aeon_ztp_db_commit_duration_seconds_bucket{le="10.0"} 3' in lines
+    assert 'aeon_ztp_db_commit_duration_seconds_bucket{le="+Inf"} 4' in lines
+    assert 'aeon_ztp_db_commit_duration_seconds_count 4' in lines
+
+
+def test_exposition_escapes_labels():
+    text = ztp_metrics.exposition([['aeon_ztp_bootstraps_in_flight', {'os_name': 'a"b'}, 1]])
+    assert 'aeon_ztp_bootstraps_in_flight{os_name="a\\"b"} 1' in text.splitlines()
+
+
+def test_collect_merges_processes(tmpdir):
+    other = [['aeon_ztp_celery_tasks_total', {'task': 'ztp_bootstrapper'}, 2],
+             ['aeon_ztp_db_commit_duration_seconds', {},
+              {'buckets': [1] + [0] * 10, 'sum': 0.001, 'count': 1}]]
+    tmpdir.join('1.json').write(json.dumps(other))
+    tmpdir.join('2.json').write('not json')
+
+    registry = ztp_metrics.Metrics(str(tmpdir))
+    registry.inc('aeon_ztp_celery_tasks_total', {'task': 'ztp_bootstrapper'})
+    registry.observe('aeon_ztp_db_commit_duration_seconds', 1)
+    entries = dict((name, value) for name, _, value in registry.collect())
+
+    assert entries['aeon_ztp_celery_tasks_total'] == 3
+    assert entries['aeon_ztp_db_commit_duration_seconds']['count'] == 2
+    assert entries['aeon_ztp_db_commit_duration_seconds']['buckets'][0] == 1
+    assert tmpdir.join(registry.snapshot_name()).check()
+    assert registry.snapshot_name().startswith('%d-' % os.getpid())
+
+
+def test_collect_retires_ended_processes(tmpdir):
+    counter = [['aeon_ztp_celery_tasks_total', {}, 2],
+               ['aeon_ztp_celery_queue_depth', {'queue': 'celery'}, 7]]
+    pid, start = os.getpid(), ztp_metrics.process_start(os.getpid())
+    # an ended process, and an earlier process of a pid reused by this one
+    for fname in ('%d-1.json' % (pid + 100000), '%d-%d.json' % (pid, start - 1)):
+        tmpdir.join(fname).write(json.dumps(counter))
+
+    registry = ztp_metrics.Metrics(str(tmpdir))
+    registry.inc('aeon_ztp_celery_tasks_total')
+    entries = dict((name, value) for name, _, value in registry.collect())
+    assert entries == {'aeon_ztp_celery_tasks_total': 5}
+    assert sorted(fname for fname in os.listdir(str(tmpdir)) if fname.endswith('.json')) == [
+        registry.snapshot_name(), 'retired.json']
+
+    # the retired counters are kept
+    registry.inc('aeon_ztp_celery_tasks_total')
+    entries = dict((name, value) for name, _, value in registry.collect())
+    assert entries == {'aeon_ztp_celery_tasks_total': 6}
+
+
+def test_process_alive():
+    assert ztp_metrics.process_alive(os.getpid())
+    assert ztp_metrics.process_alive(os.getpid(), ztp_metrics.process_start(os.getpid()))
+    assert not ztp_metrics.process_alive(os.getpid(), 1)
+    assert ztp_metrics.snapshot_process('12-345.json') == (12, 345)
+    assert ztp_metrics.snapshot_process('12.json') == (12, None)
+    assert ztp_metrics.snapshot_process('retired.json') is None
+
+
+@patch('aeon_ztp.ztp_metrics.os.getpid')
+def test_fork_resets(mock_getpid, registry):
+    mock_getpid.return_value = registry._pid
+    registry.inc('aeon_ztp_celery_tasks_total')
+    mock_getpid.return_value = registry._pid + 1
+    assert registry.snapshot() == []
+
+
+@patch('aeon_ztp.ztp_celery.metrics')
+def test_celery_task_metrics(mock_metrics):
+    from aeon_ztp import ztp_celery
+    task = MagicMock()
+    task.name = 'aeon_ztp.ztp_celery.ztp_bootstrapper'
+    ztp_celery._start_task_timer(task_id='1')
+    ztp_celery._record_task_metrics(task_id='1', task=task, kwargs={'os_name': 'eos'}, state='SUCCESS')
+    mock_metrics.inc.assert_called_with('aeon_ztp_celery_tasks_total', {
+        'task': task.name, 'os_name': 'eos', 'state': 'SUCCESS'})
+    assert mock_metrics.observe.call_args[0][0] == 'aeon_ztp_celery_task_duration_seconds'
@@ -1,5 +1,8 @@
 from tempfile import NamedTemporaryFile
+from collections import namedtuple
+import json
 from mock import patch
+import copy
 import yaml
 import pytest
 import os
@@ -9,6 +12,37 @@ from aeon_ztp import ztp_os_selector
 topdir = '/opt/aeonztps/'
 ztp_os_selector._AEON_TOPDIR = topdir
 
+dev_data = {
+    'os_name': 'cumulus-vx',
+    'vendor': 'cumulus',
+    'hw_part_number': '1234',
+    'hostname': 'cumulus',
+    'fqdn': 'cumulus.localhost',
+    'virtual': True,
+    'service_tag': '1234',
+    'os_version': '3.1.1',
+    'hw_version': '1234',
+    'mac_address': '0123456789012',
+    'serial_number': '09786554',
+    'hw_model': 'cvx1000'
+}
+
+cfg_data = {
+    'default': {
+        'regex_match': '3\\.1\\.[12]',
+        'image': 'CumulusLinux-3.1.2-amd64.bin'
+    },
+    'group_a': {
+        'regex_match': '3\\.1\\.[12]',
+        'image': 'CumulusLinux-3.1.2-amd64.bin',
+        'finally': 'finally',
+        'matches': {
+            'hw_model': ['cvx1000'],
+            'mac_address': ['0123456789012', '2109876543210']
+        }
+    }
+}
+
 
 def test_vendor_list():
     expected_vendor_list = ['nxos', 'eos', 'cumulus']
@@ -32,12 +66,19 @@ def test_load_yaml_exception(mock_yaml):
         ztp_os_selector.load_yaml('filename')
 
 
-@patch('aeon_ztp.ztp_os_selector.load_yaml')
-def test_get(mock_load_yaml):
+@patch('aeon_ztp.ztp_os_selector.selectors')
+def test_get(mock_selectors):
     vendor = 'test_vendor'
     filename = os.path.join(topdir, 'etc/profiles/{vendor}/os-selector.cfg'.format(vendor=vendor))
-    ztp_os_selector.get(vendor)
-    mock_load_yaml.assert_called_with(filename)
+    assert ztp_os_selector.get(vendor) == mock_selectors.get.return_value.cfg_data
+    mock_selectors.get.assert_called_with(filename)
+
+
+@patch('aeon_ztp.ztp_os_selector.selectors')
+def test_get_exception(mock_selectors):
+    mock_selectors.get.side_effect = ztp_os_selector.CfgLoadError('Unable to load file: os-selector.cfg')
+    with pytest.raises(IOError):
+        ztp_os_selector.get('test_vendor')
 
 
 def test_vendor_missing_config():
@@ -63,3 +104,287 @@ def test_vendor(mock_get, mock_os_access):
     assert v.check_firmware
     assert v.default_image == default_image
     assert v.vendor == vendor
+
+
+def test_match_hw_model():
+    match = ztp_os_selector.match_hw_model(dev_data, cfg_data)
+    assert match[0] == 'group_a'
+    assert match[1] == cfg_data['group_a']
+
+
+def test_match_hw_model_no_match():
+    new_dev_data = copy.deepcopy(dev_data)
+    new_dev_data['hw_model'] = 'cvx2000'
+    match = ztp_os_selector.match_hw_model(new_dev_data, cfg_data)
+    assert match[0] == 'default'
+    assert match[1] == cfg_data['default']
+
+
+def test_match_hw_model_no_default():
+    new_dev_data = copy.deepcopy(dev_data)
+    new_dev_data['hw_model'] = 'cvx2000'
+    new_cfg_data = copy.deepcopy(cfg_data)
+    new_cfg_data.pop('default')
+    try:
+        ztp_os_selector.match_hw_model(new_dev_data, new_cfg_data)
+    except ztp_os_selector.HwNoMatchError as e:
+        pass
+    assert isinstance(e, ztp_os_selector.HwNoMatchError)
+
+
+def test_match_hw_model_multi_match():
+    new_cfg_data = copy.deepcopy(cfg_data)
+    new_cfg_data['group_b'] = {
+        'regex_match': '3\.1\.[12]',
+        'image': 'CumulusLinux-3.1.2-amd64.bin',
+        'matches': {
+            'hw_model': ['cvx1000'],
+            'mac_address': ['0123456789012', '2109876543210']
+        }
+    }
+    try:
+        ztp_os_selector.match_hw_model(dev_data, new_cfg_data)
+    except ztp_os_selector.HwMultiMatchError as e:
+        pass
+    assert isinstance(e, ztp_os_selector.HwMultiMatchError)
+
+
+def test_match_os_version_regex_no_upgrade():
+    item_match = namedtuple('item_match', ['hw_match', 'data'])
+    hw_match = item_match('group_a', cfg_data['group_a'])
+    upgrade = ztp_os_selector.match_os_version(dev_data, hw_match.data)
+    assert not upgrade
+
+
+def test_match_os_version_exact_match_no_upgrade():
+    new_cfg_data = copy.deepcopy(cfg_data)
+    new_cfg_data['group_a'].pop('regex_match')
+    new_cfg_data['group_a']['exact_match'] = '3.1.1'
+    item_match = namedtuple('item_match', ['hw_match', 'data'])
+    hw_match = item_match('group_a', new_cfg_data['group_a'])
+    upgrade = ztp_os_selector.match_os_version(dev_data, hw_match.data)
+    assert not upgrade
+
+
+def test_match_os_version_regex_upgrade():
+    new_cfg_data = copy.deepcopy(cfg_data)
+    new_cfg_data['group_a']['regex_match'] = '3\.1\.[23]'
+    item_match = namedtuple('item_match', ['hw_match', 'data'])
+    hw_match = item_match('group_a', new_cfg_data['group_a'])
+    upgrade = ztp_os_selector.match_os_version(dev_data, hw_match.data)
+    assert upgrade == new_cfg_data['group_a']['image']
+
+
+def test_match_os_version_exact_match_upgrade():
+    new_cfg_data = copy.deepcopy(cfg_data)
+    new_cfg_data['group_a'].pop('regex_match')
+    new_cfg_data['group_a']['exact_match'] = '3.1.0'
+    item_match = namedtuple('item_match', ['hw_match', 'data'])
+    hw_match = item_match('group_a', new_cfg_data['group_a'])
+    upgrade = ztp_os_selector.match_os_version(dev_data, hw_match.data)
+    assert upgrade == new_cfg_data['group_a']['image']
+
+
+def test_match_os_version_cfgerror():
+    with pytest.raises(ztp_os_selector.CfgError):
+        dev_data = {'os_version': '1.A'}
+        hw_match = []
+        ztp_os_selector.match_os_version(dev_data, hw_match)
+
+
+def test_select():
+    assert ztp_os_selector.select(dev_data, cfg_data) == {'ok': True, 'image_name': False, 'finally': 'finally'}
+
+    new_dev_data = dict(dev_data, hw_model='cvx2000', os_version='3.0.0')
+    assert ztp_os_selector.select(new_dev_data, cfg_data) == {
+        'ok': True, 'image_name': 'CumulusLinux-3.1.2-amd64.bin', 'finally': None}
+
+
+def test_select_errors():
+    new_cfg_data = copy.deepcopy(cfg_data)
+    new_cfg_data.pop('default')
+    assert ztp_os_selector.select(dict(dev_data, hw_model='cvx2000'), new_cfg_data) == {
+        'ok': False, 'error_type': 'hw_match', 'error_message': 'no matching hw_model value'}
+
+    new_cfg_data['group_a'].pop('regex_match')
+    results = ztp_os_selector.select(dev_data, new_cfg_data)
+    assert (results['ok'], results['error_type']) == (False, 'cfg_error')
+
+
+def test_select_missing_image():
+    # not a selection of no image to install
+    new_cfg_data = copy.deepcopy(cfg_data)
+    new_cfg_data['group_a'].pop('image')
+    assert ztp_os_selector.select(dev_data, new_cfg_data) == {
+        'ok': False, 'error_type': 'cfg_error', 'error_message': "Expecting 'image'"}
+    assert ztp_os_selector.Selector(new_cfg_data).select(dev_data)['ok'] is False
+
+
+def test_select_os(tmpdir):
+    cfg_file = tmpdir.join('os-selector.cfg')
+    cfg_file.write(yaml.dump(cfg_data, default_flow_style=False))
+    assert ztp_os_selector.select_os(dev_data, str(cfg_file)) == ztp_os_selector.select(dev_data, cfg_data)
+
+
+def test_select_os_load_errors(tmpdir):
+    missing = str(tmpdir.join('missing.cfg'))
+    assert ztp_os_selector.select_os(dev_data, missing) == {
+        'ok': False, 'error_type': 'args', 'error_message': 'Unable to load file: %s' % missing}
+
+    bad_file = tmpdir.join('bad.cfg')
+    bad_file.write('%%%%%%%%')
+    results = ztp_os_selector.select_os(dev_data, str(bad_file))
+    assert (results['ok'], results['error_type']) == (False, 'args')
+    assert results['error_message'].startswith('YAML syntax error')
+
+
+def write_cfg(cfg_file, contents):
+    cfg_file.write(yaml.dump(contents, default_flow_style=False))
+
+
+def test_selector_cache(tmpdir):
+    cfg_file = tmpdir.join('os-selector.cfg')
+    write_cfg(cfg_file, cfg_data)
+    cache = ztp_os_selector.SelectorCache()
+    selector = cache.get(str(cfg_file))
+    assert selector.cfg_data == cfg_data
+    with patch('aeon_ztp.ztp_os_selector.load_cfg') as mock_load_cfg:
+        assert cache.get(str(cfg_file)) is selector
+        assert not mock_load_cfg.called
+
+    # a modified file is compiled again
+    new_cfg_data = copy.deepcopy(cfg_data)
+    new_cfg_data['default']['image'] = 'CumulusLinux-3.1.3-amd64.bin'
+    write_cfg(cfg_file, new_cfg_data)
+    os.utime(str(cfg_file), (1, 1))
+    assert cache.get(str(cfg_file)).cfg_data == new_cfg_data
+
+    cache.clear()
+    assert cache.get(str(cfg_file)) is not selector
+
+
+def test_selector_cache_missing_file(tmpdir):
+    with pytest.raises(ztp_os_selector.CfgLoadError):
+        ztp_os_selector.SelectorCache().get(str(tmpdir.join('missing.cfg')))
+
+
+def test_selector_missing_matches():
+    new_cfg_data = copy.deepcopy(cfg_data)
+    new_cfg_data['group_a'].pop('matches')
+    with pytest.raises(ztp_os_selector.CfgError):
+        ztp_os_selector.Selector(new_cfg_data)
+
+
+@pytest.mark.parametrize('group, os_version, image_name', [
+    ({'regex_match': '4\\.16\\..*', 'image': 'new.swi'}, '4.16.6M', False),
+    ({'regex_match': '4\\.16\\..*', 'image': 'new.swi'}, '4.15.2F', 'new.swi'),
+    ({'exact_match': ['4.16.6M', '4.17.0F'], 'image': 'new.swi'}, '4.17.0f', False),
+    ({'exact_match': '4.16.6M', 'image': 'new.swi'}, '4.16.6', 'new.swi'),
+])
+def test_version_rule(group, os_version, image_name):
+    rule = ztp_os_selector.VersionRule(group)
+    assert rule.image_name(os_version) == image_name
+    assert ztp_os_selector.match_os_version({'os_version': os_version}, group) == image_name
+
+
+@pytest.mark.parametrize('group', [{'image': 'new.swi'}, {'regex_match': '4.16.[', 'image': 'new.swi'}])
+def test_version_rule_cfgerror(group):
+    rule = ztp_os_selector.VersionRule(group)
+    with pytest.raises(ztp_os_selector.CfgError):
+        rule.image_name('4.16.6M')
+
+
+def test_match_hw_model_exact_values():
+    # a value only matches in full, not as part of a listed value
+    new_dev_data = dict(dev_data, mac_address='01234567890', hw_model='cvx100')
+    assert ztp_os_selector.match_hw_model(new_dev_data, cfg_data).hw_match == 'default'
+
+
+def test_match_hw_model_value_types():
+    new_cfg_data = {
+        'virtual': {'matches': {'virtual': True, 'serial_number': [9786554]}, 'exact_match': '3.1.1'},
+        'physical': {'matches': {'virtual': False}, 'exact_match': '3.1.1'},
+    }
+    new_dev_data = dict(dev_data, serial_number='9786554')
+    assert ztp_os_selector.match_hw_model(new_dev_data, new_cfg_data).hw_match == 'virtual'
+    assert ztp_os_selector.match_hw_model(dict(dev_data, virtual=False), new_cfg_data).hw_match == 'physical'
+
+
+def test_match_hw_model_missing_fact():
+    new_dev_data = copy.deepcopy(dev_data)
+    new_dev_data.pop('mac_address')
+    assert ztp_os_selector.match_hw_model(new_dev_data, cfg_data).hw_match == 'default'
+
+
+def test_match_hw_model_no_matches():
+    new_cfg_data = dict(cfg_data, group_b={'matches': {}, 'exact_match': '3.1.1'})
+    with pytest.raises(ztp_os_selector.HwMultiMatchError) as exc:
+        ztp_os_selector.match_hw_model(dev_data, new_cfg_data)
+    assert 'group_a' in str(exc.value) and 'group_b' in str(exc.value)
+
+
+def test_selector_index_many_groups():
+    new_cfg_data = dict(('rack_%d' % idx, {
+        'matches': {'hw_model': ['cvx1000'], 'mac_address': ['%012x' % (idx * 100 + mac) for mac in range(100)]},
+        'exact_match': '3.1.1', 'image': 'rack_%d.bin' % idx}) for idx in range(200))
+    new_cfg_data['default'] = cfg_data['default']
+    selector = ztp_os_selector.Selector(new_cfg_data)
+
+    assert selector.match_hw_model(dict(dev_data, mac_address='%012x' % 12345)).hw_match == 'rack_123'
+    assert selector.match_hw_model(dict(dev_data, mac_address='%012x' % 20000)).hw_match == 'default'
+
+    # the same value in two groups
+    new_cfg_data['rack_7']['matches']['mac_address'].append('%012x' % 12345)
+    with pytest.raises(ztp_os_selector.HwMultiMatchError):
+        ztp_os_selector.Selector(new_cfg_data).match_hw_model(dict(dev_data, mac_address='%012x' % 12345))
+
+
+def write_profile(topdir, os_name, contents):
+    profile_dir = topdir.mkdir('etc').mkdir('profiles').mkdir(os_name)
+    write_cfg(profile_dir.join('os-selector.cfg'), contents)
+
+
+def test_plan_device(tmpdir):
+    write_profile(tmpdir, 'cumulus', cfg_data)
+    facts = dict(dev_data, os_name='cumulus-vx')
+    item = dict(ip_addr='1.2.3.4', os_name='cumulus', hw_model='cvx1000', os_version='3.0.0',
+                facts=json.dumps(dict(facts, os_version='3.0.0')))
+    assert ztp_os_selector.plan_device(item, topdir=str(tmpdir)) == {
+        'ip_addr': '1.2.3.4', 'os_name': 'cumulus', 'hw_model': 'cvx1000', 'os_version': '3.0.0',
+        'ok': True, 'image_name': 'CumulusLinux-3.1.2-amd64.bin', 'finally': 'finally'}
+
+    # the facts of a registered device are not known yet
+    decision = ztp_os_selector.plan_device(dict(ip_addr='1.2.3.5', os_name='cumulus'), topdir=str(tmpdir))
+    assert (decision['ok'], decision['error_type']) == (False, 'facts')
+
+    decision = ztp_os_selector.plan_device(dict(item, os_name='eos'), topdir=str(tmpdir))
+    assert (decision['ok'], decision['error_type']) == (False, 'args')
+
+
+def test_plan_os(tmpdir):
+    cfg_file = tmpdir.join('os-selector.cfg')
+    write_cfg(cfg_file, cfg_data)
+    devices = [dict(dev_data, ip_addr='10.0.0.%d' % idx, os_version='3.1.%d' % (idx % 4)) for idx in range(8)]
+    devices.append(dict(ip_addr='10.0.0.8', os_name='cumulus'))
+
+    summary = ztp_os_selector.PlanSummary()
+    decisions = [summary.add(decision) for decision in ztp_os_selector.plan_os(devices, config_file=str(cfg_file))]
+    assert [decision['image_name'] for decision in decisions[:4]] == [
+        'CumulusLinux-3.1.2-amd64.bin', False, False, 'CumulusLinux-3.1.2-amd64.bin']
+    assert summary.report() == {
+        'total': 9, 'upgrade': 4, 'current': 4, 'error': 1,
+        'images': [{'os_name': 'cumulus-vx', 'image_name': 'CumulusLinux-3.1.2-amd64.bin', 'count': 4}],
+        'errors': [{'os_name': 'cumulus', 'error_type': 'facts', 'count': 1}]}
+
+
+@pytest.mark.parametrize('facts', [
+    dict(dev_data),
+    dict(dev_data, hw_model='cvx2000'),
+    dict(dev_data, hw_model='cvx2000', os_version='3.0.0'),
+    dict((key, value) for key, value in dev_data.items() if key != 'hw_model'),
+])
+def test_match_hw_model_same_as_selector(facts):
+    # the one-off pass and the compiled index select the same group
+    selector = ztp_os_selector.Selector(cfg_data)
+    assert ztp_os_selector.match_hw_model(facts, cfg_data) == selector.match_hw_model(facts)
+    assert ztp_os_selector.select(facts, cfg_data) == selector.select(facts)
@@ -0,0 +1,48 @@
+from mock import patch
+
+from aeon_ztp import ztp_routes
+
+
+def test_source_address_closes_socket():
+    with patch('aeon_ztp.ztp_routes.socket.socket') as mock_socket:
+        sock = mock_socket.return_value
+        sock.getsockname.return_value = ('10.0.0.1', 40000)
+        assert ztp_routes.source_address('10.0.0.20') == '10.0.0.1'
+    sock.connect.assert_called_with(('10.0.0.20', 0))
+    sock.close.assert_called_once_with()
+
+
+def test_source_address_loopback():
+    assert ztp_routes.source_address('127.0.0.1') == '127.0.0.1'
+
+
+def test_subnet():
+    assert ztp_routes.subnet('10.1.2.3', 24) == '10.1.2.0'
+    assert ztp_routes.subnet('10.1.2.3', 16) == '10.1.0.0'
+    assert ztp_routes.subnet('10.1.2.3', 32) == '10.1.2.3'
+
+
+@patch('aeon_ztp.ztp_routes.time')
+@patch('aeon_ztp.ztp_routes.source_address', return_value='10.0.0.1')
+def test_cache_per_subnet(mock_lookup, mock_time):
+    mock_time.time.return_value = 1000
+    cache = ztp_routes.SourceAddressCache(ttl=60, prefix=24)
+    assert cache.get('10.0.0.20') == '10.0.0.1'
+    assert cache.get('10.0.0.21') == '10.0.0.1'
+    assert mock_lookup.call_count == 1
+
+    cache.get('10.0.1.20')
+    assert mock_lookup.call_count == 2
+
+    # looked up again once the entry expires
+    mock_time.time.return_value = 1060
+    cache.get('10.0.0.20')
+    assert mock_lookup.call_count == 3
+
+
+@patch('aeon_ztp.ztp_routes.source_address', return_value='10.0.0.1')
+def test_cache_disabled(mock_lookup):
+    cache = ztp_routes.SourceAddressCache(ttl=0)
+    cache.get('10.0.0.20')
+    cache.get('10.0.0.20')
+    assert mock_lookup.call_count == 2
@@ -0,0 +1,79 @@
+import pytest
+from mock import patch
+
+from aeon_ztp import ztp_timing
+
+
+class Bootstrapper(object):
+    def __init__(self):
+        self.timer = ztp_timing.PhaseTimer()
+
+    @ztp_timing.timed('wait-for-device')
+    def wait_for_device(self, fail=False):
+        if fail:
+            raise SystemExit(1)
+        return 'dev'
+
+    @ztp_timing.timed('reboot')
+    def reboot_steps(self, fail=False):
+        yield 60
+        if fail:
+            raise SystemExit(1)
+        yield 10
+
+
+@patch('aeon_ztp.ztp_timing.time')
+def test_phase(mock_time):
+    mock_time.time.side_effect = [100, 101, 110.5, 112]
+    timer = ztp_timing.PhaseTimer()
+    with timer.phase('reboot'):
+        with timer.phase('wait-for-device'):
+            pass
+    assert [(p['phase'], p['duration'], p['ok']) for p in timer.report()] == [
+        ('wait-for-device', 9.5, True), ('reboot', 12, True)]
+    assert '_started' not in timer.report()[0]
+
+
+def test_timed():
+    boot = Bootstrapper()
+    assert boot.wait_for_device() == 'dev'
+    with pytest.raises(SystemExit):
+        boot.wait_for_device(fail=True)
+    assert [(p['phase'], p['ok']) for p in boot.timer.report()] == [
+        ('wait-for-device', True), ('wait-for-device', False)]
+
+
+@patch('aeon_ztp.ztp_timing.time')
+def test_timed_steps(mock_time):
+    mock_time.time.side_effect = [100, 170, 200, 260]
+    boot = Bootstrapper()
+    steps = boot.reboot_steps()
+    assert next(steps) == 60
+    assert boot.timer.report() == []
+    assert list(steps) == [10]
+    with pytest.raises(SystemExit):
+        list(boot.reboot_steps(fail=True))
+    assert [(p['phase'], p['duration'], p['ok']) for p in boot.timer.report()] == [
+        ('reboot', 70, True), ('reboot', 60, False)]
+
+
+def test_close():
+    timer = ztp_timing.PhaseTimer()
+    outer = timer.start('reboot')
+    timer.start('wait-for-device')
+    timer.close(ok=False)
+    assert [(p['phase'], p['ok']) for p in timer.report()] == [
+        ('wait-for-device', False), ('reboot', False)]
+    # stopping a phase closed by close() is a no-op
+    timer.stop(outer)
+    assert len(timer.report()) == 2
+
+
+def test_current():
+    timer = ztp_timing.PhaseTimer()
+    assert timer.current() is None
+    with timer.phase('reboot'):
+        with timer.phase('wait-for-device'):
+            assert timer.current() == 'wait-for-device'
+        assert timer.current() == 'reboot'
+    assert timer.current() is None